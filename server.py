@@ -8,24 +8,46 @@ import configparser
 import hashlib
 import json
 import os
-import pickle
 import random
 import sys
 import time
 import traceback
+import urllib.parse
 from datetime import datetime
 
 import asyncio
 from aiohttp import web
-import requests
 import ssl
 import websockets
 
 import memcache
+import vlsevents
+import vlsgeo
+import vlslog
+import vlshttp
+import vlslease
 import vlsmarket
+import vlsmasternodes
+import vlsmempool
+import vlsmetrics
+import vlsoverload
+import vlsratelimit
 import vlsstats
+import vlssupply
 import vlswallet
 import vlswebsitedb
+import vlsworkers
+
+metrics = vlsmetrics.registry
+rpc_cache_requests = metrics.counter('veles_rpc_cache_requests_total', 'Cached RPC lookups by result', ['method', 'result'])
+ws_commands = metrics.histogram('veles_ws_command_seconds', 'Websocket command handling duration', ['service', 'command'])
+ws_broadcast_seconds = metrics.histogram('veles_ws_broadcast_seconds', 'Time to queue a broadcast message to all the clients')
+ws_broadcast_messages = metrics.counter('veles_ws_broadcast_messages_total', 'Messages queued to the clients by broadcasts')
+pull_task_seconds = metrics.histogram('veles_pull_task_seconds', 'Duration of a single pull task iteration', ['task'])
+pull_task_errors = metrics.counter('veles_pull_task_errors_total', 'Pull task iterations failed or retried', ['task'])
+events_published = metrics.counter('veles_events_published_total', 'Events published', ['name'])
+ws_resumes = metrics.counter('veles_ws_resume_total', 'Websocket event resumes by result', ['result'])
+loop_lag_seconds = metrics.histogram('veles_event_loop_lag_seconds', 'Event loop scheduling lag', buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
 
 class ConfigurationError(ValueError):
 	'''raise this when there's a critical error with the configuration file'''
@@ -40,6 +62,12 @@ class ClientConnection(object):
 		self.url_path = url_path
 		self.url_host = url_host
 		self.origin = origin
+		self.last_command = (None, None)
+		self.ip = None
+		self.bucket = None	# rate limiter tokens of the connection
+		self.admitted = False	# command in progress counted by the admission control
+		self.held = None	# live events held back while the missed ones are replayed
+		self.event_position = None	# (epoch, seq) the client has the events up to
 
 	@asyncio.coroutine
 	def send(self, payload):
@@ -50,9 +78,36 @@ class ClientConnection(object):
 				yield from self.ws.send(payload)
 			except:
 				success = False
-				print("LIVE trace: Python error: %s" % pickle.dumps(sys.exc_info()[1]))
+				vlslog.logger.warning("Error sending to client: %s", sys.exc_info()[1])
 				self.close()
 
+	def send_event(self, payload, seq = None, epoch = None):
+		# live event, skipped when a replay has sent it already
+		if self.held != None:
+			self.held += [(payload, seq, epoch)]
+			return
+
+		if seq and self.event_position and self.event_position[0] == epoch and seq <= self.event_position[1]:
+			return
+
+		if seq:
+			self.event_position = (epoch, seq)
+
+		asyncio.ensure_future(self.send(payload))
+
+	def hold_events(self):
+		if self.held == None:
+			self.held = []
+
+	def release_events(self, epoch, seq):
+		# after a replay up to seq: the held events in order, without the
+		# ones the replay included
+		held, self.held = self.held or [], None
+		self.event_position = (epoch, seq)
+
+		for payload, event_seq, event_epoch in held:
+			self.send_event(payload, event_seq, event_epoch)
+
 	def is_open(self):
 		if self.ws:
 			return self.ws.open
@@ -182,27 +237,82 @@ class VelesWebsiteApiServer(object):
 	disabled_wallet_commands = ['stop']
 	pull_block_delay = 20
 	pull_mnlist_delay = 60
-	pull_price_delay = 60*10
+	pull_price_delay = 60
 	recent_events = {}
-	event_subscribers = []
 	locations = {}
+	location_task = None
+	loop_lag_interval = 0.1	# also the lag samples of the admission control
+	is_publisher = True	# runs the pull tasks, false on the follower workers
+	events_channel = None	# event hub connection in the multi-process mode
+	reuse_port = False
+	lease = None	# poller leader election between the instances, when configured
+	lease_channel = None
+	pull_tasks = []
+	ratelimit = None
+	ip_header = None	# eg. X-Forwarded-For behind a proxy, the client address otherwise
+	ip_header_hops = 1	# trusted proxies appending to it, the client is that far from the right
+	admission = None
+	cheap_services = ['price', 'mempool', 'masternodes', 'location']	# served from memory, never shed
+	cheap_http_paths = ['/metrics', '/api/stats/price/', '/api/chain/mempool']
+	mempool_snapshot_interval = 300	# full mempool copy for the followers, the deltas in between
+	mempool_shared_at = 0
+	state_request_delay = 10	# between the snapshot requests of a follower
+	state_requested_at = {}
 
 	def __init__(self, config):
 		self.config = config
+
+		# optional polling intervals, eg. for benchmarks
+		for name in ['pull_block_delay', 'pull_mnlist_delay', 'pull_price_delay']:
+			if name in config['server']:
+				setattr(self, name, float(config['server'][name]))
+
 		self.wallet = vlswallet.VelesRPCClient(**config['wallet'])
-		self.statsdb = vlsstats.VelesChainStatsDB(**config['mysql'], wallet = self.wallet)
+		self.supply = vlssupply.VelesSupplyTracker(self.wallet)
+		self.statsdb = vlsstats.VelesChainStatsDB(**config['mysql'], wallet = self.wallet, supply_tracker = self.supply)
 		self.webdb = vlswebsitedb.VelesWebsiteDB(**config['mysql'])
-		self.market = vlsmarket.VelesMarketClient(self.wallet)
+		self.http = vlshttp.VelesHttpClient()
+		self.geo = vlsgeo.VelesGeoResolver(self.http, **(config['geoip'] if 'geoip' in config else {}))
+		self.geo_clusters = vlsgeo.VelesGeoClusters()
+		self.market = vlsmarket.VelesMarketClient(self.wallet, self.supply, self.http)
+		self.market_data = vlsmarket.VelesMarketDataService(self.market)
+		self.mempool = vlsmempool.VelesMempoolTracker(self.wallet, **(config['mempool'] if 'mempool' in config else {}))
+		self.masternodes = vlsmasternodes.VelesMasternodeStore()
 		self.cache = memcache.Cache()
-		self.event_subscribers += [self.statsdb]
+		self.events = vlsevents.VelesEventBus()
+		self.events.register(self.statsdb, policy = 'block', threaded = True)	# RPC and SQL commits, never skip a block
+		self.event_log = vlsevents.VelesEventLog(config['server'].get('event_log_size'))
+		self.snapshot = None	# (epoch, seq, message) of the last snapshot frame
+
+		if 'ratelimit' not in config or config['ratelimit'].getboolean('enabled', True):
+			ratelimit_options = dict(config['ratelimit']) if 'ratelimit' in config else {}
+			ratelimit_options.pop('enabled', None)
+			self.ip_header = ratelimit_options.pop('ip_header', None)
+			self.ip_header_hops = max(1, int(ratelimit_options.pop('ip_header_hops', self.ip_header_hops)))
+			self.ratelimit = vlsratelimit.VelesRateLimiter(**ratelimit_options)
+
+		if 'overload' not in config or config['overload'].getboolean('enabled', True):
+			overload_options = dict(config['overload']) if 'overload' in config else {}
+			overload_options.pop('enabled', None)
+			self.admission = vlsoverload.VelesAdmissionController(**overload_options)
+
+		if 'lease' in config and config['lease'].getboolean('enabled', False):
+			lease_engine = vlslease.create_engine_from_config(**config['mysql'])
+			self.lease = vlslease.create_lease(config['lease'], lease_engine)
+			self.lease_channel = vlslease.VelesDatabaseChannel(lease_engine, self.lease.holder, self.handle_leader_message)
+
+		metrics.gauge('veles_ws_clients', 'Connected websocket clients', function = lambda: len(self.clients))
 
 	@asyncio.coroutine
-	def cached_rpc_call(self, method, params = [], ttl = -1):
+	def cached_rpc_call(self, method, params = [], ttl = -1, priority = vlswallet.PRIORITY_INTERACTIVE, client = None):
 		key = json.dumps([method, params])
 		result = self.cache.get(key)
 
-		if not result:
-			result = self.wallet.rpc_call(method, params)
+		if result:
+			rpc_cache_requests.inc(method=method, result='hit')
+		else:
+			rpc_cache_requests.inc(method=method, result='miss')
+			result = yield from self.wallet.rpc_call_async(method, params, priority, client)
 
 			if ttl == -1:
 				ttl = self.cache_ttl
@@ -225,7 +335,7 @@ class VelesWebsiteApiServer(object):
 		command = request.match_info['command']	#request.rel_url.path.strip('/')
 
 		if command not in self.disabled_wallet_commands:
-			result = yield from self.cached_rpc_call(command)
+			result = yield from self.cached_rpc_call(command, client=self.get_client_ip(request.headers, request.remote))
 		else:
 			result = {'status': 'error', 'message': 'Unknown method %s' % command}
 
@@ -234,6 +344,29 @@ class VelesWebsiteApiServer(object):
 			headers=self.headers
 			)
 
+	def get_http_cache_key(self, request):
+		# memcache key of the response, None for the uncached handlers
+		handler = request.match_info.handler
+
+		try:
+			if handler == self.handle_http_mining_stats:
+				return 'miningstats'
+
+			if handler in [self.handle_http_mining_stats_algo, self.handle_http_mining_stats_total]:
+				return 'miningstats_%s_%i' % (request.match_info.get('algo', None) or '', int(request.match_info.get('hours', 24)))
+
+			if handler == self.handle_http_wallet_command:
+				return json.dumps([request.match_info['command'], []])	# as by cached_rpc_call
+		except ValueError:
+			pass
+
+		return None
+
+	def is_cached_http_request(self, request):
+		# served from memory, let through by the admission control
+		key = self.get_http_cache_key(request)
+		return key != None and bool(self.cache.get(key))
+
 	@asyncio.coroutine
 	def handle_http_mining_stats(self, request):
 		result = self.cache.get('miningstats')
@@ -279,13 +412,86 @@ class VelesWebsiteApiServer(object):
 			headers=self.headers
 			)
 
+	@asyncio.coroutine
+	def handle_chain_block(self, request):
+		result = self.statsdb.query_block(request.match_info['block'])
+		return self.chain_response(result, 'Block not found')
+
+	@asyncio.coroutine
+	def handle_chain_block_reward(self, request):
+		result = self.statsdb.query_block_reward(request.match_info['block'])
+		return self.chain_response(result, 'Block reward not found')
+
+	@asyncio.coroutine
+	def handle_chain_tx(self, request):
+		result = self.statsdb.query_transaction(request.match_info['txid'])
+		return self.chain_response(result, 'Transaction not found')
+
+	@asyncio.coroutine
+	def handle_chain_latest_blocks(self, request):
+		try:
+			result = self.statsdb.query_latest_blocks(int(request.match_info.get('count', 10)))
+		except ValueError:
+			result = None
+
+		return self.chain_response(result, 'Invalid block count')
+
+	@asyncio.coroutine
+	def handle_chain_address(self, request):
+		result = self.statsdb.query_address_balance(request.match_info['address'])
+		return self.chain_response(result, 'Address not found')
+
+	@asyncio.coroutine
+	def handle_chain_address_history(self, request):
+		try:
+			result = self.statsdb.query_address_history(
+				request.match_info['address'],
+				int(request.query.get('limit', 50)),
+				request.query.get('before', None)
+				)
+		except ValueError:
+			result = None
+
+		return self.chain_response(result, 'Invalid pagination')
+
+	@asyncio.coroutine
+	def handle_chain_address_utxos(self, request):
+		try:
+			result = self.statsdb.query_address_outputs(request.match_info['address'], True, int(request.query.get('limit', 100)))
+		except ValueError:
+			result = None
+
+		return self.chain_response(result, 'Invalid limit')
+
+	def chain_response(self, result, error_message):
+		if result == None:
+			return web.Response(
+				text=json.dumps({'status': 'error', 'message': error_message}, indent=4, sort_keys=True),
+				status=404,
+				headers=self.headers
+				)
+
+		return web.Response(
+			text=json.dumps(result, indent=4, sort_keys=True), 
+			headers=self.headers
+			)
+
+	@asyncio.coroutine
+	def handle_chain_mempool(self, request):
+		return self.chain_response(self.mempool.get_stats() if self.mempool.updated_at else None, 'Mempool not loaded yet')
+
+	@asyncio.coroutine
+	def handle_metrics(self, request):
+		return web.Response(body=metrics.expose().encode('utf-8'), headers={'Content-Type': metrics.content_type})
+
 	@asyncio.coroutine
 	def http_handler_task(self):
-		app = web.Application()
+		app = web.Application(middlewares = [vlsoverload.create_middleware(self.admission, self.cheap_http_paths, self.is_cached_http_request)] if self.admission else [])
 		marketHandler = vlsmarket.VelesMarketAPIServer(
 			self.config['server']['address'], 
 			self.config['server']['http_port'],
-			self.wallet
+			self.wallet,
+			self.market_data
 			)	# just instantiate, don't run
 
 		app.router.add_get('/%s' % self.url_prefix, self.handle_http)
@@ -297,18 +503,42 @@ class VelesWebsiteApiServer(object):
 		app.router.add_get('/api/stats/mining/algo/{algo}/hours/{hours}', self.handle_http_mining_stats_algo)
 		app.router.add_get('/api/stats/mining/history/{algo}/{column}/{hours}', self.handle_mining_history)
 		app.router.add_get('/api/stats/price/', marketHandler.handle_ticker_v1)
+		app.router.add_get('/api/chain/block/{block}', self.handle_chain_block)
+		app.router.add_get('/api/chain/block/{block}/reward', self.handle_chain_block_reward)
+		app.router.add_get('/api/chain/tx/{txid}', self.handle_chain_tx)
+		app.router.add_get('/api/chain/blocks/latest', self.handle_chain_latest_blocks)
+		app.router.add_get('/api/chain/blocks/latest/{count}', self.handle_chain_latest_blocks)
+		app.router.add_get('/api/chain/address/{address}', self.handle_chain_address)
+		app.router.add_get('/api/chain/address/{address}/history', self.handle_chain_address_history)
+		app.router.add_get('/api/chain/address/{address}/utxos', self.handle_chain_address_utxos)
+		app.router.add_get('/api/chain/mempool', self.handle_chain_mempool)
+		app.router.add_get('/metrics', self.handle_metrics)
 
 		handler = app.make_handler()
 		task = asyncio.get_event_loop().create_server(
 			handler, 
 			self.config['server']['address'],
-			self.config['server']['http_port']	
+			self.config['server']['http_port'],
+			reuse_port = self.reuse_port
 			)
 		return task
 
+	def get_client_ip(self, headers, remote_ip):
+		# the leftmost entries are whatever the client sent, only the ones
+		# appended by our own proxies can be trusted
+		if not self.ip_header or self.ip_header not in headers:
+			return remote_ip
+
+		addresses = [address.strip() for address in headers[self.ip_header].split(',') if address.strip()]
+
+		if not addresses:
+			return remote_ip
+
+		return addresses[-min(self.ip_header_hops, len(addresses))]
+
 	@asyncio.coroutine
 	def handle_socket_task(self, websocket, path):
-		self.log("Listening to websocket from %s:%s" % (websocket.remote_address))
+		vlslog.logger.debug("Listening to websocket from %s:%s", *websocket.remote_address[:2])
 		client = ClientConnection(websocket, url_path = path)
 
 		# try to save some more info about client if available
@@ -321,15 +551,32 @@ class VelesWebsiteApiServer(object):
 		if 'Origin' in websocket.request_headers:
 			client.origin = websocket.request_headers['Origin']
 
-		# rebroadcast recent events
-		for event_name, event in self.recent_events.items():
-			yield from self.send_message(websocket, event)
+		client.ip = self.get_client_ip(websocket.request_headers, websocket.remote_address[0])
+
+		if self.ratelimit:
+			client.bucket = self.ratelimit.create_bucket()
 
+		# rebroadcast recent events, or just the missed ones when resuming
+		# with ?resume=<event-seq>&epoch=<event-epoch>; registered first and
+		# the live events held meanwhile, so none is lost or sent twice
+		query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
 		self.clients += [client]
+
+		if 'resume' in query and query['resume'][0].isdigit():
+			yield from self.resume_events(client, int(query['resume'][0]), query.get('epoch', [None])[0])
+		else:
+			client.hold_events()
+			position = (self.event_log.epoch, self.event_log.last_seq)
+
+			for event_name, event in self.recent_events.items():
+				yield from self.send_message(websocket, event)
+
+			client.release_events(*position)
+
 		while client.is_open():
 			try:
 				payload = yield from websocket.recv()
-				self.log("\n<< %s" % payload)
+				vlslog.messages.log('in', payload, client=websocket.remote_address[0])
 			except websockets.exceptions.ConnectionClosed:
 				break
 			except Exception as e:
@@ -337,11 +584,18 @@ class VelesWebsiteApiServer(object):
 				break
 
 			try:
+				started = time.perf_counter()
+				client.last_command = (None, None)
 				yield from self.handle_command(client, payload)
+				ws_commands.observe(time.perf_counter() - started, service=client.last_command[0], command=client.last_command[1])
 			except Exception as e:
 				self.log("Error while handling command %s: %s" % (payload, str(e)))
 				self.log_last_error()
 				continue
+			finally:
+				if client.admitted:
+					client.admitted = False
+					self.admission.leave()
 
 		# Try to still close it more gracefully
 		try:
@@ -350,7 +604,7 @@ class VelesWebsiteApiServer(object):
 			pass
 
 		self.clients.remove(client)
-		self.log("Closing websocket from %s:%s" % (websocket.remote_address))
+		vlslog.logger.debug("Closing websocket from %s:%s", *websocket.remote_address[:2])
 
 	@asyncio.coroutine
 	def handle_command(self, client, payload):
@@ -376,6 +630,25 @@ class VelesWebsiteApiServer(object):
 			cmd_args = cmd['name'].split(' ')	# TODO: careful about "" '' !!
 			cmd_name = cmd_args[0]
 			cmd_args.pop(0)
+			client.last_command = (cmd.get('service'), cmd_name)	# for the metrics
+
+			if self.ratelimit:
+				limited = self.ratelimit.check(client.bucket, client.ip, cmd.get('service'), cmd_name)
+
+				if limited:
+					limited.update({'name': cmd_name, 'service': cmd.get('service')})
+					yield from self.send_error(client.ws, "rateLimited", limited, request_id)
+					return
+
+			# uncached RPC and database queries are refused on overload
+			if self.admission and 'service' in cmd and cmd['service'] not in self.cheap_services:
+				retry_after = self.admission.try_enter('ws')
+
+				if retry_after:
+					yield from self.send_error(client.ws, "overloaded", {'name': cmd_name, 'service': cmd['service'], 'retry-after': retry_after}, request_id)
+					return
+
+				client.admitted = True
 
 			# wallet does not accept strings if number is expected, retype them
 			for arg_key, arg in enumerate(cmd_args):
@@ -393,7 +666,7 @@ class VelesWebsiteApiServer(object):
 
 			# built-in commands
 			if cmd_name == "listCommands":
-				commands = ['test', 'listClients', 'listCommands']
+				commands = ['test', 'listClients', 'listCommands', 'resume']
 				commands.sort()
 				yield from self.send_response(client.ws, self.url_prefix, cmd_name, commands, request_id, extra_attributes)
 				
@@ -426,9 +699,18 @@ class VelesWebsiteApiServer(object):
 
 				yield from self.send_response(client.ws, self.url_prefix, cmd_name, result, request_id, extra_attributes)
 
+			elif cmd_name == 'resume':	# resume <event-seq> <event-epoch>
+				if not len(cmd_args) or not isinstance(cmd_args[0], int):
+					yield from self.send_error(client.ws, "invalidArguments", {'name': cmd_name, 'usage': 'resume <event-seq> <event-epoch>'}, request_id)
+					return
+
+				epoch = cmd['name'].split(' ')[2] if len(cmd_args) > 1 else None	# as sent, not retyped
+				result = yield from self.resume_events(client, cmd_args[0], epoch)
+				yield from self.send_response(client.ws, self.url_prefix, cmd_name, result, request_id, extra_attributes)
+
 			# wallet service commands
 			elif "service" in cmd and cmd['service'] == 'node' and cmd_name not in self.disabled_wallet_commands:
-				result = yield from self.cached_rpc_call(cmd_name, cmd_args, ttl=0)
+				result = yield from self.cached_rpc_call(cmd_name, cmd_args, ttl=0, client=client.ip)
 
 				# apply filters, if any
 				if "filter" in cmd and cmd['filter']:
@@ -464,6 +746,48 @@ class VelesWebsiteApiServer(object):
 
 					result = self.statsdb.query_block_stats(cmd_args[0]);
 
+				elif cmd_name == 'reward':
+					if not len(cmd_args):
+						yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'stats'}, request_id)
+						return
+
+					result = self.statsdb.query_block_reward(cmd_args[0])
+
+				elif cmd_name == 'tx':
+					if not len(cmd_args):
+						yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'stats'}, request_id)
+						return
+
+					result = self.statsdb.query_transaction(str(cmd_args[0]))
+
+				elif cmd_name == 'blocks':
+					if not len(cmd_args):
+						cmd_args = [10]
+
+					if not isinstance(cmd_args[0], int):
+						yield from self.send_error(client.ws, "invalidArguments", {'name': cmd_name, 'service': 'stats', 'usage': 'blocks [count]'}, request_id)
+						return
+
+					result = self.statsdb.query_latest_blocks(cmd_args[0])
+
+				elif cmd_name in ['balance', 'history', 'utxos']:
+					if not len(cmd_args):
+						yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'stats'}, request_id)
+						return
+
+					if not all([isinstance(arg, int) for arg in cmd_args[1:]]):	# limit, before
+						yield from self.send_error(client.ws, "invalidArguments", {'name': cmd_name, 'service': 'stats', 'usage': '%s <address> [limit] [before]' % cmd_name}, request_id)
+						return
+
+					if cmd_name == 'balance':
+						result = self.statsdb.query_address_balance(str(cmd_args[0]))
+
+					elif cmd_name == 'history':	# history <address> [limit] [before]
+						result = self.statsdb.query_address_history(str(cmd_args[0]), *cmd_args[1:3])
+
+					else:
+						result = self.statsdb.query_address_outputs(str(cmd_args[0]), True, *cmd_args[1:2])
+
 				else:
 					yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'stats'}, request_id)
 
@@ -491,10 +815,8 @@ class VelesWebsiteApiServer(object):
 				result = None
 
 				if cmd_name == 'info' or cmd_name == 'v1':
-					try:
-						result = self.market.fetch_info_v1()[0]
-					except:
-						result = None	# todo: more exc handling
+					if self.market_data.is_ready():
+						result = self.market_data.info_v1[0]
 
 				else:
 					yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'price'}, request_id)
@@ -506,18 +828,60 @@ class VelesWebsiteApiServer(object):
 
 				yield from self.send_response(client.ws, cmd['service'], cmd_name, result, request_id, extra_attributes)
 
+			elif "service" in cmd and cmd['service'] == 'masternodes':
+				result = None
+
+				if cmd_name == 'state':
+					result = self.masternodes.state
+
+				elif cmd_name == 'get' and len(cmd_args):	# get <collateral outpoint>
+					result = self.masternodes.get(str(cmd_args[0]))
+
+				elif cmd_name == 'status' and len(cmd_args):	# status <ENABLED|EXPIRED|...>
+					result = self.masternodes.find_by_status(str(cmd_args[0]))
+
+				elif cmd_name == 'address' and len(cmd_args):	# address <ip|ip:port|payee>
+					result = self.masternodes.find_by_address(str(cmd_args[0]))
+
+				else:
+					yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'masternodes'}, request_id)
+					return
+
+				# apply filters, if any
+				if "filter" in cmd and cmd['filter']:
+					result = FilterableDataset(result).apply_filters(cmd['filter'])
+					extra_attributes['filter'] = cmd['filter']
+
+				yield from self.send_response(client.ws, cmd['service'], cmd_name, result, request_id, extra_attributes)
+
+			elif "service" in cmd and cmd['service'] == 'mempool':
+				result = None
+
+				if cmd_name == 'stats':
+					result = self.mempool.get_stats()
+
+				elif cmd_name == 'list':	# full snapshot to apply the mempool delta events on
+					result = {'sequence': self.mempool.sequence, 'entries': self.mempool.get_entries()}
+
+				else:
+					yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name, 'service': 'mempool'}, request_id)
+
+				# apply filters, if any
+				if "filter" in cmd and cmd['filter']:
+					result = FilterableDataset(result).apply_filters(cmd['filter'])
+					extra_attributes['filter'] = cmd['filter']
+
+				yield from self.send_response(client.ws, cmd['service'], cmd_name, result, request_id, extra_attributes)
+
 			elif "service" in cmd and cmd['service'] == 'location':
 				result = None
 
 				if cmd_name == 'gps':
-					#try:
-					result = []
-
-					for ip, location in self.locations.items():
-						if 'lat' in location and 'lon' in location:
-							result += [{'lat': location['lat'], 'lon': location['lon']}]
-					#except:
-					#	result = None	# todo: more exc handling
+					# optional zoom level selects the precomputed clusters
+					if len(cmd_args) and isinstance(cmd_args[0], (int, float)):
+						result = self.geo_clusters.get(cmd_args[0])
+					else:
+						result = self.geo_clusters.get()
 
 				elif cmd_name == 'list':
 					result = self.locations
@@ -537,9 +901,49 @@ class VelesWebsiteApiServer(object):
 				yield from self.send_error(client.ws, "commandNotFound", {'name': cmd_name}, request_id)
 
 
+	@asyncio.coroutine
+	def resume_events(self, client, seq, epoch):
+		# replays the events published after seq, or sends the recent events
+		# bundled in a single snapshot frame when they're no longer all logged;
+		# the live ones follow after, those already replayed are skipped
+		client.hold_events()
+		position = (self.event_log.epoch, self.event_log.last_seq)
+		missed = self.event_log.since(seq, epoch)
+
+		try:
+			if missed == None:
+				ws_resumes.inc(result='snapshot')
+				yield from self.send_message(client.ws, self.get_snapshot())
+			else:
+				ws_resumes.inc(result='replay' if missed else 'current')
+
+				for message in missed:
+					yield from self.send_message(client.ws, message)
+		finally:
+			client.release_events(*position)
+
+		return {
+			'event-seq': self.event_log.last_seq,
+			'event-epoch': self.event_log.epoch,
+			'replayed': len(missed) if missed != None else None,
+			'snapshot': missed == None
+			}
+
+	def get_snapshot(self):
+		# built once per published event, the resume storm after a deploy
+		# gets the same frame
+		if not self.snapshot or self.snapshot[:2] != (self.event_log.epoch, self.event_log.last_seq):
+			self.snapshot = (self.event_log.epoch, self.event_log.last_seq, self.create_message('event', 'snapshot', {
+				'event-seq': self.event_log.last_seq,
+				'event-epoch': self.event_log.epoch,
+				'events': [json.loads(message) for message in self.recent_events.values()]
+				}))
+
+		return self.snapshot[2]
+
 	@asyncio.coroutine
 	def send_message(self, ws, message):
-		self.log("\n>> [raw msg] %s" % message)
+		vlslog.messages.log('out', message, type='raw')
 		try:
 			asyncio.async(ws.send(message))
 		except:
@@ -553,7 +957,7 @@ class VelesWebsiteApiServer(object):
 			attributes.update({'request-id': request_id})
 
 		message = self.create_message('error', name, attributes)
-		self.log("\n>> [error] %s" % message)
+		vlslog.messages.log('out', message, type='error')
 		try:
 			asyncio.async(ws.send(message))
 		except:
@@ -571,7 +975,7 @@ class VelesWebsiteApiServer(object):
 			attributes.update({'request-id': request_id})
 
 		message = self.create_message('response', name, attributes)
-		print("\n>>", message)
+		vlslog.messages.log('out', message, type='response', service=service, name=name)
 		try:
 			asyncio.async(ws.send(message))
 		except:
@@ -580,7 +984,7 @@ class VelesWebsiteApiServer(object):
 	@asyncio.coroutine
 	def send_command(self, ws, name, data = None):
 		message = self.create_message('command', name, {'data': data})
-		print("\n>>", message)
+		vlslog.messages.log('out', message, type='command', name=name)
 		try:
 			asyncio.async(ws.send(message))
 		except:
@@ -616,22 +1020,28 @@ class VelesWebsiteApiServer(object):
 		return message
 
 	@asyncio.coroutine
-	def broadcast(self, msg = None):
+	def broadcast(self, msg = None, seq = None, epoch = None):
 		# broadcast the message everywhere ...
-		asyncio.async(self.client_broadcast(msg))
+		asyncio.async(self.client_broadcast(msg, seq, epoch))
 
 	@asyncio.coroutine
-	def client_broadcast(self, msg = None):
+	def client_broadcast(self, msg = None, seq = None, epoch = None):
 		if msg:
-			self.log("\n[clients]>> %s" % msg)
+			vlslog.messages.log('broadcast', msg, clients=len(self.clients))
 
 		if len(self.clients):
-			for client in self.clients:
-				asyncio.async(client.send(msg))
+			with ws_broadcast_seconds.time():
+				for client in self.clients:
+					client.send_event(msg, seq, epoch)
+
+			ws_broadcast_messages.inc(len(self.clients))
 
 	@asyncio.coroutine
 	def publish_event(self, name, data, is_persistent = True):
-		event_msg = self.create_message('event', name, data)
+		seq = self.event_log.next_seq()
+		event_msg = self.create_message('event', name, dict(data, **{'event-seq': seq, 'event-epoch': self.event_log.epoch}))
+		self.event_log.append(seq, event_msg)
+		events_published.inc(name=name)
 
 		if is_persistent:
 			if 'entity-id' in data:
@@ -640,16 +1050,103 @@ class VelesWebsiteApiServer(object):
 				key = name
 
 			self.recent_events[key] = event_msg
+		else:
+			key = None
 
-		yield from self.broadcast(event_msg)
+		# the other workers and instances broadcast the same message
+		self.send_to_followers({'type': 'event', 'key': key, 'seq': seq, 'epoch': self.event_log.epoch, 'message': event_msg})
 
-		for subscriber in self.event_subscribers:
-			try:
-				subscriber.handle_event(name, data)
-			except:
-				self.log("WARNING: Error while handling event " + name)
-				self.log_last_error()
-				pass
+		yield from self.broadcast(event_msg, seq, self.event_log.epoch)
+		return (yield from self.events.publish(name, data))	# futures of the subscribers handling it
+
+	def share_state(self, name, data):
+		# hands the polled state over to the follower workers and instances,
+		# the latest one of each name is kept for the ones (re)started later
+		self.send_to_followers({'type': 'state', 'key': name, 'data': data})
+
+	def share_mempool(self):
+		self.mempool_shared_at = time.time()
+		self.share_state('mempool', {'sequence': self.mempool.sequence, 'entries': self.mempool.entries, 'origin': self.event_log.epoch})
+
+	def send_to_followers(self, message):
+		if self.events_channel:
+			self.events_channel.send(message)
+
+		if self.lease_channel:
+			self.lease_channel.send(message)
+
+	def request_state(self, name):
+		# follower missing some deltas: asks the publisher worker, or the leader
+		# instance from there, to share the snapshot again
+		if time.time() - self.state_requested_at.get(name, 0) < self.state_request_delay:
+			return
+
+		self.state_requested_at[name] = time.time()
+		message = {'type': 'request', 'key': None, 'data': name}
+
+		if self.is_publisher:
+			self.handle_request(message)
+		else:
+			self.events_channel.send(message)
+
+	def handle_request(self, message):
+		if self.lease and not self.lease.is_leader:
+			self.lease_channel.send(message)
+
+		elif message['data'] == 'mempool' and self.mempool.updated_at and time.time() - self.mempool_shared_at > 1:
+			self.share_mempool()
+
+	def handle_leader_message(self, message):
+		# follower instance: same as from the event hub, and passed on to the
+		# local follower workers
+		if message['type'] == 'request':	# of a follower instance
+			if self.lease.is_leader:
+				self.handle_request(message)
+
+			return
+
+		if self.lease.is_leader:	# stale message of the previous leader
+			return
+
+		self.handle_worker_message(message)
+
+		if self.events_channel:
+			self.events_channel.send(message)
+
+	def handle_worker_message(self, message):
+		# follower side of the event hub: the publisher's events go to the
+		# local clients as they are, the states replace the local copies
+		if message['type'] == 'event':
+			self.event_log.append(message['seq'], message['message'], message['epoch'])
+
+			if message['key']:
+				self.recent_events[message['key']] = message['message']
+
+			asyncio.ensure_future(self.broadcast(message['message'], message['seq'], message['epoch']))
+
+		elif message['type'] == 'state' and message['key'] == 'market':
+			for name, value in message['data']['supply'].items():
+				setattr(self.supply, name, value)
+
+			self.market_data.update(message['data']['market'])
+
+		elif message['type'] == 'state' and message['key'] == 'masternodes':
+			self.masternodes.update(message['data'])
+			self.supply.set_masternode_count(len(message['data']))
+
+		elif message['type'] == 'state' and message['key'] == 'mempool':
+			self.mempool.load_snapshot(message['data']['entries'], message['data']['sequence'], message['data']['origin'])
+
+		elif message['type'] == 'mempool':
+			if not self.mempool.apply_delta(message['data'], message['origin']):
+				self.request_state('mempool')
+
+		elif message['type'] == 'request' and self.is_publisher:
+			self.handle_request(message)
+
+		elif message['type'] == 'state' and message['key'] == 'locations':
+			self.locations = message['data']
+			self.geo_clusters.update(self.locations)
 
 	@asyncio.coroutine
 	def pull_new_block_task(self):
@@ -660,18 +1157,20 @@ class VelesWebsiteApiServer(object):
 		last_halving_state = None
 		
 		while True:
-			chain_info = yield from self.cached_rpc_call('getblockchaininfo', ttl=self.pull_block_delay/2)
+			started = time.perf_counter()
+			chain_info = yield from self.cached_rpc_call('getblockchaininfo', ttl=self.pull_block_delay/2, priority=vlswallet.PRIORITY_TIP)
 
 			if not chain_info or not 'blocks' in chain_info:
+				pull_task_errors.inc(task='block')
 				yield from asyncio.sleep(self.pull_block_delay)	# wait before retry on error
 				continue
 
 			if not last_chain_info or last_chain_info['bestblockhash'] != chain_info['bestblockhash']:
 				self.cache.purge()	# on every block purge RPC cache
-				tip_state = yield from self.cached_rpc_call('getblock', [chain_info['bestblockhash']], ttl=self.pull_block_delay/2)
+				tip_state = yield from self.cached_rpc_call('getblock', [chain_info['bestblockhash']], ttl=self.pull_block_delay/2, priority=vlswallet.PRIORITY_TIP)
 
 				# simple event that block been found
-				yield from self.publish_event('state_changed', {
+				handled = yield from self.publish_event('state_changed', {
 					'entity-id': 'chain.tip',
 					'old-state': last_tip_state,
 					'new-state': tip_state
@@ -679,7 +1178,7 @@ class VelesWebsiteApiServer(object):
 				
 				# other chained events
 				try:
-					pow_info = yield from self.cached_rpc_call('getmultialgostatus', ttl=self.pull_block_delay/2)
+					pow_info = yield from self.cached_rpc_call('getmultialgostatus', ttl=self.pull_block_delay/2, priority=vlswallet.PRIORITY_TIP)
 					pow_info_filter = FilterableDataset(pow_info)
 					pow_state = {
 						'totalhashrate': pow_info_filter.apply_filters('sum=hashrate'),
@@ -688,7 +1187,7 @@ class VelesWebsiteApiServer(object):
 						#'diffs': pow_info_filter.apply_filters('index=algo|key=difficulty'),
 						#'height': chain_info['blocks']
 						}
-					yield from self.publish_event('state_changed', {
+					handled += yield from self.publish_event('state_changed', {
 						'entity-id': 'chain.pow',
 						'old-state': last_pow_state,
 						'new-state': pow_state
@@ -699,6 +1198,10 @@ class VelesWebsiteApiServer(object):
 					pass
 
 				try:
+					# once the stats database has stored the new block and hashrates
+					if handled:
+						yield from asyncio.wait(handled, timeout=self.pull_block_delay)
+
 					mining_state = self.statsdb.query_mining_stats(algo=None, total=True)
 					self.cache.set('miningstats_total', mining_state, 60)
 					yield from self.publish_event('state_changed', {
@@ -712,7 +1215,7 @@ class VelesWebsiteApiServer(object):
 					pass
 
 				try:
-					halving_info = yield from self.cached_rpc_call('gethalvingstatus', ttl=self.pull_block_delay/2)
+					halving_info = yield from self.cached_rpc_call('gethalvingstatus', ttl=self.pull_block_delay/2, priority=vlswallet.PRIORITY_TIP)
 					halving_state = halving_info['epochs'][-1]
 
 					yield from self.publish_event('state_changed', {
@@ -730,7 +1233,8 @@ class VelesWebsiteApiServer(object):
 				last_pow_state = copy.copy(pow_state)
 				last_mining_state = copy.copy(mining_state)
 				last_halving_state = copy.copy(halving_state)
-			
+
+			pull_task_seconds.observe(time.perf_counter() - started, task='block')
 			yield from asyncio.sleep(self.pull_block_delay)
 
 	@asyncio.coroutine
@@ -738,59 +1242,105 @@ class VelesWebsiteApiServer(object):
 		last_state = None
 
 		while True:
-			raw_mnlist = yield from self.cached_rpc_call('masternodelist', ttl=self.pull_mnlist_delay/2)
+			started = time.perf_counter()
+			raw_mnlist = yield from self.cached_rpc_call('masternodelist', ['json'], ttl=self.pull_mnlist_delay/2, priority=vlswallet.PRIORITY_INGEST)
+
+			if not isinstance(raw_mnlist, dict) or 'error' in raw_mnlist:	# older nodes without the json mode
+				raw_mnlist = yield from self.cached_rpc_call('masternodelist', ttl=self.pull_mnlist_delay/2, priority=vlswallet.PRIORITY_INGEST)
 
-			if not raw_mnlist or not len(raw_mnlist):
+			if not raw_mnlist or not len(raw_mnlist) or not isinstance(raw_mnlist, dict) or 'error' in raw_mnlist:
+				pull_task_errors.inc(task='masternodelist')
 				yield from asyncio.sleep(self.pull_block_delay)	# wait before retry on error
 				continue
 
-			mnlist = FilterableDataset(raw_mnlist)
-			state = {
-				'count': mnlist.apply_filter('count'),
-				'enabled-count': mnlist.apply_filters('value=ENABLED|count'),
-				'pre-enabled-count': mnlist.apply_filters('value=PRE_ENABLED|count'),
-				'new-start-required-count': mnlist.apply_filters('value=NEW_START_REQUIRED|count'),
-				'expired-count': mnlist.apply_filters('value=EXPIRED|count')
-				}
+			changes = self.masternodes.update(vlsmasternodes.VelesMasternodeStore.parse_masternodelist(raw_mnlist))
+			state = self.masternodes.state
 
-			if last_state != state:
-				# simple event that block been found
-				yield from self.publish_event('state_changed', {
-					'entity-id': 'masternodes',
-					'old-state': last_state,
-					'new-state': state
-					})
-				last_state = copy.copy(state)
+			if changes or last_state != state:
+				self.share_state('masternodes', self.masternodes.nodes)
+
+			self.supply.set_masternode_count(state['count'])
+
+			for change in changes:
+				yield from self.publish_event('masternode_changed', {
+					'entity-id': 'masternode:%s' % change['outpoint'],
+					'change': change['change'],
+					'old-state': change['old-state'],
+					'new-state': change['new-state']
+					}, is_persistent = False)
 
-				# resolve approximate gps locations
-				#yield from self.update_location_data()
-			
+			if last_state != state or changes:
+				if last_state != state:
+					yield from self.publish_event('state_changed', {
+						'entity-id': 'masternodes',
+						'old-state': last_state,
+						'new-state': state
+						})
+					last_state = copy.copy(state)
+
+				# resolve approximate gps locations in the background
+				if not self.location_task or self.location_task.done():
+					self.location_task = asyncio.ensure_future(self.update_location_data())
+
+			pull_task_seconds.observe(time.perf_counter() - started, task='masternodelist')
 			yield from asyncio.sleep(self.pull_mnlist_delay)
 
 	@asyncio.coroutine
 	def update_location_data(self):
-		result = yield from self.cached_rpc_call("masternodelist", ['addr'], ttl=600)
-		location_service_url = 'http://ip-api.com/json/'
-		limit = 300
+		ips = self.masternodes.get_ips()
 
-		if not result:
-			return
+		if not ips:	# masternode list without addresses, ask for them
+			result = yield from self.cached_rpc_call("masternodelist", ['addr'], ttl=600, priority=vlswallet.PRIORITY_BACKGROUND)
 
-		for key, mn_addr in result.items():
-			limit -= 1
-			if not limit:
-				break
+			if not result or not isinstance(result, dict) or 'error' in result:
+				return
 
-			ip, port = mn_addr.split(':')
+			for key, mn_addr in result.items():
+				ips += [self.masternodes.get_ip(mn_addr)]
 
-			if ip not in self.locations:
-				url = '{}/{}'.format(location_service_url, ip)
-				response = requests.get(url)
+		locations = yield from self.geo.resolve_many(ips)
 
-				if not response:
-					continue
+		if locations != self.locations:
+			self.locations = locations
+			self.geo_clusters.update(locations)
+			self.share_state('locations', locations)
+
+	@asyncio.coroutine
+	def pull_mempool_task(self):
+		last_stats = None
+		is_shared = False	# snapshot of this leader term
+
+		while True:
+			started = time.perf_counter()
+
+			try:
+				delta = yield from self.mempool.refresh_async()
+			except Exception as e:
+				delta = None
+				pull_task_errors.inc(task='mempool')
+				vlslog.logger.error('Error refreshing mempool: %s', e)
+
+			# the followers apply the deltas, a full copy only now and then
+			if self.mempool.updated_at and (not is_shared or (delta and time.time() - self.mempool_shared_at > self.mempool_snapshot_interval)):
+				self.share_mempool()
+				is_shared = True
+			elif delta:
+				self.send_to_followers({'type': 'mempool', 'key': None, 'origin': self.event_log.epoch, 'data': delta})
+
+			if delta:
+				# deltas are not kept for new clients, they ask for the snapshot
+				yield from self.publish_event('mempool', delta, is_persistent = False)
+
+				if last_stats != delta['stats']:
+					yield from self.publish_event('state_changed', {
+						'entity-id': 'mempool.stats',
+						'old-state': last_stats,
+						'new-state': delta['stats']
+						})
+					last_stats = delta['stats']
 
-				self.locations[ip] = response.json()
+			pull_task_seconds.observe(time.perf_counter() - started, task='mempool')
+			yield from self.mempool.wait_for_refresh()
 
 	@asyncio.coroutine
 	def pull_current_price_task(self):
@@ -798,17 +1348,24 @@ class VelesWebsiteApiServer(object):
 		last_market_price = None
 
 		while True:
+			started = time.perf_counter()
+
 			try:
 				today = datetime.date(datetime.now())	# in case we gate result later than we asked
-				market_data = self.market.fetch_exchange_info()
+				market_data = yield from self.market_data.refresh()	# the only upstream fetch per interval
 
 				if not market_data or not len(market_data) or not 'market_data' in market_data:
+					pull_task_errors.inc(task='price')
 					yield from asyncio.sleep(self.pull_price_delay)	# wait before retry on error
 					continue
 
+				self.share_state('market', {
+					'market': market_data,
+					'supply': {name: getattr(self.supply, name) for name in ['total_supply', 'mn_count', 'mn_collateral', 'height', 'block_hash']}
+					})
+
 				if last_market_price != market_data['market_data']['current_price']['btc']:
-					# fetch estra info if price has changed
-					price_info = self.market.fetch_info_v1()	# todo: cache
+					price_info = self.market_data.info_v1
 
 					if not price_info or not len(price_info) or not 'price_btc' in price_info[0]:
 						yield from asyncio.sleep(self.pull_price_delay)	# wait before retry on error
@@ -832,57 +1389,90 @@ class VelesWebsiteApiServer(object):
 					last_price_state = copy.copy(price_state)
 					last_market_price = market_data['market_data']['current_price']['btc']
 			except:
-				pass
-			
+				pull_task_errors.inc(task='price')
+
+			pull_task_seconds.observe(time.perf_counter() - started, task='price')
 			yield from asyncio.sleep(self.pull_price_delay)
 
+	@asyncio.coroutine
+	def monitor_loop_lag_task(self):
+		while True:
+			started = time.perf_counter()
+			yield from asyncio.sleep(self.loop_lag_interval)
+			lag = max(0, time.perf_counter() - started - self.loop_lag_interval)
+			loop_lag_seconds.observe(lag)
+
+			if self.admission:
+				self.admission.observe_lag(lag)
+
+	def get_pull_tasks(self):
+		return [
+			self.pull_new_block_task(),
+			self.pull_masternodelist_task(),
+			self.pull_current_price_task(),
+			self.supply.reconcile_task(),
+			self.pull_mempool_task(),
+			self.mempool.zmq_task(),
+			]
+
+	def start_pull_tasks(self):
+		self.event_log.new_epoch()	# numbering of the new leader, resuming clients get a snapshot
+		self.pull_tasks = [asyncio.ensure_future(task) for task in self.get_pull_tasks()]
+
+	def stop_pull_tasks(self):
+		for task in self.pull_tasks:
+			task.cancel()
+
+		self.pull_tasks = []
+
 	def run(self):
 		loop = asyncio.get_event_loop()
+		vlslog.install_signal_handlers(loop)
 		print("Running VelesWebsiteApiServer at %s:%s" % (self.config['server']['address']	, str(self.config['server']['http_port']	)))
 
+		tasks = [
+			websockets.serve(self.handle_socket_task, self.config['server']['address'], self.config['server']['ws_port'], reuse_port=self.reuse_port),
+			self.http_handler_task(),
+			self.monitor_loop_lag_task()
+			]
+
 		if 'ssl' in self.config and 'ssl_cert_chain' in self.config['ssl'] and 'ssl_cert_key' in self.config['ssl']:
 			ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
 			ssl_context.load_cert_chain(self.config['ssl']['ssl_cert_chain'], self.config['ssl']['ssl_cert_key'])
 			print("Running VelesWebsiteApiServer SSL port at %s:%s" % (self.config['server']['address']	, str(self.config['ssl']['ssl_ws_port'])))
-
-			try:			
-				loop.run_until_complete(asyncio.gather(
-					websockets.serve(self.handle_socket_task, self.config['server']['address'], self.config['server']['ws_port']),
-					websockets.serve(self.handle_socket_task, self.config['server']['address'], self.config['ssl']['ssl_ws_port'], ssl=ssl_context),
-					self.http_handler_task(),
-					self.pull_new_block_task(),
-					self.pull_masternodelist_task(),
-					self.pull_current_price_task(),
-					))
-				loop.run_forever()
-			except KeyboardInterrupt:
-				print("\n* Shutting down on keyboard interrupt *")
-			#except:
-			#	print("\n* Shutting down on error")
+			tasks += [websockets.serve(self.handle_socket_task, self.config['server']['address'], self.config['ssl']['ssl_ws_port'], ssl=ssl_context, reuse_port=self.reuse_port)]
 		else:
 			print("Notice: SSL disabled")
 
-			try:			
-				loop.run_until_complete(asyncio.gather(
-					websockets.serve(self.handle_socket_task, self.config['server']['address'], self.config['server']['ws_port']),
-					self.http_handler_task(),
-					self.pull_new_block_task(),
-					self.pull_masternodelist_task(),
-					self.pull_current_price_task(),
-					))
-				loop.run_forever()
-			except KeyboardInterrupt:
-				print("\n* Shutting down on keyboard interrupt *")
-			#except:
-			#	print("\n* Shutting down on error")
+		if self.is_publisher and self.lease:	# pull tasks only while holding the lease
+			tasks += [self.lease.run_task(self.start_pull_tasks, self.stop_pull_tasks), self.lease_channel.run_task()]
+		elif self.is_publisher:
+			tasks += self.get_pull_tasks()
+
+		if self.events_channel:
+			tasks += [self.events_channel.run_task()]
+
+
+		try:			
+			loop.run_until_complete(asyncio.gather(*tasks))
+			loop.run_forever()
+		except KeyboardInterrupt:
+			print("\n* Shutting down on keyboard interrupt *")
+		finally:
+			if self.lease:	# hand over to the next instance right away
+				try:
+					self.lease.release()
+				except Exception as e:
+					print('Error releasing the poller lease:', e)
+		#except:
+		#	print("\n* Shutting down on error")
 	
 	def log(self, msg):
-		print(msg)
+		vlslog.logger.info(msg)
 
 	def log_last_error(self):
-		# print error to the console and to the logfile
-		print("\n!!! LIVE trace: ERROR: %s\n" % sys.exc_info()[1])
-		self.log("DEBUG: Python error: " + traceback.format_exc())
+		# log the error with the traceback
+		vlslog.logger.error("Python error: %s", sys.exc_info()[1], exc_info=True)
 
 		# push the error through the network (or/and to the sync buffer)
 		error_msg = self.create_message('error', 'internalServerError', {'context': traceback.format_exc(), 'cache-control': 'ignore'})
@@ -900,6 +1490,22 @@ class VelesWebsiteApiServer(object):
 				})
 			asyncio.async(self.broadcast(error_msg))
 		
+# Single worker of the multi-process mode, runs in the forked child
+def run_worker(config, is_publisher, socket_path, workers):
+	vlslog.setup(**(config['logging'] if 'logging' in config else {}))	# the listener thread didn't survive the fork
+
+	server = VelesWebsiteApiServer(config)
+	server.is_publisher = is_publisher
+
+	if server.ratelimit:	# the address limits are for all the workers together
+		server.ratelimit.split_ip_limits(workers)
+
+	server.reuse_port = True
+	server.events_channel = vlsworkers.VelesEventChannel(socket_path, server.handle_worker_message)
+	server.run()
+
+	vlslog.shutdown()
+
 # Basic commandline interface
 def main():
 	# Process the arguments
@@ -908,8 +1514,14 @@ def main():
 			help='path to the configuration file')
 	parser.add_argument('--reindex', action='store_true',
 			help='reindex the block database')
+	parser.add_argument('--migrate-tx-encoding', action='store_true',
+			help='re-encode stored transaction vin/vout from JSON to the compact format')
 	parser.add_argument('--run-daily-jobs', action='store_true',
 			help='run daily jobs, such as daily statistics calculations')
+	parser.add_argument('--workers', type=int, default=1,
+			help='number of server processes sharing the ports, the first one polls the node')
+	parser.add_argument('--worker-socket', default='/tmp/veles-webapi-events.sock',
+			help='unix socket of the event hub between the worker processes')
 	args = parser.parse_args()
 
 	# Read the config gile
@@ -919,16 +1531,27 @@ def main():
 
 	config = configparser.ConfigParser()
 	config.read(args.config)
+	vlslog.setup(**(config['logging'] if 'logging' in config else {}))
+
+	if args.workers > 1:
+		supervisor = vlsworkers.VelesSupervisor(lambda is_publisher, socket_path: run_worker(config, is_publisher, socket_path, args.workers), args.workers, args.worker_socket)
+		supervisor.run()
+		vlslog.shutdown()
+		return
 
 	# Boot the server app
 	server = VelesWebsiteApiServer(config)
 
 	if args.reindex:
 		server.statsdb.reindex_rewards()
+	elif args.migrate_tx_encoding:
+		server.statsdb.migrate_tx_encoding()
 	#elif args.run_daily_jobs:
 	#	server.statsdb.do_daily_jobs()
 	else:
 		server.run()
 
+	vlslog.shutdown()	# flush the queued log records
+
 if __name__=='__main__':
 	main()
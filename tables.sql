@@ -22,6 +22,51 @@ SET time_zone = "+00:00";
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `address_balance`
+--
+
+CREATE TABLE `address_balance` (
+  `address` varchar(64) NOT NULL,
+  `balance` bigint(20) NOT NULL,
+  `received` bigint(20) NOT NULL,
+  `sent` bigint(20) NOT NULL,
+  `tx_count` int(11) NOT NULL,
+  `last_height` int(11) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `address_history`
+--
+
+CREATE TABLE `address_history` (
+  `id` bigint(20) NOT NULL,
+  `address` varchar(64) NOT NULL,
+  `txid` char(64) NOT NULL,
+  `height` int(11) NOT NULL,
+  `value` bigint(20) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `address_output`
+--
+
+CREATE TABLE `address_output` (
+  `txid` char(64) NOT NULL,
+  `n` int(11) NOT NULL,
+  `address` varchar(64) NOT NULL,
+  `value` bigint(20) NOT NULL,
+  `height` int(11) NOT NULL,
+  `spent_txid` char(64) DEFAULT NULL,
+  `spent_height` int(11) DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `block`
 --
@@ -134,6 +179,18 @@ CREATE TABLE `daily_supply` (
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `index_state`
+--
+
+CREATE TABLE `index_state` (
+  `name` varchar(32) NOT NULL,
+  `height` int(11) NOT NULL,
+  `block_hash` char(64) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `mining_status`
 --
@@ -148,6 +205,32 @@ CREATE TABLE `mining_status` (
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `poller_lease`
+--
+
+CREATE TABLE `poller_lease` (
+  `name` varchar(64) NOT NULL,
+  `holder` varchar(128) NOT NULL,
+  `expires_at` double NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `poller_message`
+--
+
+CREATE TABLE `poller_message` (
+  `id` bigint(20) NOT NULL,
+  `source` varchar(128) NOT NULL,
+  `key` varchar(255) DEFAULT NULL,
+  `created_at` double NOT NULL,
+  `payload` mediumtext NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `transaction`
 --
@@ -169,6 +252,29 @@ CREATE TABLE `transaction` (
 -- Indexes for dumped tables
 --
 
+--
+-- Indexes for table `address_balance`
+--
+ALTER TABLE `address_balance`
+  ADD PRIMARY KEY (`address`);
+
+--
+-- Indexes for table `address_history`
+--
+ALTER TABLE `address_history`
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `address_id` (`address`,`id`),
+  ADD KEY `height` (`height`);
+
+--
+-- Indexes for table `address_output`
+--
+ALTER TABLE `address_output`
+  ADD PRIMARY KEY (`txid`,`n`),
+  ADD KEY `address_spent_height` (`address`,`spent_txid`,`height`),
+  ADD KEY `height` (`height`),
+  ADD KEY `spent_height` (`spent_height`);
+
 --
 -- Indexes for table `block`
 --
@@ -183,6 +289,16 @@ ALTER TABLE `block`
 ALTER TABLE `block_reward`
   ADD PRIMARY KEY (`height`);
 
+--
+-- Indexes for table `block_rewards`
+-- (the batched upserts need the primary key, older tables possibly holding
+-- duplicate ids are migrated with `vlsminingapi.py --migrate-block-rewards`)
+--
+ALTER TABLE `block_rewards`
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `algo_id` (`algo`,`id`),
+  ADD KEY `created_at` (`created_at`);
+
 --
 -- Indexes for table `daily_price`
 --
@@ -195,12 +311,31 @@ ALTER TABLE `daily_price`
 ALTER TABLE `daily_supply`
   ADD PRIMARY KEY (`id`);
 
+--
+-- Indexes for table `index_state`
+--
+ALTER TABLE `index_state`
+  ADD PRIMARY KEY (`name`);
+
 --
 -- Indexes for table `mining_status`
 --
 ALTER TABLE `mining_status`
   ADD PRIMARY KEY (`algo`);
 
+--
+-- Indexes for table `poller_lease`
+--
+ALTER TABLE `poller_lease`
+  ADD PRIMARY KEY (`name`);
+
+--
+-- Indexes for table `poller_message`
+--
+ALTER TABLE `poller_message`
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `created_at` (`created_at`);
+
 --
 -- Indexes for table `transaction`
 --
@@ -211,6 +346,18 @@ ALTER TABLE `transaction`
 -- AUTO_INCREMENT for dumped tables
 --
 
+--
+-- AUTO_INCREMENT for table `address_history`
+--
+ALTER TABLE `address_history`
+  MODIFY `id` bigint(20) NOT NULL AUTO_INCREMENT;
+
+--
+-- AUTO_INCREMENT for table `poller_message`
+--
+ALTER TABLE `poller_message`
+  MODIFY `id` bigint(20) NOT NULL AUTO_INCREMENT;
+
 --
 -- AUTO_INCREMENT for table `daily_supply`
 --
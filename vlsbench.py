@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+#
+# Websocket load test of VelesWebsiteApiServer
+#
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import websockets
+
+def percentiles(values):
+	if not values:
+		return None
+
+	values = sorted(values)
+
+	def pick(fraction):
+		return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3)
+
+	return {'count': len(values), 'p50_ms': pick(0.5), 'p99_ms': pick(0.99), 'p999_ms': pick(0.999), 'max_ms': pick(1)}
+
+# Starts the fake node (vlsfakenode.py) and the server against it and the
+# database of the given configuration file, then opens the requested number
+# of websocket clients, each sending commands of the configured mix in a loop
+# with a think time in between, while new blocks are mined on the fake node
+# at a fixed interval. Reports command throughput and latency percentiles,
+# how long it took the new block events to reach all the clients and the
+# server memory per connection, as JSON.
+class VelesLoadTest(object):
+	commands = {
+		'node': {'message-type': 'command', 'service': 'node', 'name': 'getblockchaininfo'},
+		'stats': {'message-type': 'command', 'service': 'stats', 'name': 'blocks 10'},
+		'price': {'message-type': 'command', 'service': 'price', 'name': 'info'},
+		'listClients': {'message-type': 'command', 'name': 'listClients'}
+		}
+	response_timeout = 10
+	connect_batch_size = 200
+
+	def __init__(self, args):
+		self.args = args
+		self.mix = self.parse_mix(args.mix)
+		self.latencies = {name: [] for name in self.mix.keys()}
+		self.completed = 0	# responses received before the deadline
+		self.pending = {}
+		self.errors = 0
+		self.timeouts = 0
+		self.sent = 0
+		self.blocks = {}	# tip hash -> [mined at, [receive times]]
+		self.processes = []
+		self.server_process = None
+		self.request_counter = 0
+
+	def parse_mix(self, mix):
+		result = {}
+
+		for item in mix.split(','):
+			name, weight = item.split('=')
+
+			if name not in self.commands:
+				raise ValueError('Unknown command kind %s, use one of %s' % (name, ', '.join(self.commands.keys())))
+
+			result[name] = float(weight)
+
+		return result
+
+	def write_config(self):
+		config = configparser.ConfigParser()
+		config.read(self.args.config)
+
+		if not 'mysql' in config:
+			raise ValueError('Configuration %s needs a [mysql] section pointing to a local database' % self.args.config)
+
+		config.remove_section('ssl')
+		config['server'] = {
+			'address': '127.0.0.1',
+			'http_port': str(self.args.http_port),
+			'ws_port': str(self.args.ws_port),
+			'pull_block_delay': str(self.args.poll_delay)
+			}
+		config['wallet'] = {'host': '127.0.0.1', 'port': str(self.args.node_port)}
+		config['logging'] = {'level': 'WARNING', 'message_logging': 'false'}
+		config['ratelimit'] = {'enabled': 'false'}	# all the clients come from one address
+
+		handle, path = tempfile.mkstemp(suffix='.conf')
+
+		with os.fdopen(handle, 'w') as f:
+			config.write(f)
+
+		return path
+
+	def start(self, arguments):
+		directory = os.path.dirname(os.path.abspath(__file__))
+		process = subprocess.Popen([sys.executable] + arguments, cwd=directory)
+		self.processes += [process]
+		return process
+
+	def wait_for_port(self, port, timeout = 60):
+		deadline = time.time() + timeout
+
+		while time.time() < deadline:
+			try:
+				socket.create_connection(('127.0.0.1', port), 1).close()
+				return
+			except OSError:
+				time.sleep(0.2)
+
+		raise TimeoutError('Nothing listening on port %i after %is' % (port, timeout))
+
+	def get_rss(self, pid):
+		# resident memory of the process and its children (the workers)
+		rss = None
+
+		with open('/proc/%i/status' % pid) as f:
+			for line in f:
+				if line.startswith('VmRSS:'):
+					rss = int(line.split()[1]) * 1024
+
+		if rss != None and os.path.exists('/proc/%i/task/%i/children' % (pid, pid)):
+			with open('/proc/%i/task/%i/children' % (pid, pid)) as f:
+				for child in f.read().split():
+					rss += self.get_rss(int(child)) or 0
+
+		return rss
+
+	@asyncio.coroutine
+	def node_rpc(self, method, params = []):
+		session = aiohttp.ClientSession()
+
+		try:
+			response = yield from session.post(
+				'http://127.0.0.1:%i/' % self.args.node_port,
+				data = json.dumps({'method': method, 'params': params, 'id': 0})
+				)
+			result = yield from response.json()
+		finally:
+			yield from session.close()
+
+		return result['result']
+
+	@asyncio.coroutine
+	def connect(self):
+		url = 'ws://127.0.0.1:%i/' % self.args.ws_port
+		clients = []
+
+		for offset in range(0, self.args.clients, self.connect_batch_size):
+			batch = min(self.connect_batch_size, self.args.clients - offset)
+			clients += (yield from asyncio.gather(*[
+				websockets.connect(url, max_size = None) for i in range(batch)
+				]))
+
+		return clients
+
+	@asyncio.coroutine
+	def reader(self, ws):
+		while True:
+			try:
+				message = json.loads((yield from ws.recv()))
+			except websockets.exceptions.ConnectionClosed:
+				return
+
+			now = time.perf_counter()
+
+			if message.get('message-type') == 'event':
+				if message.get('entity-id') == 'chain.tip' and message.get('new-state'):
+					block_hash = message['new-state'].get('hash')
+
+					if block_hash in self.blocks:
+						self.blocks[block_hash][1] += [now]
+
+			elif message.get('request-id') in self.pending:
+				future = self.pending.pop(message['request-id'])
+
+				if message.get('message-type') == 'error':
+					self.errors += 1
+
+				if not future.done():
+					future.set_result(now)
+
+	@asyncio.coroutine
+	def sender(self, ws, deadline):
+		names = list(self.mix.keys())
+		weights = list(self.mix.values())
+		loop = asyncio.get_event_loop()
+
+		# spread the start over the think time so the clients don't go in lockstep
+		yield from asyncio.sleep(random.random() * self.args.think_time)
+
+		while time.perf_counter() < deadline:
+			name = random.choices(names, weights)[0]
+			self.request_counter += 1
+			request_id = 'bench-%i' % self.request_counter
+			command = dict(self.commands[name])
+			command['request-id'] = request_id
+			future = loop.create_future()
+			self.pending[request_id] = future
+			started = time.perf_counter()
+
+			try:
+				yield from ws.send(json.dumps(command))
+				self.sent += 1
+				finished = yield from asyncio.wait_for(future, self.response_timeout)
+				self.latencies[name] += [finished - started]
+
+				if finished <= deadline:
+					self.completed += 1
+			except asyncio.TimeoutError:
+				self.pending.pop(request_id, None)
+				self.timeouts += 1
+			except websockets.exceptions.ConnectionClosed:
+				self.errors += 1
+				return
+
+			yield from asyncio.sleep(self.args.think_time)
+
+	@asyncio.coroutine
+	def miner(self, deadline):
+		while time.perf_counter() + self.args.block_interval < deadline:
+			yield from asyncio.sleep(self.args.block_interval)
+			block_hash = (yield from self.node_rpc('generate', [1]))[0]
+			self.blocks[block_hash] = [time.perf_counter(), []]
+
+	@asyncio.coroutine
+	def run_clients(self):
+		connect_started = time.perf_counter()
+		clients = yield from self.connect()
+		connect_time = time.perf_counter() - connect_started
+		yield from asyncio.sleep(1)	# let the server settle after the connection burst
+		rss_connected = self.get_rss(self.server_process.pid)
+
+		readers = [asyncio.ensure_future(self.reader(ws)) for ws in clients]
+		started = time.perf_counter()
+		deadline = started + self.args.duration
+		yield from asyncio.gather(self.miner(deadline), *[self.sender(ws, deadline) for ws in clients])
+
+		# give the last block events time to arrive
+		yield from asyncio.sleep(self.args.poll_delay + 1)
+		yield from asyncio.gather(*[ws.close() for ws in clients])
+
+		for reader in readers:
+			reader.cancel()
+
+		return connect_time, rss_connected
+
+	def run(self):
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+		config_path = self.write_config()
+		loop = asyncio.get_event_loop()
+
+		try:
+			self.start([
+				'vlsfakenode.py', '--port', str(self.args.node_port), '--height', str(self.args.height),
+				'--seed', str(self.args.seed), '--tx-per-block', str(self.args.tx_per_block)
+				])
+			self.wait_for_port(self.args.node_port)
+			self.server_process = self.start([
+				'server.py', '--config', config_path, '--workers', str(self.args.workers),
+				'--worker-socket', config_path + '.sock'
+				])
+			self.wait_for_port(self.args.ws_port)
+			time.sleep(2)	# first poll of the pull tasks
+			rss_idle = self.get_rss(self.server_process.pid)
+			connect_time, rss_connected = loop.run_until_complete(self.run_clients())
+		finally:
+			for process in self.processes:
+				process.terminate()
+				process.wait()
+
+			os.unlink(config_path)
+
+		all_latencies = sum(self.latencies.values(), [])
+		fanout = []
+		delivery = []
+		missed = 0
+
+		for mined_at, received in self.blocks.values():
+			if received:
+				fanout += [max(received) - min(received)]
+				delivery += [max(received) - mined_at]
+
+			missed += self.args.clients - len(received)
+
+		return {
+			'clients': self.args.clients,
+			'workers': self.args.workers,
+			'duration_s': self.args.duration,
+			'mix': self.mix,
+			'think_time_s': self.args.think_time,
+			'connect_time_s': round(connect_time, 3),
+			'commands_sent': self.sent,
+			'responses': len(all_latencies),
+			'errors': self.errors,
+			'timeouts': self.timeouts,
+			'throughput_per_s': round(self.completed / self.args.duration, 1),
+			'latency': percentiles(all_latencies),
+			'latency_by_command': {name: percentiles(values) for name, values in self.latencies.items()},
+			'blocks': {
+				'mined': len(self.blocks),
+				'missed_deliveries': missed,
+				'fanout': percentiles(fanout),	# first to last client receiving the event
+				'delivery': percentiles(delivery)	# mined to last client, includes the polling delay
+				},
+			'memory': {
+				'server_rss_idle': rss_idle,
+				'server_rss_connected': rss_connected,
+				'bytes_per_connection': int((rss_connected - rss_idle) / self.args.clients) if rss_idle and rss_connected else None
+				}
+			}
+
+# Feeds the blocks of a seeded fake node chain to the ingest paths in-process,
+# the same way the server does on new blocks: the chain tip and PoW state
+# events to VelesChainStatsDB and the masternode list to VelesMasternodeStore,
+# and reports their throughput and per block timings as JSON.
+class VelesIngestBenchmark(object):
+	def __init__(self, args):
+		self.args = args
+
+	def run(self):
+		import vlsfakenode
+		import vlsmasternodes
+		import vlsstats
+
+		config = configparser.ConfigParser()
+		config.read(self.args.config)
+
+		if not 'mysql' in config:
+			raise ValueError('Configuration %s needs a [mysql] section pointing to a local database' % self.args.config)
+
+		node = vlsfakenode.VelesFakeNode(self.args.height, self.args.masternodes, self.args.seed, self.args.tx_per_block,
+			reorg_probability = self.args.reorg_probability)
+		statsdb = vlsstats.VelesChainStatsDB(**config['mysql'], wallet = node)
+		statsdb.log = lambda msg: None
+		masternodes = vlsmasternodes.VelesMasternodeStore()
+		timings = {'tip': [], 'pow': [], 'masternodes': []}
+		transactions = 0
+		started = time.perf_counter()
+
+		for index in range(self.args.ingest):
+			node.mine()
+			tip = node.rpc_call('getblock', [node.rpc_call('getbestblockhash')])
+			transactions += tip['nTx']
+
+			begin = time.perf_counter()
+			statsdb.handle_event('state_changed', {'entity-id': 'chain.tip', 'new-state': tip})
+			timings['tip'] += [time.perf_counter() - begin]
+
+			begin = time.perf_counter()
+			pow_state = {'multialgo': {item['algo']: item for item in node.rpc_call('getmultialgostatus')}}
+			statsdb.handle_event('state_changed', {'entity-id': 'chain.pow', 'new-state': pow_state})
+			timings['pow'] += [time.perf_counter() - begin]
+
+			begin = time.perf_counter()
+			masternodes.update(vlsmasternodes.VelesMasternodeStore.parse_masternodelist(node.rpc_call('masternodelist', ['json'])))
+			timings['masternodes'] += [time.perf_counter() - begin]
+
+		elapsed = time.perf_counter() - started
+
+		return {
+			'blocks': self.args.ingest,
+			'transactions': transactions,
+			'seed': self.args.seed,
+			'tx_per_block': self.args.tx_per_block,
+			'reorgs': node.chain.branch,
+			'seconds': round(elapsed, 3),
+			'blocks_per_second': round(self.args.ingest / elapsed, 1),
+			'transactions_per_second': round(transactions / elapsed, 1),
+			'timings': {name: percentiles(values) for name, values in timings.items()}
+			}
+
+# Basic commandline interface
+def main():
+	parser = argparse.ArgumentParser(description='Websocket load test of the Veles website API server')
+	parser.add_argument('--config', default='websiteapi.conf',
+			help='configuration file with the [mysql] section of the local test database')
+	parser.add_argument('--clients', type=int, default=1000,
+			help='number of websocket clients')
+	parser.add_argument('--duration', type=float, default=60,
+			help='seconds to send commands for')
+	parser.add_argument('--mix', default='node=40,stats=30,price=20,listClients=10',
+			help='relative weights of the command kinds node, stats, price and listClients')
+	parser.add_argument('--think-time', type=float, default=1,
+			help='seconds every client waits between a response and the next command')
+	parser.add_argument('--block-interval', type=float, default=10,
+			help='seconds between the blocks mined on the fake node')
+	parser.add_argument('--poll-delay', type=float, default=1,
+			help='block polling interval of the server')
+	parser.add_argument('--height', type=int, default=1000,
+			help='initial height of the fake chain')
+	parser.add_argument('--seed', type=int, default=1,
+			help='seed of the fake chain')
+	parser.add_argument('--tx-per-block', type=int, default=2,
+			help='transactions per block of the fake chain apart of the coinbase')
+	parser.add_argument('--masternodes', type=int, default=100,
+			help='initial number of masternodes of the fake chain')
+	parser.add_argument('--reorg-probability', type=float, default=0,
+			help='chance of a reorg instead of a new block in the ingest benchmark')
+	parser.add_argument('--ingest', type=int, default=0,
+			help='instead of the websocket load test, ingest this many new blocks in-process')
+	parser.add_argument('--workers', type=int, default=1,
+			help='number of server worker processes')
+	parser.add_argument('--node-port', type=int, default=25599)
+	parser.add_argument('--ws-port', type=int, default=28882)
+	parser.add_argument('--http-port', type=int, default=28881)
+	parser.add_argument('--output',
+			help='write the JSON results to this file instead of stdout')
+	args = parser.parse_args()
+
+	if args.ingest:
+		result = VelesIngestBenchmark(args).run()
+	else:
+		result = VelesLoadTest(args).run()
+
+	result = json.dumps(result, indent=4, sort_keys=True)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(result + '\n')
+	else:
+		print(result)
+
+if __name__=='__main__':
+	main()
@@ -8,6 +8,12 @@ class VelesBlockInfoRepository(object):
 	user = None
 	password = None
 	database = None
+	store_chunk_size = 1000
+	primary_key_checked = False
+	upsert_sql = ('INSERT INTO `block_rewards` (id, hash, algo, rewards, difficulty, hashrate, reward_per_mh) '
+		+ 'VALUES (%s, %s, %s, %s, %s, %s, %s) '
+		+ 'ON DUPLICATE KEY UPDATE hash=VALUES(hash), algo=VALUES(algo), rewards=VALUES(rewards), '
+		+ 'difficulty=VALUES(difficulty), hashrate=VALUES(hashrate), reward_per_mh=VALUES(reward_per_mh)')
 
 	def __init__(self, host, port, username, password, database):
 		self.host = host
@@ -38,54 +44,148 @@ class VelesBlockInfoRepository(object):
 	def get_block_count(self, algo = None, hours = None):
 		return self.limit_sql_query('SELECT COUNT(id) FROM `block_rewards`', 'COUNT(id)', algo, hours)
 
-	def store(self, block_info):
-		select_sql = 'SELECT id FROM `block_rewards` WHERE `id` = %s'
-		update_sql = 'UPDATE `block_rewards` SET hash=%s, algo=%s, rewards=%s, difficulty=%s, hashrate=%s, reward_per_mh=%s WHERE `id` = %s'
-		insert_sql = 'INSERT INTO `block_rewards` (hash, algo, rewards, difficulty, hashrate, reward_per_mh, id) VALUES (%s, %s, %s, %s, %s, %s, %s)'
-		exists = False
-		optional_fields = {'hashrate': None, 'reward_per_mh': None}
-		optional_fields.update(block_info)
-		block_info = optional_fields
+	def get_last_id(self):
+		with self.conn().cursor() as cursor:
+			cursor.execute('SELECT MAX(id) AS last_id FROM `block_rewards`')
+			result = cursor.fetchall()
+			self.conn().commit()
+
+		if result and len(result):
+			return result[0]['last_id']
+
+		return None
+
+	def get_algo_summaries(self, hours = None, algo = None):
+		# Aggregates of every algo (or just one) in a single grouped query, joined
+		# with the last block of each algo, keyed by algo name.
+		sql = ('SELECT s.*, l.difficulty AS last_difficulty, l.rewards AS last_rewards, l.hashrate AS last_hashrate '
+			+ 'FROM (SELECT algo, MAX(id) AS last_id, ' + self.summary_columns(hours)
+			+ ' FROM `block_rewards` WHERE rewards IS NOT NULL AND hashrate IS NOT NULL'
+			+ (' AND algo = %s' if algo else '')
+			+ ' GROUP BY algo) s JOIN `block_rewards` l ON l.id = s.last_id')
+		result = {}
 
 		with self.conn().cursor() as cursor:
-			try:
-				cursor.execute(select_sql, (block_info['id']))
-				self.conn().commit()
-				exists = len(list(cursor.fetchall()))
-			except:
-				exists = False
-			##	print("Repository error: failed to store block info")
-			#finally:
-			#	 cursor.close()
+			cursor.execute(sql, (algo) if algo else None)
+
+			for row in cursor.fetchall():
+				result[row['algo']] = row
+
+			self.conn().commit()
+
+		return result
+
+	def get_total_summary(self, hours = None):
+		# Same aggregates as get_algo_summaries over all the algos together
+		sql = ('SELECT ' + self.summary_columns(hours)
+			+ ' FROM `block_rewards` WHERE rewards IS NOT NULL AND hashrate IS NOT NULL')
 
 		with self.conn().cursor() as cursor:
-			#try:
-			if exists:
-				cursor.execute(update_sql, (
-					block_info['hash'], 
-					block_info['algo'], 
-					block_info['rewards'], 
-					block_info['difficulty'],
-					block_info['hashrate'],
-					block_info['reward_per_mh'],
-					block_info['id']
-				))
-			else:
-				cursor.execute(insert_sql, (
-					block_info['hash'], 
-					block_info['algo'], 
-					block_info['rewards'], 
-					block_info['difficulty'],
-					block_info['hashrate'],
-					block_info['reward_per_mh'],
-					block_info['id']
-				))
+			cursor.execute(sql)
+			result = cursor.fetchall()
 			self.conn().commit()
-			#except:
-			#	print("Repository error: failed to store block info")
-			#finally:
-			#	self.conn().commit()
-			#	cursor.close()
+
+		if result and len(result):
+			return result[0]
+
+		return None
+
+	def summary_columns(self, hours = None):
+		# Conditional aggregates for the requested window and the fixed hourly/daily ones,
+		# matching what get_total_value/get_average_value/get_block_count return.
+		if hours is None:
+			window = 'TRUE'
+		else:
+			window = 'created_at >= DATE_SUB(NOW(),INTERVAL %i HOUR)' % int(hours)
+
+		hourly = 'created_at >= DATE_SUB(NOW(),INTERVAL 1 HOUR)'
+		daily = 'created_at >= DATE_SUB(NOW(),INTERVAL 24 HOUR)'
+
+		return ', '.join([
+			'SUM(IF(%s, rewards, NULL)) AS rewards_total' % window,
+			'COUNT(IF(%s, id, NULL)) AS blocks_total' % window,
+			'AVG(IF(%s, hashrate, NULL)) AS hashrate_average' % window,
+			'AVG(IF(%s, difficulty, NULL)) AS difficulty_average' % window,
+			'SUM(IF(%s, reward_per_mh, NULL)) AS reward_per_mh_total' % window,
+			'SUM(IF(%s, rewards, NULL)) AS rewards_hourly' % hourly,
+			'COUNT(IF(%s, id, NULL)) AS blocks_hourly' % hourly,
+			'SUM(IF(%s, rewards, NULL)) AS rewards_daily' % daily,
+			'COUNT(IF(%s, id, NULL)) AS blocks_daily' % daily,
+			])
+
+	def store(self, block_info):
+		return self.store_many([block_info])
+
+	def store_many(self, blocks):
+		# one multi-row INSERT ... ON DUPLICATE KEY UPDATE round-trip per chunk
+		self.check_primary_key()
+		rows = []
+
+		for block_info in blocks:
+			optional_fields = {'hashrate': None, 'reward_per_mh': None}
+			optional_fields.update(block_info)
+			rows += [(
+				optional_fields['id'],
+				optional_fields['hash'],
+				optional_fields['algo'],
+				optional_fields['rewards'],
+				optional_fields['difficulty'],
+				optional_fields['hashrate'],
+				optional_fields['reward_per_mh']
+			)]
+
+		connection = self.conn()
+
+		with connection.cursor() as cursor:
+			for offset in range(0, len(rows), self.store_chunk_size):
+				cursor.executemany(self.upsert_sql, rows[offset:offset + self.store_chunk_size])
+				connection.commit()
+
+		return len(rows)
+
+	def has_primary_key(self):
+		with self.conn().cursor() as cursor:
+			cursor.execute("SHOW KEYS FROM `block_rewards` WHERE Key_name = 'PRIMARY'")
+			result = cursor.fetchall()
+			self.conn().commit()
+
+		return bool(result)
+
+	def check_primary_key(self):
+		# without the key the upsert silently inserts duplicate rows, tables
+		# created before it was added need migrate_primary_key() first
+		if self.primary_key_checked:
+			return
+
+		if not self.has_primary_key():
+			raise RuntimeError('block_rewards has no primary key on id, run vlsminingapi.py --migrate-block-rewards first')
+
+		self.primary_key_checked = True
+
+	def migrate_primary_key(self):
+		# Rebuilds block_rewards with the keys of tables.sql, keeping the most
+		# recently created row of every duplicate id. Returns the number of
+		# duplicate rows dropped, None when the key was already there.
+		if self.has_primary_key():
+			return None
+
+		connection = self.conn()
+
+		with connection.cursor() as cursor:
+			cursor.execute('SELECT COUNT(*) AS count FROM `block_rewards`')
+			count = cursor.fetchall()[0]['count']
+			cursor.execute('DROP TABLE IF EXISTS `block_rewards_migrated`')
+			cursor.execute('CREATE TABLE `block_rewards_migrated` LIKE `block_rewards`')
+			cursor.execute('ALTER TABLE `block_rewards_migrated` ADD PRIMARY KEY (`id`), '
+				+ 'ADD KEY `algo_id` (`algo`,`id`), ADD KEY `created_at` (`created_at`)')
+			cursor.execute('INSERT IGNORE INTO `block_rewards_migrated` SELECT * FROM `block_rewards` ORDER BY created_at DESC')
+			cursor.execute('RENAME TABLE `block_rewards` TO `block_rewards_old`, `block_rewards_migrated` TO `block_rewards`')
+			cursor.execute('DROP TABLE `block_rewards_old`')
+			cursor.execute('SELECT COUNT(*) AS count FROM `block_rewards`')
+			kept = cursor.fetchall()[0]['count']
+			connection.commit()
+
+		return count - kept
 
 	## Internal functions
 	def conn(self):
@@ -169,6 +269,9 @@ class VelesMiningStatusRepository(object):
 	user = None
 	password = None
 	database = None
+	store_chunk_size = 1000
+	upsert_sql = ('INSERT INTO `mining_status` (algo, blocks, difficulty, hashrate) VALUES (%s, %s, %s, %s) '
+		+ 'ON DUPLICATE KEY UPDATE blocks=VALUES(blocks), difficulty=VALUES(difficulty), hashrate=VALUES(hashrate)')
 
 	def __init__(self, host, port, username, password, database):
 		self.host = host
@@ -204,41 +307,27 @@ class VelesMiningStatusRepository(object):
 		return None
 
 	def store(self, data):
-		select_sql = 'SELECT algo FROM `mining_status` WHERE `algo` = %s'
-		update_sql = 'UPDATE `mining_status` SET blocks=%s, difficulty=%s, hashrate=%s WHERE `algo` = %s'
-		insert_sql = 'INSERT INTO `mining_status` (blocks, difficulty, hashrate, algo) VALUES (%s, %s, %s, %s)'
-		exists = False
+		return self.store_many([data])
 
-		with self.conn().cursor() as cursor:
-			try:
-				cursor.execute(select_sql, (data['algo']))
-				exists = len(list(cursor.fetchall()))
-			except:
-				print("Repository error: failed to store block info")
-			finally:
-				 cursor.close()
+	def store_many(self, items):
+		# one multi-row INSERT ... ON DUPLICATE KEY UPDATE round-trip per chunk
+		rows = []
 
-		with self.conn().cursor() as cursor:
+		for data in items:
+			rows += [(data['algo'], data['blocks'], data['difficulty'], data['hashrate'])]
+
+		connection = self.conn()
+
+		with connection.cursor() as cursor:
 			try:
-				if exists:
-					cursor.execute(update_sql, (
-						data['blocks'], 
-						data['difficulty'],
-						data['hashrate'],
-						data['algo']
-					))
-				else:
-					cursor.execute(insert_sql, (
-						data['blocks'], 
-						data['difficulty'],
-						data['hashrate'],
-						data['algo']
-					))
+				for offset in range(0, len(rows), self.store_chunk_size):
+					cursor.executemany(self.upsert_sql, rows[offset:offset + self.store_chunk_size])
+					connection.commit()
 			except:
-				print("Repository error: failed to store block info")
-			finally:
-				self.conn().commit()
-				cursor.close()
+				print("Repository error: failed to store mining status")
+				return 0
+
+		return len(rows)
 
 	## Internal functions
 	def conn(self):
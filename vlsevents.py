@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+#
+# Asynchronous event bus with bounded per-subscriber queues
+#
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import time
+import uuid
+
+import vlslog
+import vlsmetrics
+
+queue_depth = vlsmetrics.registry.gauge('veles_event_queue_depth', 'Events waiting in the subscriber queue', ['subscriber'])
+delivery_seconds = vlsmetrics.registry.histogram('veles_event_delivery_seconds', 'Time from publishing to the subscriber taking the event', ['subscriber'])
+handler_seconds = vlsmetrics.registry.histogram('veles_event_handler_seconds', 'Subscriber event handling duration', ['subscriber'])
+events_dropped = vlsmetrics.registry.counter('veles_events_dropped_total', 'Events dropped on a full subscriber queue', ['subscriber'])
+events_coalesced = vlsmetrics.registry.counter('veles_events_coalesced_total', 'Queued events replaced by a newer one of the same entity', ['subscriber'])
+handler_errors = vlsmetrics.registry.counter('veles_event_handler_errors_total', 'Subscriber event handlers failed', ['subscriber'])
+
+# Queue and consumer task of a single subscriber, what happens when the queue
+# is full depends on the policy:
+#  - block: the publisher waits for a free slot, nothing is lost
+#  - drop: the new event is dropped
+#  - coalesce: a queued event of the same name and entity-id is replaced by
+#    the newer one in place, only the state that is current when handled
+#    matters; other events are dropped when the queue is full
+# Threaded subscribers are handled on their own thread (in order), for the
+# ones doing blocking I/O such as RPC calls and SQL commits. Every queued event
+# has a future that's done once handled (a coalesced one shares it with the
+# newer event), so the publisher can wait for its results when it needs them.
+class VelesEventSubscription(object):
+	policies = ['block', 'drop', 'coalesce']
+
+	def __init__(self, handler, name, maxsize = 1000, policy = 'block', threaded = False):
+		if policy not in self.policies:
+			raise ValueError('Unknown event queue policy: %s' % policy)
+
+		self.handler = handler
+		self.name = name
+		self.maxsize = maxsize
+		self.policy = policy
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if threaded else None
+		self.pending = collections.OrderedDict()	# key -> (name, data, published at)
+		self.counter = 0
+		self.not_empty = asyncio.Event()
+		self.not_full = asyncio.Event()
+		self.not_full.set()
+		self.task = None
+
+	def get_key(self, name, data):
+		if self.policy == 'coalesce' and isinstance(data, dict) and 'entity-id' in data:
+			return (name, data['entity-id'])
+
+		self.counter += 1
+		return self.counter
+
+	@asyncio.coroutine
+	def put(self, name, data):
+		if not self.task:	# started on first use, in the loop that publishes
+			self.task = asyncio.ensure_future(self.run_task())
+
+		key = self.get_key(name, data)
+
+		if key in self.pending:
+			events_coalesced.inc(subscriber=self.name)
+			handled = self.pending[key][3]
+
+		elif len(self.pending) >= self.maxsize and self.policy != 'block':
+			events_dropped.inc(subscriber=self.name)
+			return None
+
+		else:
+			while len(self.pending) >= self.maxsize:
+				self.not_full.clear()
+				yield from self.not_full.wait()
+
+			handled = asyncio.get_event_loop().create_future()
+
+		self.pending[key] = (name, data, time.perf_counter(), handled)
+		queue_depth.set(len(self.pending), subscriber=self.name)
+		self.not_empty.set()
+		return handled
+
+	@asyncio.coroutine
+	def run_task(self):
+		loop = asyncio.get_event_loop()
+
+		while True:
+			if not self.pending:
+				self.not_empty.clear()
+				yield from self.not_empty.wait()
+				continue
+
+			key, (name, data, published_at, handled) = self.pending.popitem(last = False)
+			queue_depth.set(len(self.pending), subscriber=self.name)
+			self.not_full.set()
+			started = time.perf_counter()
+			delivery_seconds.observe(started - published_at, subscriber=self.name)
+
+			try:
+				if self.executor:
+					yield from loop.run_in_executor(self.executor, self.handler, name, data)
+				else:
+					self.handler(name, data)
+
+				handled.set_result(True)
+			except Exception as e:
+				handler_errors.inc(subscriber=self.name)
+				vlslog.logger.error('Error while handling event %s in %s: %s', name, self.name, e, exc_info=True)
+				handled.set_result(False)
+
+			handler_seconds.observe(time.perf_counter() - started, subscriber=self.name)
+
+# Fans the published events out to the registered subscriber queues. The
+# publisher only waits for the queues of the blocking policy subscribers that
+# are full, never for the handlers themselves; it gets their futures instead.
+class VelesEventBus(object):
+	def __init__(self):
+		self.subscriptions = []
+
+	def register(self, subscriber, name = None, maxsize = 1000, policy = 'block', threaded = False):
+		# subscriber is an object with handle_event(name, data), such as the
+		# stats database, or a function with the same arguments
+		handler = subscriber.handle_event if hasattr(subscriber, 'handle_event') else subscriber
+
+		if not name:
+			name = type(subscriber).__name__ if hasattr(subscriber, 'handle_event') else subscriber.__name__
+
+		subscription = VelesEventSubscription(handler, name, maxsize, policy, threaded)
+		self.subscriptions += [subscription]
+		return subscription
+
+	@asyncio.coroutine
+	def publish(self, name, data):
+		handled = []
+
+		for subscription in self.subscriptions:
+			future = yield from subscription.put(name, data)
+
+			if future:
+				handled += [future]
+
+		return handled
+
+# Bounded ring of the last published event messages by their sequence number,
+# so reconnecting clients get only the events they've missed. The epoch
+# changes when the numbering starts over (restart, new poller leader), a
+# client resuming from another epoch or from a sequence number that's no
+# longer in the ring needs a snapshot instead.
+class VelesEventLog(object):
+	size = 1000
+
+	def __init__(self, size = None):
+		if size:
+			self.size = int(size)
+
+		self.entries = collections.deque(maxlen = self.size)	# (seq, message)
+		self.epoch = None
+		self.last_seq = 0
+		self.new_epoch()
+
+	def new_epoch(self):
+		self.epoch = uuid.uuid4().hex[:12]
+		self.entries.clear()
+		self.last_seq = 0
+
+	def next_seq(self):
+		return self.last_seq + 1
+
+	def append(self, seq, message, epoch = None):
+		# numbers assigned by the publisher, a follower adopts its epoch and
+		# starts over on a gap so the ring is always contiguous
+		if epoch and epoch != self.epoch:
+			self.epoch = epoch
+			self.entries.clear()
+
+		elif seq <= self.last_seq and self.entries:
+			return	# already have it, eg. replayed by the event hub
+
+		elif seq != self.last_seq + 1:
+			self.entries.clear()
+
+		self.entries.append((seq, message))
+		self.last_seq = seq
+
+	def since(self, seq, epoch):
+		# messages published after seq, None when they're not all available
+		if epoch != self.epoch or seq > self.last_seq:
+			return None
+
+		if seq == self.last_seq:
+			return []
+
+		if not self.entries or seq < self.entries[0][0] - 1:
+			return None
+
+		return [message for entry_seq, message in itertools.islice(self.entries, seq - self.entries[0][0] + 1, None)]
@@ -1,22 +1,43 @@
 #!/usr/bin/python3
-import requests, json
+import asyncio, requests, json, time, hashlib, argparse, collections
+from aiohttp import web
 from time import sleep
+import vlshttp
 
 class VelesBlockExplorer(object):
 	api_url = 'http://explorer.veles.network/api'
 	session = requests.Session()
+	timeout = 10
+	block_cache_size = 10000
+
+	def __init__(self, http = None):
+		self.http = http if http else vlshttp.VelesHttpClient()
+		self.block_cache = collections.OrderedDict()
 
 	def call_api_method(self, api_method, method_args=None):
 		url = "%s/%s" % (self.api_url, api_method)
-		response = self.session.get(url, params=method_args)
+		response = self.session.get(url, params=method_args, timeout=self.timeout)
+		return self.parse_api_response(response.text)
+
+	@asyncio.coroutine
+	def call_api_method_async(self, api_method, method_args=None):
+		url = "%s/%s" % (self.api_url, api_method)
+
+		if method_args:
+			method_args = {key: str(value) for key, value in method_args.items()}
+
+		text = yield from self.http.get_text(url, params=method_args)
+		return self.parse_api_response(text)
+
+	def parse_api_response(self, text):
 		# This is a specific backend error ...
-		if response.text == 'There was and error. Check your console.':
+		if text == 'There was and error. Check your console.':
 			return None
 
 		try:
-			json_payload = dict(response.json())
+			json_payload = dict(json.loads(text))
 		except:
-			return response.text.strip()
+			return text.strip()
 
 		return json_payload
 
@@ -49,34 +70,211 @@ class VelesBlockExplorer(object):
 			if not block_index:
 				block_index = int(self.call_api_method('getblockcount')) - 1
 			block_hash = self.call_api_method('getblockhash', {'index': block_index})
+
+			if block_hash in self.block_cache:
+				return self.block_cache[block_hash]
+
 			block_info = self.call_api_method('getblock', {'hash': block_hash})
-			block_rewards = 0
-
-			for tx_id in block_info['tx']:
-				try:
-					tx_info = self.call_api_method('getrawtransaction', {'txid': "%s" % tx_id, 'decrypt': 1})
-
-					if 'vout' in tx_info and 'vin' in tx_info and len(tx_info['vin']):
-						if 'coinbase' in tx_info['vin'][0] and 'txid' not in tx_info['vin'][0]: # todo make sure its one
-							for vout in tx_info['vout']:
-								block_rewards += float(vout['value'])
-				except:
-					#print("Error parsing tx ", tx_id)
-					pass
-
-			info = {
-				'id': block_index,
-				'hash': block_hash,
-				'algo': self.detect_algo(block_info['versionHex']),
-				'rewards': block_rewards,
-				'difficulty': block_info['difficulty']
-				}
+			# the coinbase is always the first transaction of the block
+			block_rewards = self.get_coinbase_value(self.get_transaction(block_info['tx'][0]))
+
+			if block_rewards == None:
+				block_rewards = 0
+
+				for tx_id in block_info['tx'][1:]:
+					block_rewards += self.get_coinbase_value(self.get_transaction(tx_id)) or 0
+
+			info = self.compose_block_info(block_index, block_hash, block_info, block_rewards)
 		except:
 			return None
 
-		if info['rewards']:
-			return info
-		else:
+		return info
+
+	@asyncio.coroutine
+	def get_last_block_info_async(self, block_index = None):
+		try:
+			if not block_index:
+				block_count = yield from self.call_api_method_async('getblockcount')
+				block_index = int(block_count) - 1
+			block_hash = yield from self.call_api_method_async('getblockhash', {'index': block_index})
+
+			if block_hash in self.block_cache:
+				return self.block_cache[block_hash]
+
+			block_info = yield from self.call_api_method_async('getblock', {'hash': block_hash})
+			coinbase = yield from self.get_transaction_async(block_info['tx'][0])
+			block_rewards = self.get_coinbase_value(coinbase)
+
+			if block_rewards == None:
+				transactions = yield from asyncio.gather(
+					*[self.get_transaction_async(tx_id) for tx_id in block_info['tx'][1:]]
+					)
+				block_rewards = sum([self.get_coinbase_value(tx_info) or 0 for tx_info in transactions])
+
+			info = self.compose_block_info(block_index, block_hash, block_info, block_rewards)
+		except:
+			return None
+
+		return info
+
+	def compose_block_info(self, block_index, block_hash, block_info, block_rewards):
+		if not block_rewards:
 			return None
 
+		info = {
+			'id': block_index,
+			'hash': block_hash,
+			'algo': self.detect_algo(block_info['versionHex']),
+			'rewards': block_rewards,
+			'difficulty': block_info['difficulty']
+			}
+
+		# blocks are immutable, keep the result by hash
+		self.block_cache[block_hash] = info
+		self.block_cache.move_to_end(block_hash)
+
+		while len(self.block_cache) > self.block_cache_size:
+			self.block_cache.popitem(last = False)
+
+		return info
+
+	def get_transaction(self, tx_id):
+		try:
+			return self.call_api_method('getrawtransaction', {'txid': "%s" % tx_id, 'decrypt': 1})
+		except:
+			return None
+
+	@asyncio.coroutine
+	def get_transaction_async(self, tx_id):
+		try:
+			result = yield from self.call_api_method_async('getrawtransaction', {'txid': "%s" % tx_id, 'decrypt': 1})
+		except:
+			result = None
+
+		return result
+
+	def get_coinbase_value(self, tx_info):
+		# sum of the outputs if the transaction is a coinbase one, None otherwise
+		try:
+			if 'vout' in tx_info and 'vin' in tx_info and len(tx_info['vin']):
+				if 'coinbase' in tx_info['vin'][0] and 'txid' not in tx_info['vin'][0]:
+					return sum([float(vout['value']) for vout in tx_info['vout']])
+		except:
+			pass
+
+		return None
+
+
+# Stub of the explorer API serving a synthetic chain, for tests and benchmarks
+# of the explorer client without hitting explorer.veles.network.
+class VelesStubExplorer(object):
+	addr = '127.0.0.1'
+	port = 8891
+	tx_per_block = 200
+	algos = ['00', '01', '02', '03', '04', '05']
+
+	def __init__(self, height = 1000, tx_per_block = None):
+		self.height = height
+		self.requests = 0
+		self.block_indexes = {self.block_hash(index): index for index in range(height + 1)}
+		self.coinbase_ids = set([self.tx_id(index, 0) for index in range(height + 1)])
+
+		if tx_per_block:
+			self.tx_per_block = tx_per_block
+
+	def block_hash(self, index):
+		return hashlib.sha256(b'block-%i' % int(index)).hexdigest()
+
+	def tx_id(self, index, n):
+		return hashlib.sha256(b'tx-%i-%i' % (index, n)).hexdigest()
+
+	@asyncio.coroutine
+	def handle(self, request):
+		self.requests += 1
+		method = request.match_info['method']
+		params = request.query
+
+		if method == 'getblockcount':
+			return web.Response(text = str(self.height + 1))
+
+		if method == 'getblockhash':
+			return web.Response(text = self.block_hash(params['index']))
+
+		if method == 'getblock':
+			index = self.block_indexes.get(params['hash'])
+
+			if index == None:
+				return web.Response(text = 'There was and error. Check your console.')
+
+			return web.json_response({
+				'hash': params['hash'],
+				'height': index,
+				'versionHex': '2000%s00' % self.algos[index % len(self.algos)],
+				'difficulty': 1000.0 + index,
+				'tx': [self.tx_id(index, n) for n in range(self.tx_per_block)]
+				})
+
+		if method == 'getrawtransaction':
+			txid = params['txid']
+			vin = [{'txid': txid, 'vout': 0}]
+
+			if txid in self.coinbase_ids:
+				vin = [{'coinbase': '03abcdef'}]
+
+			return web.json_response({'txid': txid, 'vin': vin, 'vout': [{'value': 2.5, 'n': 0}, {'value': 0.5, 'n': 1}]})
+
+		return web.Response(text = 'There was and error. Check your console.')
+
+	def make_app(self):
+		app = web.Application()
+		app.router.add_get('/api/{method}', self.handle)
+		return app
+
+	def run(self):
+		print("Running VelesStubExplorer at %s:%s" % (self.addr, str(self.port)))
+		web.run_app(self.make_app(), host = self.addr, port = self.port)
+
+# Basic commandline interface
+def main():
+	parser = argparse.ArgumentParser(description='Veles block explorer client')
+	parser.add_argument('--stub', action='store_true',
+			help='run the stub explorer API server')
+	parser.add_argument('--bench', type=int, default=0,
+			help='fetch info of the given number of blocks from the stub explorer and report the timing')
+	parser.add_argument('--port', type=int, default=VelesStubExplorer.port,
+			help='port of the stub explorer')
+	args = parser.parse_args()
+
+	stub = VelesStubExplorer()
+	stub.port = args.port
+
+	if args.stub:
+		stub.run()
+		return
+
+	if args.bench:
+		loop = asyncio.get_event_loop()
+		runner = web.AppRunner(stub.make_app())
+		loop.run_until_complete(runner.setup())
+		loop.run_until_complete(web.TCPSite(runner, stub.addr, stub.port).start())
+
+		explorer = VelesBlockExplorer()
+		explorer.api_url = 'http://%s:%i/api' % (stub.addr, stub.port)
+		started = time.time()
+
+		for index in range(stub.height - args.bench + 1, stub.height + 1):
+			loop.run_until_complete(explorer.get_last_block_info_async(index))
+
+		elapsed = time.time() - started
+		print(json.dumps({
+			'blocks': args.bench,
+			'tx_per_block': stub.tx_per_block,
+			'seconds': round(elapsed, 3),
+			'blocks_per_second': round(args.bench / elapsed, 1),
+			'upstream_requests': stub.requests
+			}))
+		loop.run_until_complete(explorer.http.close())
+		loop.run_until_complete(runner.cleanup())
 
+if __name__=='__main__':
+	main()
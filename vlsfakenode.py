@@ -0,0 +1,504 @@
+#!/usr/bin/python3
+#
+# Stand-in for the Veles Core JSON-RPC interface, for tests and benchmarks
+#
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+from aiohttp import web
+
+# Deterministic synthetic multi-algo chain. Everything is derived from the
+# seed: the algo of every block (encoded in the versionHex the same way as
+# VelesChainStatsDB.detect_algo reads it), per-algo difficulty drifting with
+# the blocks found, the block rewards halving every halving_interval blocks,
+# transactions spending earlier outputs to a pool of addresses, the mempool
+# (always the transactions of the next block) and a masternode list slowly
+# changing statuses, joining and leaving. Reorgs replace the last blocks with
+# a different branch, so the same seed and the same sequence of calls give
+# the same chain.
+class VelesChainGenerator(object):
+	algos = ['sha256d', 'scrypt', 'nist5', 'lyra2z', 'x11', 'x16r']
+	algo_weights = [10, 20, 15, 25, 15, 15]
+	genesis_time = 1546300800
+	block_time = 120
+	initial_reward = 5.0
+	halving_interval = 1051200
+	mn_collateral = 2000
+	address_count = 1000
+	mn_status_change_rates = {'ENABLED': 0.0005, 'PRE_ENABLED': 0.05, 'EXPIRED': 0.01, 'NEW_START_REQUIRED': 0.01}	# per block
+	mn_join_rate = 0.02	# per block
+
+	def __init__(self, seed = 1, tx_per_block = 2, masternodes = 100, halving_interval = None):
+		self.seed = seed
+		self.random = random.Random(seed)
+		self.tx_per_block = tx_per_block
+		self.branch = 0
+		self.tx_counter = 0
+		self.blocks = []
+		self.block_index = {}
+		self.transactions = {}
+		self.utxos = {}	# (txid, n) -> output
+		self.utxo_keys = []	# for picking random outputs in constant time
+		self.utxo_positions = {}
+		self.undo = []	# per block: spent and created outputs
+		self.mempool = {}
+		self.masternodes = {}
+		self.mn_counter = 0
+		self.difficulty = {algo: 1000.0 * (index + 1) for index, algo in enumerate(self.algos)}
+		self.last_algo_block = {algo: 0 for algo in self.algos}
+		self.addresses = ['V%s' % self.make_hash('address', index)[:33] for index in range(self.address_count)]
+
+		if halving_interval:
+			self.halving_interval = int(halving_interval)
+
+		for index in range(masternodes):
+			self.add_masternode('ENABLED')
+
+	def make_hash(self, *parts):
+		return hashlib.sha256(':'.join([str(self.seed)] + [str(part) for part in parts]).encode('utf-8')).hexdigest()
+
+	def get_reward(self, height):
+		return self.initial_reward / (2 ** (height // self.halving_interval))
+
+	def make_tx(self, height, inputs, outputs):
+		self.tx_counter += 1
+		txid = self.make_hash('tx', self.branch, height, self.tx_counter)
+		size = 10 + 148 * len(inputs) + 34 * len(outputs)
+		vin = []
+
+		for utxo in inputs:
+			if 'coinbase' in utxo:
+				vin += [{'coinbase': utxo['coinbase'], 'sequence': 4294967295}]
+			else:
+				vin += [{'txid': utxo['txid'], 'vout': utxo['n'], 'scriptSig': {'asm': '', 'hex': ''}, 'sequence': 4294967295}]
+
+		vout = []
+
+		for n, (address, value) in enumerate(outputs):
+			vout += [{
+				'value': round(value, 8),
+				'n': n,
+				'scriptPubKey': {'type': 'pubkeyhash', 'reqSigs': 1, 'addresses': [address]}
+				}]
+
+		return {
+			'txid': txid,
+			'hash': txid,
+			'version': 2,
+			'size': size,
+			'vsize': size,
+			'weight': self.tx_counter * 4,	# unique, the stats schema has a unique key on it
+			'locktime': 0,
+			'vin': vin,
+			'vout': vout
+			}
+
+	def make_payment(self, height):
+		# spends one or two random outputs to two random addresses
+		if not self.utxos:
+			return None
+
+		inputs = []
+
+		for index in range(min(len(self.utxos), self.random.randint(1, 2))):
+			inputs += [self.pop_utxo(self.utxo_keys[self.random.randrange(len(self.utxo_keys))])]
+
+		total = sum([utxo['value'] for utxo in inputs]) - 0.0001
+
+		if total <= 0:
+			for utxo in reversed(inputs):
+				self.add_utxo(utxo)
+
+			return None
+
+		split = self.random.random()
+		outputs = [(self.random.choice(self.addresses), total * split), (self.random.choice(self.addresses), total * (1 - split))]
+		tx = self.make_tx(height, inputs, outputs)
+		tx['spent'] = inputs
+		self.add_outputs(tx)
+		return tx
+
+	def add_utxo(self, utxo):
+		key = (utxo['txid'], utxo['n'])
+		self.utxos[key] = utxo
+		self.utxo_positions[key] = len(self.utxo_keys)
+		self.utxo_keys += [key]
+
+	def pop_utxo(self, key):
+		# swaps the last key into the place of the removed one
+		position = self.utxo_positions.pop(key)
+		last = self.utxo_keys.pop()
+
+		if last != key:
+			self.utxo_keys[position] = last
+			self.utxo_positions[last] = position
+
+		return self.utxos.pop(key)
+
+	def add_outputs(self, tx):
+		for vout in tx['vout']:
+			self.add_utxo({'txid': tx['txid'], 'n': vout['n'], 'value': vout['value']})
+
+	def remove_outputs(self, tx):
+		for vout in tx['vout']:
+			self.pop_utxo((tx['txid'], vout['n']))
+
+		for utxo in reversed(tx.get('spent', [])):
+			self.add_utxo(utxo)
+
+	def fill_mempool(self, height):
+		for index in range(self.tx_per_block):
+			tx = self.make_payment(height)
+
+			if tx:
+				self.mempool[tx['txid']] = tx
+
+	def clear_mempool(self):
+		for tx in reversed(list(self.mempool.values())):
+			self.remove_outputs(tx)
+
+		self.mempool = {}
+
+	def mine_block(self):
+		height = len(self.blocks)
+		previous = self.blocks[-1] if self.blocks else None
+		algo = self.random.choices(self.algos, self.algo_weights)[0]
+		algo_index = self.algos.index(algo)
+		reward = self.get_reward(height)
+		coinbase = self.make_tx(height, [{'coinbase': '%06x%08x' % (height, self.branch)}], [
+			(self.random.choice(self.addresses), reward * 0.55),
+			(self.random.choice(self.addresses), reward * 0.45)
+			])
+		self.add_outputs(coinbase)
+		txs = [coinbase] + list(self.mempool.values())
+		self.mempool = {}
+
+		# difficulty of the algo drifts up or down with every block it finds
+		self.difficulty[algo] = round(self.difficulty[algo] * self.random.uniform(0.95, 1.05), 8)
+		self.last_algo_block[algo] = height
+		block_time = (previous['time'] if previous else self.genesis_time) + int(self.random.expovariate(1.0 / self.block_time)) + 1
+		block_hash = self.make_hash('block', self.branch, height)
+		size = sum([tx['size'] for tx in txs]) + 80
+		block = {
+			'hash': block_hash,
+			'strippedsize': size,
+			'size': size,
+			'weight': size * 4,
+			'height': height,
+			'version': 0x20000000 | (algo_index << 8),
+			'versionHex': '2000%02x00' % algo_index,
+			'merkleroot': self.make_hash('merkle', block_hash),
+			'tx': [{key: value for key, value in tx.items() if key != 'spent'} for tx in txs],
+			'time': block_time,
+			'mediantime': block_time,
+			'nonce': self.random.getrandbits(32),
+			'bits': '1d00ffff',
+			'difficulty': self.difficulty[algo],
+			'chainwork': '%064x' % (int(previous['chainwork'], 16) + int(self.difficulty[algo]) if previous else 1),
+			'nTx': len(txs),
+			'previousblockhash': previous['hash'] if previous else '0' * 64,
+			'nextblockhash': None
+			}
+
+		if previous:
+			previous['nextblockhash'] = block_hash
+
+		self.blocks += [block]
+		self.block_index[block_hash] = block
+		self.undo += [txs]
+
+		for tx in block['tx']:
+			self.transactions[tx['txid']] = tx
+
+		self.evolve_masternodes()
+		self.fill_mempool(height + 1)
+		return block
+
+	def generate(self, count = 1):
+		return [self.mine_block()['hash'] for index in range(int(count))]
+
+	def reorg(self, depth = 1):
+		# disconnects the last depth blocks and mines depth + 1 on a new branch,
+		# the transactions of the disconnected blocks are dropped
+		depth = min(int(depth), len(self.blocks) - 1)
+		self.clear_mempool()
+
+		for index in range(depth):
+			block = self.blocks.pop()	# stays in block_index, nodes keep the stale blocks
+
+			for tx in reversed(self.undo.pop()):
+				self.transactions.pop(tx['txid'], None)
+				self.remove_outputs(tx)
+
+		self.blocks[-1]['nextblockhash'] = None
+		self.branch += 1
+		self.fill_mempool(len(self.blocks))
+		return self.generate(depth + 1)
+
+	def add_masternode(self, status):
+		self.mn_counter += 1
+		outpoint = '%s-%i' % (self.make_hash('collateral', self.mn_counter), self.mn_counter % 2)
+		self.masternodes[outpoint] = {
+			'status': status,
+			'address': '10.%i.%i.%i:25522' % (self.mn_counter // 65536 % 256, self.mn_counter // 256 % 256, self.mn_counter % 256),
+			'payee': self.random.choice(self.addresses)
+			}
+
+	def evolve_masternodes(self):
+		transitions = {
+			'ENABLED': ['EXPIRED', 'NEW_START_REQUIRED'],
+			'PRE_ENABLED': ['ENABLED'],
+			'EXPIRED': ['NEW_START_REQUIRED', 'ENABLED'],
+			'NEW_START_REQUIRED': ['PRE_ENABLED', None]	# None leaves the list
+			}
+
+		for outpoint in sorted(self.masternodes.keys()):
+			if self.random.random() < self.mn_status_change_rates[self.masternodes[outpoint]['status']]:
+				status = self.random.choice(transitions[self.masternodes[outpoint]['status']])
+
+				if status:
+					self.masternodes[outpoint]['status'] = status
+				else:
+					del self.masternodes[outpoint]
+
+		if self.random.random() < self.mn_join_rate:
+			self.add_masternode('PRE_ENABLED')
+
+	def tip(self):
+		return self.blocks[-1]
+
+# Serves a VelesChainGenerator chain over JSON-RPC, answering the calls the
+# server and the ingest code make. New blocks come from the regtest style
+# 'generate' call or every block_interval seconds on average, with a chance
+# of a reorg of up to reorg_depth blocks instead. rpc_call() answers the same
+# calls in-process, a drop-in replacement of VelesRPCClient for benchmarks.
+class VelesFakeNode(object):
+	addr = '127.0.0.1'
+	port = 25599
+
+	def __init__(self, height = 1000, masternodes = 100, seed = 1, tx_per_block = 2,
+			block_interval = 0, reorg_probability = 0, reorg_depth = 3, halving_interval = None):
+		self.chain = VelesChainGenerator(seed, tx_per_block, masternodes, halving_interval)
+		self.random = random.Random(seed)	# mining schedule, separate from the chain contents
+		self.block_interval = block_interval
+		self.reorg_probability = reorg_probability
+		self.reorg_depth = reorg_depth
+		self.requests = 0
+		self.chain.generate(height + 1)
+
+	def mine(self):
+		if self.reorg_probability and self.random.random() < self.reorg_probability:
+			return self.chain.reorg(self.random.randint(1, self.reorg_depth))
+
+		return self.chain.generate(1)
+
+	@asyncio.coroutine
+	def mining_task(self):
+		while True:
+			yield from asyncio.sleep(self.random.expovariate(1.0 / self.block_interval))
+			self.mine()
+
+	def get_block(self, block_hash, verbosity = 1):
+		block = self.chain.block_index[block_hash]
+		result = dict(block)
+		result['confirmations'] = self.chain.tip()['height'] - block['height'] + 1
+
+		if block['height'] >= len(self.chain.blocks) or self.chain.blocks[block['height']] is not block:	# stale, off the main chain
+			result['confirmations'] = -1
+
+		if verbosity != 2:
+			result['tx'] = [tx['txid'] for tx in block['tx']]
+
+		return result
+
+	## RPC methods, rpc_<method>(*params)
+	def rpc_getblockchaininfo(self):
+		tip = self.chain.tip()
+		return {
+			'chain': 'main',
+			'blocks': tip['height'],
+			'headers': tip['height'],
+			'bestblockhash': tip['hash'],
+			'difficulty': tip['difficulty'],
+			'mediantime': tip['mediantime'],
+			'chainwork': tip['chainwork']
+			}
+
+	def rpc_getinfo(self):
+		return {'version': 1000000, 'blocks': self.chain.tip()['height'], 'connections': 8}
+
+	def rpc_getblockcount(self):
+		return self.chain.tip()['height']
+
+	def rpc_getbestblockhash(self):
+		return self.chain.tip()['hash']
+
+	def rpc_getblockhash(self, height):
+		return self.chain.blocks[int(height)]['hash']
+
+	def rpc_getblock(self, block_hash, verbosity = 1):
+		return self.get_block(block_hash, verbosity)
+
+	def rpc_getrawtransaction(self, txid, verbose = False):
+		if txid in self.chain.mempool:
+			return {key: value for key, value in self.chain.mempool[txid].items() if key != 'spent'}
+
+		return self.chain.transactions[txid]
+
+	def rpc_getmultialgostatus(self):
+		result = []
+
+		for algo in self.chain.algos:
+			result += [{
+				'algo': algo,
+				'difficulty': self.chain.difficulty[algo],
+				'hashrate': int(self.chain.difficulty[algo] * 2 ** 32 / (self.chain.block_time * len(self.chain.algos))),
+				'last_block_index': self.chain.last_algo_block[algo]
+				}]
+
+		return result
+
+	def rpc_gethalvingstatus(self):
+		height = self.chain.tip()['height']
+		epochs = []
+
+		for epoch in range(height // self.chain.halving_interval + 1):
+			epochs += [{
+				'epoch': epoch,
+				'started_at_block': epoch * self.chain.halving_interval,
+				'max_block_reward': self.chain.get_reward(epoch * self.chain.halving_interval)
+				}]
+
+		return {'halving_interval': self.chain.halving_interval, 'epochs': epochs}
+
+	def rpc_masternodelist(self, mode = 'status'):
+		if mode == 'json':
+			return self.chain.masternodes
+
+		if mode == 'addr':
+			return {outpoint: node['address'] for outpoint, node in self.chain.masternodes.items()}
+
+		if mode == 'payee':
+			return {outpoint: node['payee'] for outpoint, node in self.chain.masternodes.items()}
+
+		return {outpoint: node['status'] for outpoint, node in self.chain.masternodes.items()}
+
+	def rpc_masternode(self, command):
+		if command == 'collateral':
+			return self.chain.mn_collateral
+
+		if command == 'count':
+			return len(self.chain.masternodes)
+
+		return self.rpc_masternodelist()
+
+	def rpc_gettxoutsetinfo(self):
+		return {
+			'height': self.chain.tip()['height'],
+			'bestblock': self.chain.tip()['hash'],
+			'txouts': len(self.chain.utxos),
+			'total_amount': round(sum([utxo['value'] for utxo in self.chain.utxos.values()]), 8)
+			}
+
+	def rpc_getrawmempool(self, verbose = False):
+		if verbose:
+			return {txid: self.rpc_getmempoolentry(txid) for txid in self.chain.mempool.keys()}
+
+		return list(self.chain.mempool.keys())
+
+	def rpc_getmempoolentry(self, txid):
+		tx = self.chain.mempool[txid]
+		fee = round(sum([utxo['value'] for utxo in tx['spent']]) - sum([vout['value'] for vout in tx['vout']]), 8)
+		return {'vsize': tx['vsize'], 'size': tx['size'], 'fee': fee, 'fees': {'base': fee}, 'time': self.chain.tip()['time']}
+
+	def rpc_generate(self, count = 1):
+		return self.chain.generate(count)
+
+	def rpc_reorg(self, depth = 1):
+		# not a Veles Core call, replaces the last depth blocks by a new branch
+		return self.chain.reorg(depth)
+
+	@staticmethod
+	def error(code, message, request_id):
+		return {'result': None, 'error': {'code': code, 'message': message}, 'id': request_id}
+
+	def dispatch(self, payload):
+		self.requests += 1
+		method = getattr(self, 'rpc_%s' % payload.get('method'), None)
+
+		if not method:
+			return self.error(-32601, 'Method not found', payload.get('id'))
+
+		try:
+			return {'result': method(*payload.get('params', [])), 'error': None, 'id': payload.get('id')}
+		except KeyError as e:
+			return self.error(-5, 'Not found: %s' % e, payload.get('id'))
+		except (IndexError, TypeError, ValueError) as e:
+			return self.error(-8, 'Invalid parameter: %s' % e, payload.get('id'))
+
+	def rpc_call(self, method, params = [], priority = None, client = None):
+		# same results as VelesRPCClient.rpc_call, copied through JSON like over the wire
+		response = json.loads(json.dumps(self.dispatch({'method': method, 'params': params, 'id': 0})))
+
+		if response['error'] != None:
+			return response
+
+		return response['result']
+
+	@asyncio.coroutine
+	def handle_rpc(self, request):
+		try:
+			payload = json.loads((yield from request.text()))
+		except ValueError:
+			return web.json_response(self.error(-32700, 'Parse error', None), status = 500)
+
+		result = self.dispatch(payload)
+		return web.json_response(result, status = 500 if result['error'] else 200)
+
+	@asyncio.coroutine
+	def start_mining(self, app):
+		if self.block_interval:
+			app['mining_task'] = asyncio.ensure_future(self.mining_task())
+
+	def make_app(self):
+		app = web.Application()
+		app.router.add_post('/', self.handle_rpc)
+		app.on_startup.append(self.start_mining)
+		return app
+
+	def run(self):
+		web.run_app(self.make_app(), host = self.addr, port = self.port)
+
+# Basic commandline interface
+def main():
+	parser = argparse.ArgumentParser(description='Fake Veles Core JSON-RPC daemon')
+	parser.add_argument('--port', type=int, default=VelesFakeNode.port,
+			help='port to listen on')
+	parser.add_argument('--height', type=int, default=1000,
+			help='initial chain height')
+	parser.add_argument('--masternodes', type=int, default=100,
+			help='initial number of masternodes')
+	parser.add_argument('--seed', type=int, default=1,
+			help='seed of the synthetic chain')
+	parser.add_argument('--tx-per-block', type=int, default=2,
+			help='transactions per block apart of the coinbase')
+	parser.add_argument('--block-interval', type=float, default=0,
+			help='average seconds between mined blocks, 0 mines only on the generate call')
+	parser.add_argument('--reorg-probability', type=float, default=0,
+			help='chance of a reorg instead of a new block')
+	parser.add_argument('--reorg-depth', type=int, default=3,
+			help='maximum depth of the reorgs')
+	parser.add_argument('--halving-interval', type=int,
+			help='blocks between the block reward halvings')
+	args = parser.parse_args()
+
+	node = VelesFakeNode(args.height, args.masternodes, args.seed, args.tx_per_block,
+		args.block_interval, args.reorg_probability, args.reorg_depth, args.halving_interval)
+	node.port = args.port
+	node.run()
+
+if __name__=='__main__':
+	main()
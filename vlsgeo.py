@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#
+# Approximate geo-location of masternode IP addresses
+#
+import asyncio
+import json
+import os
+import time
+
+import vlshttp
+import vlslog
+
+try:
+	import geoip2.database
+	import geoip2.errors
+except ImportError:
+	geoip2 = None
+
+# Resolves IP addresses to approximate locations in the ip-api.com format.
+# Results are kept in a JSON cache file with a TTL, so restarts don't start
+# from scratch. Lookups go to a local offline GeoIP2/GeoLite2 City database
+# first when one is configured (needs the optional geoip2 package), the rest
+# is resolved by the ip-api.com batch endpoint, 100 addresses per request,
+# with as many requests in flight as the rate limit allows.
+class VelesGeoResolver(object):
+	batch_url = 'http://ip-api.com/batch'
+	batch_size = 100
+	rate_limit = 15		# requests per rate_period, ip-api.com free tier limit
+	rate_period = 60
+	ttl = 7*24*3600
+	negative_ttl = 24*3600
+
+	def __init__(self, http, cache_file = None, database = None, ttl = None):
+		self.http = http
+		self.cache_file = cache_file
+		self.cache = {}
+		self.request_times = []
+		self.reader = None
+
+		if ttl:
+			self.ttl = int(ttl)
+
+		if database:
+			if geoip2:
+				self.reader = geoip2.database.Reader(database)
+			else:
+				vlslog.logger.warning('geoip2 package not installed, offline GeoIP database %s ignored', database)
+
+		self.load_cache()
+
+	def get_cached(self, ip):
+		if ip in self.cache and self.cache[ip]['expires'] > time.time():
+			return self.cache[ip]['location']
+
+		return None
+
+	@asyncio.coroutine
+	def resolve_many(self, ips):
+		result = {}
+		missing = []
+
+		for ip in set(ips):
+			location = self.get_cached(ip)
+
+			if location == None:
+				location = self.lookup_offline(ip)
+
+				if location:
+					self.store(ip, location)
+
+			if location == None:
+				missing += [ip]
+			elif location.get('status') == 'success':
+				result[ip] = location
+
+		batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+		responses = yield from asyncio.gather(*[self.resolve_batch(batch) for batch in batches])
+
+		for locations in responses:
+			result.update(locations)
+
+		if missing:
+			self.save_cache()
+
+		return result
+
+	@asyncio.coroutine
+	def resolve_batch(self, ips):
+		result = {}
+		yield from self.wait_for_rate_limit()
+
+		try:
+			locations = yield from self.http.post_json(self.batch_url, ips)
+		except vlshttp.UpstreamError as e:
+			vlslog.logger.error('Error resolving locations: %s', e)
+			return result
+
+		for location in locations:
+			if not isinstance(location, dict) or not 'query' in location:
+				continue
+
+			if location.get('status') == 'success':
+				self.store(location['query'], location)
+				result[location['query']] = location
+			else:
+				self.store(location['query'], location, self.negative_ttl)
+
+		return result
+
+	@asyncio.coroutine
+	def wait_for_rate_limit(self):
+		while True:
+			now = time.time()
+			self.request_times = [t for t in self.request_times if t > now - self.rate_period]
+
+			if len(self.request_times) < self.rate_limit:
+				self.request_times += [now]
+				return
+
+			yield from asyncio.sleep(self.request_times[0] + self.rate_period - now)
+
+	def lookup_offline(self, ip):
+		if not self.reader:
+			return None
+
+		try:
+			response = self.reader.city(ip)
+		except (geoip2.errors.AddressNotFoundError, ValueError):
+			return None
+
+		return {
+			'status': 'success',
+			'query': ip,
+			'country': response.country.name,
+			'countryCode': response.country.iso_code,
+			'regionName': response.subdivisions.most_specific.name,
+			'city': response.city.name,
+			'lat': response.location.latitude,
+			'lon': response.location.longitude,
+			'timezone': response.location.time_zone,
+			}
+
+	def store(self, ip, location, ttl = None):
+		self.cache[ip] = {'location': location, 'expires': time.time() + (ttl if ttl else self.ttl)}
+
+	def load_cache(self):
+		if not self.cache_file or not os.path.isfile(self.cache_file):
+			return
+
+		try:
+			with open(self.cache_file) as f:
+				self.cache = json.load(f)
+		except (IOError, ValueError) as e:
+			vlslog.logger.error('Error loading geo-location cache %s: %s', self.cache_file, e)
+
+	def save_cache(self):
+		if not self.cache_file:
+			return
+
+		now = time.time()
+		self.cache = {ip: entry for ip, entry in self.cache.items() if entry['expires'] > now}
+
+		try:
+			with open(self.cache_file + '.tmp', 'w') as f:
+				json.dump(self.cache, f)
+
+			os.replace(self.cache_file + '.tmp', self.cache_file)
+		except IOError as e:
+			vlslog.logger.error('Error saving geo-location cache %s: %s', self.cache_file, e)
+
+# Spatial aggregation of the resolved locations for the map: locations are
+# bucketed into a lat/lon grid at every zoom level (cell size halves with every
+# level), each bucket reported as its count and centroid. Everything is
+# precomputed on update(), so serving the map is a dictionary lookup.
+class VelesGeoClusters(object):
+	max_zoom = 10
+
+	def __init__(self):
+		self.points = []
+		self.clusters = {}
+		self.update({})
+
+	def update(self, locations):
+		points = []
+
+		for ip, location in locations.items():
+			# the offline database may know the country but not the coordinates
+			if location and location.get('lat') != None and location.get('lon') != None:
+				points += [{'lat': location['lat'], 'lon': location['lon']}]
+
+		clusters = {}
+
+		for zoom in range(self.max_zoom + 1):
+			clusters[zoom] = self.aggregate(points, zoom)
+
+		self.points = points
+		self.clusters = clusters
+
+	def aggregate(self, points, zoom):
+		cell_size = 180.0 / (2 ** zoom)
+		buckets = {}
+
+		for point in points:
+			cell = (int((point['lat'] + 90) // cell_size), int((point['lon'] + 180) // cell_size))
+
+			if cell not in buckets:
+				buckets[cell] = [0, 0.0, 0.0]
+
+			buckets[cell][0] += 1
+			buckets[cell][1] += point['lat']
+			buckets[cell][2] += point['lon']
+
+		result = []
+
+		for count, lat_sum, lon_sum in buckets.values():
+			result += [{
+				'lat': round(lat_sum / count, 4),
+				'lon': round(lon_sum / count, 4),
+				'count': count
+				}]
+
+		return result
+
+	def get(self, zoom = None):
+		# no zoom means all the individual points, deeper zooms than
+		# precomputed get the finest clusters
+		if zoom == None:
+			return self.points
+
+		return self.clusters[min(self.max_zoom, max(0, int(zoom)))]
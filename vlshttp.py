@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+#
+# Shared asynchronous client for outbound HTTP requests (market data, block
+# explorer, geo-location services, ...)
+#
+import asyncio
+import collections
+import json
+import random
+import time
+import urllib.parse
+
+import aiohttp
+
+class UpstreamError(IOError):
+	'''raise this when an upstream service fails and there's no last good value to serve'''
+
+# Classic three state circuit breaker: after failure_threshold consecutive
+# failures the circuit opens and requests fail fast, after reset_timeout one
+# trial request is let through (half-open) and its result closes or re-opens it.
+class VelesCircuitBreaker(object):
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, failure_threshold = 5, reset_timeout = 60):
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.failures = 0
+		self.opened_at = None
+		self.trial_running = False
+
+	def state(self):
+		if self.opened_at == None:
+			return self.CLOSED
+
+		if time.time() - self.opened_at >= self.reset_timeout:
+			return self.HALF_OPEN
+
+		return self.OPEN
+
+	def allow(self):
+		state = self.state()
+
+		if state == self.CLOSED:
+			return True
+
+		if state == self.HALF_OPEN and not self.trial_running:
+			self.trial_running = True
+			return True
+
+		return False
+
+	def record_success(self):
+		self.failures = 0
+		self.opened_at = None
+		self.trial_running = False
+
+	def record_failure(self):
+		self.failures += 1
+		self.trial_running = False
+
+		if self.failures >= self.failure_threshold or self.opened_at != None:
+			self.opened_at = time.time()
+
+# Outbound HTTP client with connection reuse, a concurrency limit per host,
+# strict timeouts, retries with exponential backoff and a circuit breaker per
+# host. While a host is unhealthy the last good value of the same request is
+# served instead, if there's any.
+class VelesHttpClient(object):
+	timeout = 10
+	connect_timeout = 5
+	retries = 2
+	backoff = 0.5
+	limit_per_host = 4
+	failure_threshold = 5
+	reset_timeout = 60
+	max_last_good = 1024
+	retry_statuses = [429, 500, 502, 503, 504]
+	headers = {'User-Agent': 'veles-webapi'}
+
+	def __init__(self, timeout = None, retries = None, limit_per_host = None):
+		if timeout != None:
+			self.timeout = timeout
+		if retries != None:
+			self.retries = retries
+		if limit_per_host != None:
+			self.limit_per_host = limit_per_host
+
+		self.session = None
+		self.breakers = {}
+		self.last_good = collections.OrderedDict()
+
+	@asyncio.coroutine
+	def get_json(self, url, params = None):
+		result = yield from self.request('GET', url, params = params, parse = json.loads)
+		return result
+
+	@asyncio.coroutine
+	def get_text(self, url, params = None):
+		result = yield from self.request('GET', url, params = params)
+		return result
+
+	@asyncio.coroutine
+	def post_json(self, url, payload, params = None):
+		result = yield from self.request('POST', url, params = params, data = json.dumps(payload), parse = json.loads)
+		return result
+
+	@asyncio.coroutine
+	def request(self, method, url, params = None, data = None, parse = None):
+		key = json.dumps([method, url, params, data], sort_keys = True)
+		breaker = self.get_breaker(url)
+
+		if not breaker.allow():
+			return self.serve_last_good(key, 'Circuit open for %s' % url)
+
+		recorded = False
+
+		try:
+			for attempt in range(self.retries + 1):
+				if attempt:
+					yield from asyncio.sleep(self.backoff * (2 ** (attempt - 1)) * (1 + random.random()))
+
+				try:
+					text = yield from self.fetch(method, url, params, data)
+					result = parse(text) if parse else text
+				except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+					error = e
+					continue
+
+				recorded = True
+				breaker.record_success()
+				self.store_last_good(key, result)
+				return result
+
+			recorded = True
+			breaker.record_failure()
+			return self.serve_last_good(key, 'Request to %s failed: %s' % (url, error))
+		finally:
+			# cancelled or failed otherwise, a half-open trial counts as failed
+			# so the next one is let through after the timeout again
+			if not recorded and breaker.trial_running:
+				breaker.record_failure()
+
+	@asyncio.coroutine
+	def fetch(self, method, url, params = None, data = None):
+		response = yield from self.get_session().request(method, url, params = params, data = data)
+
+		try:
+			if response.status in self.retry_statuses:
+				raise aiohttp.ClientResponseError(
+					response.request_info, response.history, status = response.status, message = response.reason
+					)
+
+			text = yield from response.text()
+		finally:
+			response.release()
+
+		return text
+
+	def get_session(self):
+		if not self.session or self.session.closed:
+			self.session = aiohttp.ClientSession(
+				connector = aiohttp.TCPConnector(limit_per_host = self.limit_per_host),
+				timeout = aiohttp.ClientTimeout(total = self.timeout, connect = self.connect_timeout),
+				headers = self.headers
+				)
+
+		return self.session
+
+	def get_breaker(self, url):
+		host = urllib.parse.urlparse(url).hostname
+
+		if host not in self.breakers:
+			self.breakers[host] = VelesCircuitBreaker(self.failure_threshold, self.reset_timeout)
+
+		return self.breakers[host]
+
+	def store_last_good(self, key, value):
+		self.last_good[key] = value
+		self.last_good.move_to_end(key)
+
+		while len(self.last_good) > self.max_last_good:
+			self.last_good.popitem(last = False)
+
+	def serve_last_good(self, key, message):
+		if key in self.last_good:
+			return self.last_good[key]
+
+		raise UpstreamError(message)
+
+	@asyncio.coroutine
+	def close(self):
+		if self.session:
+			yield from self.session.close()
+
+
+# Self-test against a local stub server
+if __name__ == "__main__":
+
+	import unittest
+	from aiohttp import web
+
+	class TestHttpClient(unittest.TestCase):
+
+		def setUp(self):
+			self.loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(self.loop)
+			self.hits = 0
+			self.healthy = True
+			self.delay = 0
+
+			@asyncio.coroutine
+			def handle(request):
+				self.hits += 1
+				yield from asyncio.sleep(self.delay)
+
+				if not self.healthy:
+					return web.Response(status = 503)
+
+				return web.json_response({'hits': self.hits})
+
+			app = web.Application()
+			app.router.add_get('/', handle)
+			self.runner = web.AppRunner(app)
+			self.loop.run_until_complete(self.runner.setup())
+			site = web.TCPSite(self.runner, '127.0.0.1', 0)
+			self.loop.run_until_complete(site.start())
+			self.url = 'http://127.0.0.1:%i/' % site._server.sockets[0].getsockname()[1]
+			self.client = VelesHttpClient(timeout = 0.5, retries = 1)
+			self.client.backoff = 0.01
+
+		def tearDown(self):
+			self.loop.run_until_complete(self.client.close())
+			self.loop.run_until_complete(self.runner.cleanup())
+			self.loop.close()
+
+		def test_get_json(self):
+			result = self.loop.run_until_complete(self.client.get_json(self.url))
+			self.assertEqual({'hits': 1}, result)
+
+		def test_retry_then_fail(self):
+			self.healthy = False
+			with self.assertRaises(UpstreamError):
+				self.loop.run_until_complete(self.client.get_json(self.url))
+			self.assertEqual(2, self.hits)
+
+		def test_timeout(self):
+			self.delay = 1
+			started = time.time()
+			with self.assertRaises(UpstreamError):
+				self.loop.run_until_complete(self.client.get_json(self.url))
+			self.assertLess(time.time() - started, 1.5)
+
+		def test_circuit_breaker_serves_last_good(self):
+			self.client.failure_threshold = 2
+			self.loop.run_until_complete(self.client.get_json(self.url))
+			self.healthy = False
+
+			for i in range(2):
+				result = self.loop.run_until_complete(self.client.get_json(self.url))
+				self.assertEqual({'hits': 1}, result)
+
+			hits = self.hits
+			result = self.loop.run_until_complete(self.client.get_json(self.url))
+			self.assertEqual({'hits': 1}, result)
+			self.assertEqual(hits, self.hits)	# circuit open, upstream not hit
+
+		def test_cancelled_trial_reopens(self):
+			self.client.failure_threshold = 1
+			self.client.reset_timeout = 0.1
+			self.healthy = False
+
+			with self.assertRaises(UpstreamError):
+				self.loop.run_until_complete(self.client.get_json(self.url))
+
+			# half-open trial cancelled while waiting for the upstream
+			self.loop.run_until_complete(asyncio.sleep(0.15))
+			self.healthy = True
+			self.delay = 0.3
+			trial = asyncio.ensure_future(self.client.get_json(self.url))
+			self.loop.run_until_complete(asyncio.sleep(0.1))
+			trial.cancel()
+
+			with self.assertRaises(asyncio.CancelledError):
+				self.loop.run_until_complete(trial)
+
+			# the next trial after the timeout goes through and closes it
+			self.loop.run_until_complete(asyncio.sleep(0.15))
+			self.delay = 0
+			hits = self.hits
+			result = self.loop.run_until_complete(self.client.get_json(self.url))
+			self.assertEqual(hits + 1, self.hits)
+			self.assertEqual({'hits': self.hits}, result)
+			self.assertEqual(VelesCircuitBreaker.CLOSED, self.client.get_breaker(self.url).state())
+
+	unittest.main(verbosity=2)
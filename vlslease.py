@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+#
+# Leader election of the pollers between several server instances
+#
+import abc
+import asyncio
+import concurrent.futures
+import fcntl
+import json
+import os
+import socket
+import time
+import uuid
+
+from sqlalchemy import create_engine, or_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import Column
+from sqlalchemy.sql import func
+from sqlalchemy.types import Float, String, Text
+from sqlalchemy.dialects.mysql import BIGINT
+
+import vlslog
+import vlsmetrics
+
+leader_gauge = vlsmetrics.registry.gauge('veles_poller_leader', 'Whether this instance holds the poller lease')
+leader_changes = vlsmetrics.registry.counter('veles_poller_leader_changes_total', 'Poller lease acquisitions and losses', ['change'])
+
+Base = declarative_base()
+
+class PollerLease(Base):
+	__tablename__ = 'poller_lease'
+	name = Column(String(64), primary_key=True)
+	holder = Column(String(128), nullable=False)
+	expires_at = Column(Float, nullable=False)
+
+class PollerMessage(Base):
+	__tablename__ = 'poller_message'
+	id = Column(BIGINT, primary_key=True, autoincrement=True)
+	source = Column(String(128), nullable=False)
+	key = Column(String(255), nullable=True)
+	created_at = Column(Float, nullable=False)
+	payload = Column(Text, nullable=False)
+
+def create_engine_from_config(host, port, username, password, database):
+	return create_engine('mysql+pymysql://%s:%s@%s:%i/%s' % (username, password, host, int(port), database))
+
+# Base of the leases: the holder id, the renewal loop and the role callbacks.
+# The leader renews every ttl/3 seconds, the others try to take over as often,
+# so a dead leader is replaced within ttl + ttl/3 seconds (immediately when it
+# shuts down cleanly and releases the lease). A renewal is valid for ttl
+# seconds from when it was sent, the leader steps down on a timer safety
+# seconds before that unless renewed meanwhile, so a hung or slow renewal
+# can't keep it polling after another instance could have taken over.
+class VelesLease(abc.ABC):
+	name = 'pollers'
+	ttl = 10
+	safety = 0.1	# fraction of the ttl
+
+	def __init__(self, name = None, ttl = None):
+		if name:
+			self.name = name
+
+		if ttl:
+			self.ttl = float(ttl)
+
+		self.holder = '%s:%i:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.is_leader = False
+		self.expiry_timer = None
+
+	@abc.abstractmethod
+	def try_acquire(self):
+		pass
+
+	@abc.abstractmethod
+	def release(self):
+		pass
+
+	def set_leader(self, is_leader, on_elected, on_demoted):
+		if is_leader == self.is_leader:
+			return
+
+		self.is_leader = is_leader
+		leader_gauge.set(1 if is_leader else 0)
+		leader_changes.inc(change='elected' if is_leader else 'demoted')
+		vlslog.logger.info('Poller lease %s %s by %s', self.name, 'acquired' if is_leader else 'lost', self.holder)
+
+		if is_leader:
+			on_elected()
+		else:
+			on_demoted()
+
+	@asyncio.coroutine
+	def run_task(self, on_elected, on_demoted):
+		loop = asyncio.get_event_loop()
+
+		while True:
+			started = loop.time()
+
+			try:
+				# a hung call keeps the executor busy, the next ones time out too
+				acquired = yield from asyncio.wait_for(loop.run_in_executor(self.executor, self.try_acquire), self.ttl / 3)
+			except asyncio.TimeoutError:
+				vlslog.logger.error('Poller lease renewal timed out')
+				acquired = False
+			except Exception as e:
+				vlslog.logger.error('Error renewing the poller lease: %s', e)
+				acquired = False
+
+			if self.expiry_timer:
+				self.expiry_timer.cancel()
+				self.expiry_timer = None
+
+			# the lease is valid until started + ttl, step down a bit earlier
+			deadline = started + self.ttl * (1 - self.safety)
+			acquired = acquired and loop.time() < deadline
+
+			if acquired:
+				self.expiry_timer = loop.call_at(deadline, self.set_leader, False, on_elected, on_demoted)
+
+			self.set_leader(acquired, on_elected, on_demoted)
+			yield from asyncio.sleep(self.ttl / 3)
+
+# Lease row in the shared database, for instances on different hosts. Taking
+# over is a single conditional UPDATE (held by us or expired), the INSERT only
+# happens once for a new lease name and the primary key lets just one of the
+# racing instances win. The expiry is set and compared in the database time,
+# the clocks of the hosts don't matter.
+class VelesDatabaseLease(VelesLease):
+	def __init__(self, engine, name = None, ttl = None):
+		super().__init__(name, ttl)
+		self.engine = engine
+
+	def try_acquire(self):
+		now = func.unix_timestamp(func.now(6))
+
+		with self.engine.begin() as connection:
+			result = connection.execute(PollerLease.__table__.update()
+				.where(PollerLease.name == self.name)
+				.where(or_(PollerLease.holder == self.holder, PollerLease.expires_at < now))
+				.values(holder = self.holder, expires_at = now + self.ttl))
+
+			if result.rowcount:
+				return True
+
+		try:
+			with self.engine.begin() as connection:
+				connection.execute(PollerLease.__table__.insert().values(name = self.name, holder = self.holder, expires_at = now + self.ttl))
+		except IntegrityError:
+			return False
+
+		return True
+
+	def release(self):
+		with self.engine.begin() as connection:
+			connection.execute(PollerLease.__table__.delete()
+				.where(PollerLease.name == self.name)
+				.where(PollerLease.holder == self.holder))
+
+# Local stand-in for instances on a single host: an exclusive flock() on a
+# file, released by the kernel as soon as the holding process dies.
+class VelesFileLease(VelesLease):
+	def __init__(self, path, name = None, ttl = None):
+		super().__init__(name, ttl)
+		self.path = path
+		self.file = None
+
+	def try_acquire(self):
+		if self.file:
+			return True
+
+		lock_file = open(self.path, 'a')
+
+		try:
+			fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			lock_file.close()
+			return False
+
+		self.file = lock_file
+		return True
+
+	def release(self):
+		if self.file:
+			fcntl.flock(self.file, fcntl.LOCK_UN)
+			self.file.close()
+			self.file = None
+
+# Leader's events and polled state for the followers, relayed through the
+# database so it works across hosts. Same interface as VelesEventChannel: the
+# leader sends, every instance polls the rows of the others. Rows are kept for
+# the retention period, the latest one of every key always, so a starting
+# follower replays the recent events and the current state.
+class VelesDatabaseChannel(object):
+	poll_delay = 0.5
+	retention = 600
+	batch_size = 500
+
+	def __init__(self, engine, source, handler):
+		self.engine = engine
+		self.source = source
+		self.handler = handler
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)	# keeps the inserts in order
+		self.last_id = 0
+		self.pruned_at = time.time()
+
+	def send(self, message):
+		# retained per type like in the event hub, states and events don't collide
+		key = '%s:%s' % (message['type'], message['key']) if message.get('key') else None
+		self.executor.submit(self.insert, key, json.dumps(message))
+
+	def insert(self, key, payload):
+		try:
+			with self.engine.begin() as connection:
+				connection.execute(PollerMessage.__table__.insert().values(
+					source = self.source,
+					key = key,
+					created_at = time.time(),
+					payload = payload
+					))
+
+			if time.time() - self.pruned_at > self.retention / 10:
+				self.prune()
+		except SQLAlchemyError as e:
+			vlslog.logger.error('Error storing poller message: %s', e)
+
+	def prune(self):
+		self.pruned_at = time.time()
+
+		with self.engine.begin() as connection:
+			keep = [row[0] for row in connection.execute(
+				PollerMessage.__table__.select().with_only_columns([func.max(PollerMessage.id)])
+					.where(PollerMessage.key != None)
+					.group_by(PollerMessage.key)
+				)]
+			query = PollerMessage.__table__.delete().where(PollerMessage.created_at < time.time() - self.retention)
+
+			if keep:
+				query = query.where(PollerMessage.id.notin_(keep))
+
+			connection.execute(query)
+
+	def fetch(self):
+		with self.engine.connect() as connection:
+			return [(row.id, row.payload) for row in connection.execute(PollerMessage.__table__.select()
+				.where(PollerMessage.id > self.last_id)
+				.where(PollerMessage.source != self.source)
+				.order_by(PollerMessage.id)
+				.limit(self.batch_size)
+				)]
+
+	@asyncio.coroutine
+	def run_task(self):
+		loop = asyncio.get_event_loop()
+
+		while True:
+			try:
+				rows = yield from loop.run_in_executor(self.executor, self.fetch)
+			except SQLAlchemyError as e:
+				vlslog.logger.error('Error reading poller messages: %s', e)
+				rows = []
+
+			for row_id, payload in rows:
+				self.last_id = row_id
+
+				try:
+					self.handler(json.loads(payload))
+				except Exception as e:
+					vlslog.logger.error('Error handling poller message: %s', e, exc_info=True)
+
+			if len(rows) < self.batch_size:
+				yield from asyncio.sleep(self.poll_delay)
+
+def create_lease(config, engine):
+	# [lease] section: backend = database (default) or file with the path of
+	# the lock file, ttl in seconds
+	options = {'name': config.get('name'), 'ttl': config.get('ttl')}
+
+	if config.get('backend', 'database') == 'file':
+		return VelesFileLease(config.get('path', '/tmp/veles-webapi-pollers.lock'), **options)
+
+	return VelesDatabaseLease(engine, **options)
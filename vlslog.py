@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#
+# Level-gated asynchronous logging
+#
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+import sys
+
+logger = logging.getLogger('veles')
+
+# Hands the records over to the listener thread as they are, the formatting
+# and the (possibly slow) writes happen there, off the event loop.
+class VelesQueueHandler(logging.handlers.QueueHandler):
+	def prepare(self, record):
+		return record
+
+# Single line records with the structured fields appended as key=value pairs
+class VelesLogFormatter(logging.Formatter):
+	def __init__(self):
+		super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+	def format(self, record):
+		line = super().format(record)
+		fields = getattr(record, 'fields', None)
+
+		if fields:
+			line += ' ' + ' '.join(['%s=%s' % (key, value) for key, value in sorted(fields.items())])
+
+		return line
+
+# Logging of the websocket traffic. Disabled by default, when disabled a call
+# costs only the flag check; when enabled the payloads are truncated to
+# max_payload characters and only sample_rate of them are logged at all.
+class VelesMessageLogger(object):
+	def __init__(self, enabled = False, max_payload = 512, sample_rate = 1.0):
+		self.logger = logger.getChild('messages')
+		self.logger.setLevel(logging.DEBUG)	# gated by the enabled flag instead
+		self.enabled = enabled
+		self.max_payload = max_payload
+		self.sample_rate = sample_rate
+
+	def log(self, direction, payload, **fields):
+		if not self.enabled:
+			return
+
+		if self.sample_rate < 1 and random.random() >= self.sample_rate:
+			return
+
+		payload = str(payload)
+		fields['bytes'] = len(payload)
+
+		if len(payload) > self.max_payload:
+			payload = payload[:self.max_payload] + '...'
+
+		fields['direction'] = direction
+		self.logger.debug(payload, extra={'fields': fields})
+
+	def toggle(self):
+		self.enabled = not self.enabled
+		logger.warning('Message logging %s', 'enabled' if self.enabled else 'disabled')
+
+messages = VelesMessageLogger()
+listener = None
+
+def setup(level = 'INFO', message_logging = False, max_payload = 512, sample_rate = 1.0, file = None):
+	# Routes the 'veles' loggers through a queue to a listener thread writing
+	# to stdout or the given file. Values may come as strings from the config.
+	global listener
+
+	if listener:
+		listener.stop()
+
+	output = logging.FileHandler(file) if file else logging.StreamHandler(sys.stdout)
+	output.setFormatter(VelesLogFormatter())
+	log_queue = queue.Queue()
+	listener = logging.handlers.QueueListener(log_queue, output)
+	listener.start()
+
+	logger.handlers = [VelesQueueHandler(log_queue)]
+	logger.propagate = False
+	logger.setLevel(str(level).upper())
+
+	messages.enabled = str(message_logging).lower() in ['1', 'true', 'yes', 'on']
+	messages.max_payload = int(max_payload)
+	messages.sample_rate = float(sample_rate)
+
+def toggle_debug():
+	if logger.level == logging.DEBUG:
+		logger.setLevel(logging.INFO)
+	else:
+		logger.setLevel(logging.DEBUG)
+
+	logger.warning('Log level set to %s', logging.getLevelName(logger.level))
+
+def install_signal_handlers(loop):
+	# runtime switches: SIGUSR1 toggles message logging, SIGUSR2 debug level
+	loop.add_signal_handler(signal.SIGUSR1, messages.toggle)
+	loop.add_signal_handler(signal.SIGUSR2, toggle_debug)
+
+def shutdown():
+	if listener:
+		listener.stop()
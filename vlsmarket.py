@@ -5,18 +5,28 @@
 # Copyright 2018 barlog@veles.network
 ##
 import asyncio, sys, json, requests
+import concurrent.futures
 from aiohttp import web
+import vlshttp
+import vlslog
 from datetime import datetime
 from time import mktime
 
 class VelesMarketClient(object):
 	url = 'https://api.coingecko.com/api/v3/coins/veles?localization=false&tickers=false&community_data=false&developer_data=false&sparkline=false'
 
-	def __init__(self, wallet = None):
+	timeout = 10
+	max_supply = 2500000
+
+	def __init__(self, wallet = None, supply_tracker = None, http = None):
 		self.wallet = wallet
+		self.supply_tracker = supply_tracker
+		self.http = http if http else vlshttp.VelesHttpClient()
 
 	def fetch_info_v2(self):
-		data = self.fetch_all()
+		return self.compose_info_v2(self.fetch_all())
+
+	def compose_info_v2(self, data):
 		info = {
 			'data': {
 				'id': '9999',
@@ -46,7 +56,9 @@ class VelesMarketClient(object):
 		return info
 
 	def fetch_info_v1(self):
-		data = self.fetch_all()
+		return self.compose_info_v1(self.fetch_all())
+
+	def compose_info_v1(self, data):
 		t = datetime.now()
 		unix_secs = mktime(t.timetuple())
 		info = [
@@ -71,28 +83,117 @@ class VelesMarketClient(object):
 		return info
 
 	def fetch_all(self):
-		data = self.fetch_exchange_info()
-		data['supply_data'] = self.fetch_supply_info()
-		# Calculate the market cap
-		data['market_data']['market_cap']['usd'] = data['supply_data']['available_supply'] * data['market_data']['current_price']['usd']
+		return self.add_supply_data(self.fetch_exchange_info(), self.fetch_supply_info())
+
+	@asyncio.coroutine
+	def fetch_all_async(self, executor = None):
+		data = yield from self.fetch_exchange_info_async()
+		# supply info may still need the blocking wallet RPC
+		supply_data = yield from asyncio.get_event_loop().run_in_executor(executor, self.fetch_supply_info)
+		return self.add_supply_data(data, supply_data)
+
+	def add_supply_data(self, data, supply_data):
+		# on a copy, data may be the response the http client keeps as its last
+		# good one; without our supply info the upstream figures are used
+		market_data = dict(data['market_data'], market_cap = dict(data['market_data']['market_cap']))
+		data = dict(data, market_data = market_data)
+
+		if supply_data:
+			data['supply_data'] = supply_data
+			# Calculate the market cap
+			market_data['market_cap']['usd'] = supply_data['available_supply'] * market_data['current_price']['usd']
+		else:
+			data['supply_data'] = {
+				'max_supply': market_data.get('max_supply') or self.max_supply,
+				'total_supply': market_data.get('total_supply'),
+				'available_supply': market_data.get('circulating_supply')
+			}
+
 		return data
 
 	def fetch_exchange_info(self):
-		response = requests.get(self.url)
+		response = requests.get(self.url, timeout=self.timeout)
 		data = json.loads(response.content.decode())
 		return data
 
+	@asyncio.coroutine
+	def fetch_exchange_info_async(self):
+		data = yield from self.http.get_json(self.url)
+		return data
+
 	def fetch_supply_info(self):
-		data = {}
-		total_supply = self.wallet.rpc_call('gettxoutsetinfo')['total_amount']
-		mn_count = len(self.wallet.rpc_call('masternode', ['list']))
+		if self.supply_tracker and self.supply_tracker.is_ready():
+			return self.supply_tracker.get_supply_info()
+
+		utxo_info = self.wallet.rpc_call('gettxoutsetinfo')
+		mn_list = self.wallet.rpc_call('masternode', ['list'])
 		mn_collateral = self.wallet.rpc_call('masternode', ['collateral'])
 
+		# error responses of the wallet, the supply is unavailable then
+		if not isinstance(utxo_info, dict) or 'total_amount' not in utxo_info:
+			return None
+
+		if (isinstance(mn_list, dict) and 'error' in mn_list) or isinstance(mn_collateral, dict):
+			return None
+
+		total_supply = utxo_info['total_amount']
+		mn_count = len(mn_list)
+
 		return {
-			'max_supply': 2500000,
+			'max_supply': self.max_supply,
 			'total_supply': total_supply,
 			'available_supply': total_supply - (mn_count * mn_collateral)
 		}
+
+# Holds the last market data snapshot, refreshed from upstream once per interval
+# and shared by the price poller and all the HTTP and websocket consumers. The
+# ticker payloads are composed and encoded once per refresh, so serving them
+# never triggers an outbound request.
+class VelesMarketDataService(object):
+	refresh_delay = 60
+
+	def __init__(self, client):
+		self.client = client
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.data = None
+		self.info_v1 = None
+		self.info_v2 = None
+		self.payload_v1 = None
+		self.payload_v2 = None
+		self.updated_at = None
+
+	@asyncio.coroutine
+	def refresh(self):
+		data = yield from self.client.fetch_all_async(self.executor)
+		self.update(data)
+		return data
+
+	def update(self, data):
+		if not data or not 'market_data' in data:
+			return
+
+		info_v1 = self.client.compose_info_v1(data)
+		info_v2 = self.client.compose_info_v2(data)
+
+		self.data = data
+		self.info_v1 = info_v1
+		self.info_v2 = info_v2
+		self.payload_v1 = json.dumps(info_v1, indent=4).encode('utf-8')
+		self.payload_v2 = json.dumps(info_v2, indent=4).encode('utf-8')
+		self.updated_at = datetime.now()
+
+	def is_ready(self):
+		return self.data != None
+
+	@asyncio.coroutine
+	def refresh_task(self):
+		while True:
+			try:
+				yield from self.refresh()
+			except Exception as e:
+				vlslog.logger.error('Error refreshing market data: %s', e)
+
+			yield from asyncio.sleep(self.refresh_delay)
 		 
 
 class VelesMarketAPIServer(object):
@@ -100,13 +201,18 @@ class VelesMarketAPIServer(object):
 	addr = '0.0.0.0'
 	headers = {"Content-Type": 'application/json', "Access-Control-Allow-Origin": "*"}
 
-	def __init__(self, addr = None, port = None, wallet = None):
+	def __init__(self, addr = None, port = None, wallet = None, market_data = None):
 		if addr != None:
 			self.addr = addr
 		if port != None:
 			self.port = port
 
-		self.client = VelesMarketClient(wallet)
+		if market_data:
+			self.market_data = market_data
+			self.client = market_data.client
+		else:
+			self.client = VelesMarketClient(wallet)
+			self.market_data = VelesMarketDataService(self.client)
 
 	@asyncio.coroutine
 	def handle(self, request):
@@ -119,12 +225,27 @@ class VelesMarketAPIServer(object):
 	@asyncio.coroutine
 	def handle_ticker_v1(self, request):
 		coinID = request.match_info.get('coinID', "0")
-		return web.Response(text=json.dumps(self.client.fetch_info_v1(), indent=4), headers=self.headers)
+
+		if not self.market_data.is_ready():
+			return self.handle_not_ready()
+
+		return web.Response(body=self.market_data.payload_v1, headers=self.headers)
 
 	@asyncio.coroutine
 	def handle_ticker_v2(self, request):
 		coinID = request.match_info.get('coinID', "0")
-		return web.Response(text=json.dumps(self.client.fetch_info_v2(), indent=4), headers=self.headers)
+
+		if not self.market_data.is_ready():
+			return self.handle_not_ready()
+
+		return web.Response(body=self.market_data.payload_v2, headers=self.headers)
+
+	def handle_not_ready(self):
+		text = json.dumps({
+			'status': 'error',
+			'message': 'Market data not available yet'
+			}, sort_keys = True, indent = 4)
+		return web.Response(text=text, status=503, headers=self.headers)
 
 	@asyncio.coroutine
 	def http_handler_task(self):
@@ -153,6 +274,7 @@ class VelesMarketAPIServer(object):
 		loop.run_until_complete(asyncio.gather(
 			self.http_handler_task()
 			))
+		asyncio.ensure_future(self.market_data.refresh_task())
 		loop.run_forever()
 		#except KeyboardInterrupt:
 		#	print("\n* Shutting down on keyboard interrupt *")
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+#
+# In-memory masternode list with change tracking
+#
+
+# Keeps the last masternodelist snapshot keyed by collateral outpoint, together
+# with indexes by status and by address (both the IP:port and the payee), so
+# lookups don't need another pass over the list. Every update computes the
+# status counts and the per-node changes against the previous snapshot in a
+# single pass.
+class VelesMasternodeStore(object):
+	counted_statuses = {
+		'ENABLED': 'enabled-count',
+		'PRE_ENABLED': 'pre-enabled-count',
+		'NEW_START_REQUIRED': 'new-start-required-count',
+		'EXPIRED': 'expired-count'
+		}
+
+	def __init__(self):
+		self.nodes = {}
+		self.by_status = {}
+		self.by_address = {}
+		self.state = None
+
+	def update(self, nodes):
+		# returns the list of added, removed, status changed and otherwise
+		# updated nodes, empty on the first snapshot
+		changes = []
+		state = {'count': len(nodes)}
+		by_status = {}
+		by_address = {}
+
+		for name in self.counted_statuses.values():
+			state[name] = 0
+
+		for outpoint, node in nodes.items():
+			status = node.get('status')
+
+			if status in self.counted_statuses:
+				state[self.counted_statuses[status]] += 1
+
+			by_status.setdefault(status, set()).add(outpoint)
+
+			for address in self.get_node_addresses(node):
+				by_address.setdefault(address, set()).add(outpoint)
+
+			if self.state == None:
+				continue
+
+			if outpoint not in self.nodes:
+				changes += [{'outpoint': outpoint, 'change': 'added', 'old-state': None, 'new-state': node}]
+
+			elif self.nodes[outpoint].get('status') != status:
+				changes += [{'outpoint': outpoint, 'change': 'status', 'old-state': self.nodes[outpoint], 'new-state': node}]
+
+			elif self.nodes[outpoint] != node:
+				changes += [{'outpoint': outpoint, 'change': 'updated', 'old-state': self.nodes[outpoint], 'new-state': node}]
+
+		if self.state != None:
+			for outpoint, node in self.nodes.items():
+				if outpoint not in nodes:
+					changes += [{'outpoint': outpoint, 'change': 'removed', 'old-state': node, 'new-state': None}]
+
+		self.nodes = nodes
+		self.by_status = by_status
+		self.by_address = by_address
+		self.state = state
+		return changes
+
+	def get_node_addresses(self, node):
+		addresses = []
+
+		if node.get('address'):
+			addresses += [node['address'], self.get_ip(node['address'])]
+
+		if node.get('payee'):
+			addresses += [node['payee']]
+
+		return addresses
+
+	def get_ip(self, address):
+		return address.rsplit(':', 1)[0].strip('[]')
+
+	def get(self, outpoint):
+		return self.nodes.get(outpoint)
+
+	def find_by_status(self, status):
+		return {outpoint: self.nodes[outpoint] for outpoint in self.by_status.get(status, [])}
+
+	def find_by_address(self, address):
+		return {outpoint: self.nodes[outpoint] for outpoint in self.by_address.get(address, [])}
+
+	def get_ips(self):
+		return [self.get_ip(node['address']) for node in self.nodes.values() if node.get('address')]
+
+	@staticmethod
+	def parse_masternodelist(raw_mnlist):
+		# Accepts both the 'json' mode of masternodelist (outpoint -> object)
+		# and the default one (outpoint -> status string).
+		nodes = {}
+
+		for outpoint, item in raw_mnlist.items():
+			if isinstance(item, dict):
+				nodes[outpoint] = {
+					'status': item.get('status'),
+					'address': item.get('address'),
+					'payee': item.get('payee')
+					}
+			else:
+				nodes[outpoint] = {'status': str(item).strip(), 'address': None, 'payee': None}
+
+		return nodes
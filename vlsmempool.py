@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+#
+# Mempool tracker
+#
+import asyncio
+import concurrent.futures
+import time
+
+import vlslog
+import vlswallet
+
+try:
+	import zmq
+	import zmq.asyncio
+except ImportError:
+	zmq = None
+
+# Keeps the current set of unconfirmed transactions of the node. Every refresh
+# asks only for the txid list (getrawmempool), diffs it against the previous
+# one and fetches the entries (getmempoolentry) of the new transactions only,
+# or all of them at once (getrawmempool true) when there are many, eg. on a
+# cold start. The added and removed sets can be published as small delta
+# events together with the summary stats, the follower workers and instances
+# apply the same deltas on top of a snapshot. The RPCs run on the executor, the
+# entries are only changed on the event loop that serves them. With the
+# optional pyzmq package and a node publishing zmqpubhashtx, every announced
+# transaction triggers a refresh right away instead of waiting for the next poll.
+class VelesMempoolTracker(object):
+	refresh_delay = 10
+	zmq_debounce_delay = 0.5
+	verbose_threshold = 50	# new transactions from which a single getrawmempool true is cheaper
+	fee_buckets = [1, 2, 5, 10, 20, 50, 100]	# fee rate bounds in sat/vB
+
+	def __init__(self, wallet, refresh_delay = None, zmq_url = None):
+		self.wallet = wallet
+		self.zmq_url = zmq_url
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.entries = {}
+		self.sequence = 0
+		self.origin = None
+		self.updated_at = None
+		self.refresh_event = asyncio.Event()
+
+		if refresh_delay:
+			self.refresh_delay = float(refresh_delay)
+
+		if zmq_url and not zmq:
+			vlslog.logger.warning('pyzmq package not installed, mempool ZMQ notifications from %s ignored', zmq_url)
+			self.zmq_url = None
+
+	def fetch_changes(self, entries):
+		# executor side, entries are only read: returns the added entries and
+		# the removed txids
+		txids = self.wallet.rpc_call('getrawmempool', priority=vlswallet.PRIORITY_INGEST)
+
+		if not isinstance(txids, list):
+			raise ValueError('Unexpected getrawmempool result: %s' % txids)
+
+		current = set(txids)
+		removed = [txid for txid in entries.keys() if txid not in current]
+		new_txids = [txid for txid in current if txid not in entries]
+		fetched = {}
+
+		if len(new_txids) > self.verbose_threshold:
+			verbose = self.wallet.rpc_call('getrawmempool', [True], priority=vlswallet.PRIORITY_INGEST)
+
+			if not isinstance(verbose, dict) or 'error' in verbose:
+				raise ValueError('Unexpected getrawmempool result: %s' % verbose)
+
+			# transactions that came meanwhile wait for the next refresh
+			fetched = {txid: verbose[txid] for txid in new_txids if txid in verbose}
+		else:
+			for txid in new_txids:
+				entry = self.wallet.rpc_call('getmempoolentry', [txid], priority=vlswallet.PRIORITY_INGEST)
+
+				if isinstance(entry, dict) and 'error' not in entry:	# otherwise confirmed or evicted meanwhile
+					fetched[txid] = entry
+
+		return [self.compact_entry(txid, entry) for txid, entry in fetched.items()], removed
+
+	def apply_changes(self, added, removed):
+		for txid in removed:
+			self.entries.pop(txid, None)
+
+		for entry in added:
+			self.entries[entry['txid']] = entry
+
+		self.updated_at = time.time()
+
+		if not added and not removed:
+			return None
+
+		self.sequence += 1
+		return {
+			'sequence': self.sequence,
+			'added': added,
+			'removed': removed,
+			'stats': self.get_stats()
+			}
+
+	def load_snapshot(self, entries, sequence, origin = None):
+		# follower side: the publisher's full copy, origin tells its deltas
+		# apart from the ones of a previous publisher
+		self.entries = entries
+		self.sequence = sequence
+		self.origin = origin
+		self.updated_at = time.time()
+
+	def apply_delta(self, delta, origin = None):
+		# follower side: a delta of the publisher on top of the snapshot, False
+		# when some were missed and a new snapshot is needed
+		if self.updated_at == None or origin != self.origin:
+			return False
+
+		if delta['sequence'] <= self.sequence:	# already in the snapshot
+			return True
+
+		if delta['sequence'] != self.sequence + 1:
+			return False
+
+		self.apply_changes(delta['added'], delta['removed'])
+		self.sequence = delta['sequence']
+		return True
+
+	def compact_entry(self, txid, entry):
+		size = entry.get('vsize', entry.get('size', 0))
+
+		if 'fees' in entry:
+			fee = entry['fees']['base']
+		else:
+			fee = entry.get('fee', 0)
+
+		return {
+			'txid': txid,
+			'size': size,
+			'fee': fee,
+			'feerate': round(fee * 100000000 / size, 2) if size else 0,	# sat/vB
+			'time': entry.get('time')
+			}
+
+	def get_stats(self):
+		buckets = [0] * (len(self.fee_buckets) + 1)
+		total_size = 0
+		total_fee = 0
+
+		for entry in self.entries.values():
+			total_size += entry['size']
+			total_fee += entry['fee']
+			index = 0
+
+			while index < len(self.fee_buckets) and entry['feerate'] >= self.fee_buckets[index]:
+				index += 1
+
+			buckets[index] += 1
+
+		fee_buckets = []
+
+		for index, count in enumerate(buckets):
+			fee_buckets += [{
+				'min': self.fee_buckets[index - 1] if index else 0,
+				'max': self.fee_buckets[index] if index < len(self.fee_buckets) else None,
+				'count': count
+				}]
+
+		return {
+			'count': len(self.entries),
+			'bytes': total_size,
+			'fees': round(total_fee, 8),
+			'fee_buckets': fee_buckets
+			}
+
+	def get_entries(self):
+		return list(self.entries.values())
+
+	@asyncio.coroutine
+	def refresh_async(self):
+		# the delta event, None when nothing changed
+		added, removed = yield from asyncio.get_event_loop().run_in_executor(self.executor, self.fetch_changes, self.entries)
+		return self.apply_changes(added, removed)
+
+	@asyncio.coroutine
+	def wait_for_refresh(self):
+		# sleeps until the next poll is due or a ZMQ notification comes
+		try:
+			yield from asyncio.wait_for(self.refresh_event.wait(), self.refresh_delay)
+		except asyncio.TimeoutError:
+			pass
+
+		self.refresh_event.clear()
+
+	@asyncio.coroutine
+	def zmq_task(self):
+		if not self.zmq_url:
+			return
+
+		socket = zmq.asyncio.Context.instance().socket(zmq.SUB)
+		socket.connect(self.zmq_url)
+		socket.setsockopt(zmq.SUBSCRIBE, b'hashtx')
+
+		while True:
+			try:
+				yield from socket.recv_multipart()
+			except Exception as e:
+				vlslog.logger.error('Error reading mempool ZMQ notification: %s', e)
+				yield from asyncio.sleep(self.refresh_delay)
+				continue
+
+			# a burst of announcements ends up in a single refresh
+			yield from asyncio.sleep(self.zmq_debounce_delay)
+
+			while (yield from socket.poll(0)):
+				yield from socket.recv_multipart()
+
+			self.refresh_event.set()
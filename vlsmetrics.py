@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+#
+# Minimal metrics registry with the Prometheus text exposition format
+#
+import math
+import threading
+import time
+
+# Base of the labelled metrics. Values are kept per label value tuple, the
+# number of distinct label sets is capped by max_series so a client sending
+# arbitrary command names can't blow the registry up, the rest is counted
+# under the overflow label value. Updates may come from the executor threads
+# (RPC, database), hence the lock.
+class VelesMetric(object):
+	metric_type = None
+	max_series = 500
+	overflow_label = 'other'
+
+	def __init__(self, name, description, labelnames = ()):
+		self.name = name
+		self.description = description
+		self.labelnames = tuple(labelnames)
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def key(self, labels):
+		key = tuple([str(labels.get(name, '')) for name in self.labelnames])
+
+		if key not in self.values and len(self.values) >= self.max_series:
+			return tuple([self.overflow_label] * len(self.labelnames))
+
+		return key
+
+	def format_labels(self, key, extra = None):
+		pairs = list(zip(self.labelnames, key))
+
+		if extra:
+			pairs += [extra]
+
+		if not pairs:
+			return ''
+
+		return '{%s}' % ','.join(['%s="%s"' % (name, self.escape(value)) for name, value in pairs])
+
+	def escape(self, value):
+		return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+	def format_value(self, value):
+		if value == math.inf:
+			return '+Inf'
+
+		return repr(float(value))
+
+	def expose(self):
+		lines = [
+			'# HELP %s %s' % (self.name, self.description),
+			'# TYPE %s %s' % (self.name, self.metric_type)
+			]
+
+		with self.lock:
+			items = sorted(self.values.items())
+
+		for key, value in items:
+			lines += self.expose_series(key, value)
+
+		return lines
+
+	def expose_series(self, key, value):
+		return ['%s%s %s' % (self.name, self.format_labels(key), self.format_value(value))]
+
+	def get(self, **labels):
+		return self.values.get(self.key(labels))
+
+class VelesCounter(VelesMetric):
+	metric_type = 'counter'
+
+	def inc(self, amount = 1, **labels):
+		with self.lock:
+			key = self.key(labels)
+			self.values[key] = self.values.get(key, 0) + amount
+
+class VelesGauge(VelesMetric):
+	metric_type = 'gauge'
+
+	def __init__(self, name, description, labelnames = (), function = None):
+		super().__init__(name, description, labelnames)
+		self.function = function
+
+	def set(self, value, **labels):
+		with self.lock:
+			self.values[self.key(labels)] = value
+
+	def inc(self, amount = 1, **labels):
+		with self.lock:
+			key = self.key(labels)
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def dec(self, amount = 1, **labels):
+		self.inc(-amount, **labels)
+
+	def expose(self):
+		if self.function:	# unlabelled gauge read at scrape time
+			self.set(self.function())
+
+		return super().expose()
+
+class VelesHistogram(VelesMetric):
+	metric_type = 'histogram'
+	default_buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+	def __init__(self, name, description, labelnames = (), buckets = None):
+		super().__init__(name, description, labelnames)
+		self.buckets = sorted(buckets if buckets else self.default_buckets) + [math.inf]
+
+	def observe(self, value, **labels):
+		with self.lock:
+			key = self.key(labels)
+
+			if key not in self.values:
+				self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+
+			series = self.values[key]
+			series['sum'] += value
+			series['count'] += 1
+
+			for index, bound in enumerate(self.buckets):
+				if value <= bound:
+					series['counts'][index] += 1
+					break
+
+	def time(self, **labels):
+		return VelesTimer(self, labels)
+
+	def expose_series(self, key, value):
+		lines = []
+		cumulative = 0
+
+		for bound, count in zip(self.buckets, value['counts']):
+			cumulative += count
+			lines += ['%s_bucket%s %i' % (self.name, self.format_labels(key, ('le', self.format_value(bound))), cumulative)]
+
+		lines += ['%s_sum%s %s' % (self.name, self.format_labels(key), self.format_value(value['sum']))]
+		lines += ['%s_count%s %i' % (self.name, self.format_labels(key), value['count'])]
+		return lines
+
+# Context manager observing the elapsed wall time, works across yields
+class VelesTimer(object):
+	def __init__(self, histogram, labels):
+		self.histogram = histogram
+		self.labels = labels
+		self.started = None
+
+	def __enter__(self):
+		self.started = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class VelesMetricsRegistry(object):
+	content_type = 'text/plain; version=0.0.4'
+
+	def __init__(self):
+		self.metrics = {}
+
+	def register(self, metric):
+		# registering the same name again returns the existing metric, so
+		# modules can declare what they use at import time
+		if metric.name not in self.metrics:
+			self.metrics[metric.name] = metric
+
+		return self.metrics[metric.name]
+
+	def counter(self, name, description, labelnames = ()):
+		return self.register(VelesCounter(name, description, labelnames))
+
+	def gauge(self, name, description, labelnames = (), function = None):
+		return self.register(VelesGauge(name, description, labelnames, function))
+
+	def histogram(self, name, description, labelnames = (), buckets = None):
+		return self.register(VelesHistogram(name, description, labelnames, buckets))
+
+	def expose(self):
+		lines = []
+
+		for name in sorted(self.metrics.keys()):
+			lines += self.metrics[name].expose()
+
+		return '\n'.join(lines) + '\n'
+
+# Process wide registry shared by all the modules
+registry = VelesMetricsRegistry()
@@ -1,75 +1,48 @@
 #!/usr/bin/env python3
-import asyncio, sys, json
+import asyncio, sys, json, time
+import concurrent.futures
 from aiohttp import web
 import vlsblockdb
+import vlsexplorer
+import vlslog
 import configparser, argparse, os
 
-		
-# jednoduchy example zabaleny do classy, navyse je este priklad
-# ako 
-class VelesMiningApiWebServer(object):
-	port = 8081
-	addr = '0.0.0.0'
-	headers = {"Access-Control-Allow-Origin": "*"}
-	algos = ['x11', 'x16r', 'sha256d', 'scrypt', 'lyra2z', 'nist5']
-	pow_reward_perc = 89.9334221
-	api_root = '/api/stats/mining'
 
-	def __init__(self, config):	#self, addr, port, mysql_host, mysql_port, mysql_user, mysql_pass, mysql_db):
-		self.config = config
-		self.addr = config['server']['address']
-		self.port = config['mining_api']['http_port']
-
-		self.stats_repo = vlsblockdb.VelesBlockInfoRepository(**config['mysql'])
-		self.mining_repo = vlsblockdb.VelesMiningStatusRepository(**config['mysql'])
-
-	def get_hashrate(self, algo):
-		info = self.mining_repo.get(algo)
-
-		if info and 'hashrate' in info:
-			return info['hashrate']
-
-		return self.stats_repo.get_last_value('hashrate', algo)
+# Composes the mining stats of all the algos out of two aggregate queries over
+# `block_rewards` (one grouped by algo, one for the totals) and one read of
+# `mining_status`, instead of querying every single value separately.
+class VelesMiningStatsComposer(object):
+	def __init__(self, stats_repo, mining_repo, algos, pow_reward_perc):
+		self.stats_repo = stats_repo
+		self.mining_repo = mining_repo
+		self.algos = algos
+		self.pow_reward_perc = pow_reward_perc
 
 	def compose_stats_for_algo(self, algo, hours = None):
-		rewards = self.slice_pow_rewards(self.stats_repo.get_total_value('rewards', algo, hours))
-		blocks = self.stats_repo.get_block_count(algo, hours)
-
-		stats = {
-			'hashrate': self.convert_to_mhs(self.get_hashrate(algo)),
-			'difficulty': self.round(self.stats_repo.get_last_value('difficulty', algo), 8),
-			'hashrate_average': self.convert_to_mhs(self.stats_repo.get_average_value('hashrate', algo, hours)),
-			'difficulty_average': self.round(self.stats_repo.get_average_value('difficulty', algo, hours), 8),
-			'block_reward_average': self.div(rewards, blocks),
-			'block_reward_last': self.slice_pow_rewards(self.stats_repo.get_last_value('rewards', algo)),
-			'last_block_index': self.stats_repo.get_last_value('id', algo),
-			'rewards_total': rewards,
-			'blocks_total': blocks,
-			'reward_per_mh': self.slice_pow_rewards(self.stats_repo.get_total_value('reward_per_mh', algo, hours)),
-			'blocks_hourly': self.stats_repo.get_block_count(algo, 1),
-			'blocks_daily': self.stats_repo.get_block_count(algo, 24),
-			'rewards_hourly': self.round(self.slice_pow_rewards(self.stats_repo.get_total_value('rewards', algo, 1)), 8),
-			'rewards_daily': self.round(self.slice_pow_rewards(self.stats_repo.get_total_value('rewards', algo, 24)), 8),
-			}
-
-		if hours:
-			stats.update({
-				'blocks': blocks,
-				'block_reward': self.div(rewards,  blocks)
-			})
-		return stats;
+		summaries = self.stats_repo.get_algo_summaries(self.window(hours), algo)
+		return self.compose_algo(algo, summaries.get(algo, {}), self.get_hashrates(), hours)
 
 	def compose_stats(self, hours = None):
+		return self.compose_stats_with_algos(hours)[0]
+
+	def compose_stats_with_algos(self, hours = None):
+		# Returns both the overall stats and the stats of every algo as
+		# compose_stats_for_algo would return them (without the percentages).
 		stats = {}
-		total_rewards = self.slice_pow_rewards(self.stats_repo.get_total_value('rewards', None, hours))
-		total_blocks = self.stats_repo.get_block_count(None, hours)
-		total_rewards_daily = self.slice_pow_rewards(self.stats_repo.get_total_value('rewards', None, 24))
-		total_blocks_daily = self.stats_repo.get_block_count(None, 24)
-		total_rewards_hourly = self.slice_pow_rewards(self.stats_repo.get_total_value('rewards', None, 1))
-		total_blocks_hourly = self.stats_repo.get_block_count(None, 1)
+		algo_stats = {}
+		summaries = self.stats_repo.get_algo_summaries(self.window(hours))
+		totals = self.stats_repo.get_total_summary(self.window(hours)) or {}
+		hashrates = self.get_hashrates()
+		total_rewards = self.slice_pow_rewards(totals.get('rewards_total'))
+		total_blocks = totals.get('blocks_total', 0)
+		total_rewards_daily = self.slice_pow_rewards(totals.get('rewards_daily'))
+		total_blocks_daily = totals.get('blocks_daily', 0)
+		total_rewards_hourly = self.slice_pow_rewards(totals.get('rewards_hourly'))
+		total_blocks_hourly = totals.get('blocks_hourly', 0)
 
 		for algo in self.algos:
-			stats[algo] = self.compose_stats_for_algo(algo, hours)
+			stats[algo] = self.compose_algo(algo, summaries.get(algo, {}), hashrates, hours)
+			algo_stats[algo] = dict(stats[algo])
 
 		for algo in self.algos:
 			if 'rewards_daily' in stats[algo] and stats[algo]['rewards_daily']:
@@ -90,7 +63,57 @@ class VelesMiningApiWebServer(object):
 			if (not hours and 'blocks_total' in stats[algo]) and stats[algo]['blocks_total'] and total_blocks:
 				stats[algo]['blocks_percent'] = round(stats[algo]['blocks_total'] / (total_blocks / 100), 2)			
 
-		return stats
+		return stats, algo_stats
+
+	def compose_algo(self, algo, summary, hashrates, hours = None):
+		rewards = self.slice_pow_rewards(summary.get('rewards_total'))
+		blocks = summary.get('blocks_total', 0)
+
+		# mining_status has precedence, last block's hashrate is the fallback
+		if algo in hashrates:
+			hashrate = hashrates[algo]
+		else:
+			hashrate = summary.get('last_hashrate')
+
+		stats = {
+			'hashrate': self.convert_to_mhs(hashrate),
+			'difficulty': self.round(summary.get('last_difficulty'), 8),
+			'hashrate_average': self.convert_to_mhs(summary.get('hashrate_average')),
+			'difficulty_average': self.round(summary.get('difficulty_average'), 8),
+			'block_reward_average': self.div(rewards, blocks),
+			'block_reward_last': self.slice_pow_rewards(summary.get('last_rewards')),
+			'last_block_index': summary.get('last_id'),
+			'rewards_total': rewards,
+			'blocks_total': blocks,
+			'reward_per_mh': self.slice_pow_rewards(summary.get('reward_per_mh_total')),
+			'blocks_hourly': summary.get('blocks_hourly', 0),
+			'blocks_daily': summary.get('blocks_daily', 0),
+			'rewards_hourly': self.round(self.slice_pow_rewards(summary.get('rewards_hourly')), 8),
+			'rewards_daily': self.round(self.slice_pow_rewards(summary.get('rewards_daily')), 8),
+			}
+
+		if hours:
+			stats.update({
+				'blocks': blocks,
+				'block_reward': self.div(rewards,  blocks)
+			})
+		return stats;
+
+	def get_hashrates(self):
+		hashrates = {}
+
+		for info in self.mining_repo.get_all():
+			if 'hashrate' in info:
+				hashrates[info['algo']] = info['hashrate']
+
+		return hashrates
+
+	def window(self, hours):
+		# hours come as strings from the URL, any non-empty value is a window
+		if hours:
+			return int(hours)
+
+		return None
 
 	def slice_pow_rewards(self, reward):
 		if reward:
@@ -116,6 +139,142 @@ class VelesMiningApiWebServer(object):
 
 		return 0
 
+		
+# Keeps the mining stats responses pre-encoded in memory. The standard windows
+# are rebuilt in the background whenever a new row shows up in `block_rewards`
+# (or when they get older than max_age), other windows are computed on first
+# request and kept until the next rebuild. All the database work runs on a
+# single worker thread, so the pymysql connection is never shared and the
+# request handlers never block the event loop on MySQL.
+class VelesMiningStatsCache(object):
+	refresh_delay = 10
+	max_age = 60
+	max_adhoc_entries = 256
+	standard_windows = [None, 1, 24]
+
+	def __init__(self, composer, stats_repo):
+		self.composer = composer
+		self.stats_repo = stats_repo
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.payloads = {}
+		self.adhoc_payloads = {}
+		self.pending = {}
+		self.last_id = None
+		self.built_at = 0
+
+	@asyncio.coroutine
+	def get(self, key, compose):
+		# Pre-encoded payload of the key if cached, otherwise compose it off the
+		# event loop, concurrent requests of the same key wait for one result.
+		if key in self.payloads:
+			return self.payloads[key]
+
+		if key in self.adhoc_payloads:
+			return self.adhoc_payloads[key]
+
+		if key not in self.pending:
+			self.pending[key] = asyncio.ensure_future(self.run_in_executor(lambda: self.encode(compose())))
+
+		try:
+			payload = yield from asyncio.shield(self.pending[key])
+		finally:
+			self.pending.pop(key, None)
+
+		if len(self.adhoc_payloads) >= self.max_adhoc_entries:
+			self.adhoc_payloads = {}
+
+		self.adhoc_payloads[key] = payload
+		return payload
+
+	@asyncio.coroutine
+	def refresh_task(self):
+		while True:
+			try:
+				last_id = yield from self.run_in_executor(self.stats_repo.get_last_id)
+
+				if last_id != self.last_id or time.time() - self.built_at > self.max_age:
+					self.payloads = yield from self.run_in_executor(self.build)
+					self.adhoc_payloads = {}
+					self.last_id = last_id
+					self.built_at = time.time()
+			except Exception as e:
+				vlslog.logger.error('Error refreshing mining stats cache: %s', e)
+
+			yield from asyncio.sleep(self.refresh_delay)
+
+	def build(self):
+		payloads = {}
+
+		for hours in self.standard_windows:
+			stats, algo_stats = self.composer.compose_stats_with_algos(hours)
+			payloads[('stats', hours)] = self.encode(stats)
+
+			for algo, algo_result in algo_stats.items():
+				payloads[('algo', algo, hours)] = self.encode(algo_result)
+
+		return payloads
+
+	def encode(self, result):
+		return json.dumps(result, indent=4, sort_keys=True).encode('utf-8')
+
+	@asyncio.coroutine
+	def run_in_executor(self, func):
+		result = yield from asyncio.get_event_loop().run_in_executor(self.executor, func)
+		return result
+
+
+# Fills `block_rewards` from the block explorer, from the block after the last
+# stored one up to the current tip. The blocks of a batch are fetched
+# concurrently and written with a single store_many(), so the database side
+# keeps up with thousands of rows per second and the explorer is the limit.
+@asyncio.coroutine
+def backfill_block_rewards(stats_repo, explorer, from_index = None, to_index = None, batch_size = 500):
+	if from_index == None:
+		from_index = (stats_repo.get_last_id() or 0) + 1
+
+	if to_index == None:
+		block_count = yield from explorer.call_api_method_async('getblockcount')
+		to_index = int(block_count) - 1
+
+	stored = 0
+	started = time.time()
+
+	for offset in range(max(1, from_index), to_index + 1, batch_size):
+		indexes = range(offset, min(offset + batch_size, to_index + 1))
+		blocks = yield from asyncio.gather(*[explorer.get_last_block_info_async(index) for index in indexes])
+		blocks = [block for block in blocks if block]
+		stored += stats_repo.store_many(blocks)
+		print('Backfilled block_rewards up to %i, %i rows, %.1f rows/s' % (indexes[-1], stored, stored / (time.time() - started)))
+
+	return stored
+
+		
+# jednoduchy example zabaleny do classy, navyse je este priklad
+# ako 
+class VelesMiningApiWebServer(object):
+	port = 8081
+	addr = '0.0.0.0'
+	headers = {"Access-Control-Allow-Origin": "*"}
+	algos = ['x11', 'x16r', 'sha256d', 'scrypt', 'lyra2z', 'nist5']
+	pow_reward_perc = 89.9334221
+	api_root = '/api/stats/mining'
+
+	def __init__(self, config):	#self, addr, port, mysql_host, mysql_port, mysql_user, mysql_pass, mysql_db):
+		self.config = config
+		self.addr = config['server']['address']
+		self.port = config['mining_api']['http_port']
+
+		self.stats_repo = vlsblockdb.VelesBlockInfoRepository(**config['mysql'])
+		self.mining_repo = vlsblockdb.VelesMiningStatusRepository(**config['mysql'])
+		self.composer = VelesMiningStatsComposer(self.stats_repo, self.mining_repo, self.algos, self.pow_reward_perc)
+		self.stats_cache = VelesMiningStatsCache(self.composer, self.stats_repo)
+
+	def compose_stats_for_algo(self, algo, hours = None):
+		return self.composer.compose_stats_for_algo(algo, hours)
+
+	def compose_stats(self, hours = None):
+		return self.composer.compose_stats(hours)
+
 	@asyncio.coroutine
 	def handle(self, request):
 		text = json.dumps({
@@ -126,31 +285,38 @@ class VelesMiningApiWebServer(object):
 
 	@asyncio.coroutine
 	def handle_getminigstats(self, request):
-		return web.Response(text=json.dumps(self.compose_stats(), indent=4, sort_keys=True), headers=self.headers)
+		payload = yield from self.stats_cache.get(('stats', None), lambda: self.compose_stats())
+		return self.cached_response(payload)
 
 	@asyncio.coroutine
 	def handle_getminigstats_last_hours(self, request):
 		hours = request.match_info.get('hours', "24")
-		return web.Response(text=json.dumps(self.compose_stats(hours), indent=4, sort_keys=True), headers=self.headers)
+		payload = yield from self.stats_cache.get(('stats', self.composer.window(hours)), lambda: self.compose_stats(hours))
+		return self.cached_response(payload)
 
 	@asyncio.coroutine
 	def handle_getminigstats_of_algo(self, request):
 		algo = request.match_info.get('algo', "scrypt")
-		return web.Response(text=json.dumps(self.compose_stats_for_algo(algo), indent=4, sort_keys=True), headers=self.headers)
+		payload = yield from self.stats_cache.get(('algo', algo, None), lambda: self.compose_stats_for_algo(algo))
+		return self.cached_response(payload)
 
 	@asyncio.coroutine
 	def handle_getminigstats_of_algo_last_hours(self, request):
 		algo = request.match_info.get('algo', "scrypt")
 		hours = request.match_info.get('hours', "24")
-		return web.Response(text=json.dumps(self.compose_stats_for_algo(algo, hours), indent=4, sort_keys=True), headers=self.headers)
+		payload = yield from self.stats_cache.get(('algo', algo, self.composer.window(hours)), lambda: self.compose_stats_for_algo(algo, hours))
+		return self.cached_response(payload)
 
 	@asyncio.coroutine
 	def handle_history_last_hours(self, request):
 		algo = request.match_info.get('algo', "lyra2z")
 		column = request.match_info.get('column', "column")
 		hours = request.match_info.get('hours', "24")
-		return web.Response(text=json.dumps( self.stats_repo.get_last_values(column, algo, hours), indent=4, sort_keys=True), headers=self.headers)
+		payload = yield from self.stats_cache.get(('history', algo, column, hours), lambda: self.stats_repo.get_last_values(column, algo, hours))
+		return self.cached_response(payload)
 
+	def cached_response(self, payload):
+		return web.Response(body=payload, content_type='text/plain', charset='utf-8', headers=self.headers)
 
 	@asyncio.coroutine
 	def http_handler_task(self):
@@ -180,20 +346,223 @@ class VelesMiningApiWebServer(object):
 		loop.run_until_complete(asyncio.gather(
 			self.http_handler_task()
 			))
+		asyncio.ensure_future(self.stats_cache.refresh_task())
 		loop.run_forever()
 		#except KeyboardInterrupt:
 		#	print("\n* Shutting down on keyboard interrupt *")
 		#except:
 		#	print("\n* Shutting down on error")
 
+# Golden-output test of VelesMiningStatsComposer: the output has to stay
+# identical to the original per-value composition (kept below as the
+# reference), both running their real SQL on a fixture in SQLite with the few
+# MySQL functions they use emulated.
+def self_test():
+	import datetime
+	import random
+	import re
+	import sqlite3
+	import unittest
+
+	class SQLiteCursor(object):
+		def __init__(self, db):
+			self.cursor = db.cursor()
+
+		def __enter__(self):
+			return self
+
+		def __exit__(self, *args):
+			self.cursor.close()
+
+		def execute(self, sql, params = None):
+			sql = re.sub(r'DATE_SUB\(NOW\(\),\s*INTERVAL\s*(\d+)\s*HOUR\)', r"datetime('now', '-\1 hours')", sql).replace('%s', '?')
+
+			if params != None and not isinstance(params, (tuple, list)):
+				params = (params,)
+
+			self.cursor.execute(sql, params or ())
+
+		def fetchall(self):
+			columns = [column[0] for column in self.cursor.description]
+			return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+
+	class SQLiteConnection(object):
+		def __init__(self, db):
+			self.db = db
+
+		def cursor(self):
+			return SQLiteCursor(self.db)
+
+		def commit(self):
+			self.db.commit()
+
+		def ping(self, reconnect = True):
+			pass
+
+	class ReferenceComposer(object):
+		# compose_stats_for_algo and compose_stats before the grouped queries
+		def __init__(self, composer):
+			self.c = composer
+
+		def get_hashrate(self, algo):
+			info = self.c.mining_repo.get(algo)
+
+			if info and 'hashrate' in info:
+				return info['hashrate']
+
+			return self.c.stats_repo.get_last_value('hashrate', algo)
+
+		def compose_stats_for_algo(self, algo, hours = None):
+			c, repo = self.c, self.c.stats_repo
+			rewards = c.slice_pow_rewards(repo.get_total_value('rewards', algo, hours))
+			blocks = repo.get_block_count(algo, hours)
+
+			stats = {
+				'hashrate': c.convert_to_mhs(self.get_hashrate(algo)),
+				'difficulty': c.round(repo.get_last_value('difficulty', algo), 8),
+				'hashrate_average': c.convert_to_mhs(repo.get_average_value('hashrate', algo, hours)),
+				'difficulty_average': c.round(repo.get_average_value('difficulty', algo, hours), 8),
+				'block_reward_average': c.div(rewards, blocks),
+				'block_reward_last': c.slice_pow_rewards(repo.get_last_value('rewards', algo)),
+				'last_block_index': repo.get_last_value('id', algo),
+				'rewards_total': rewards,
+				'blocks_total': blocks,
+				'reward_per_mh': c.slice_pow_rewards(repo.get_total_value('reward_per_mh', algo, hours)),
+				'blocks_hourly': repo.get_block_count(algo, 1),
+				'blocks_daily': repo.get_block_count(algo, 24),
+				'rewards_hourly': c.round(c.slice_pow_rewards(repo.get_total_value('rewards', algo, 1)), 8),
+				'rewards_daily': c.round(c.slice_pow_rewards(repo.get_total_value('rewards', algo, 24)), 8),
+				}
+
+			if hours:
+				stats.update({
+					'blocks': blocks,
+					'block_reward': c.div(rewards,  blocks)
+				})
+			return stats;
+
+		def compose_stats(self, hours = None):
+			c, repo = self.c, self.c.stats_repo
+			stats = {}
+			total_rewards = c.slice_pow_rewards(repo.get_total_value('rewards', None, hours))
+			total_blocks = repo.get_block_count(None, hours)
+			total_rewards_daily = c.slice_pow_rewards(repo.get_total_value('rewards', None, 24))
+			total_blocks_daily = repo.get_block_count(None, 24)
+			total_rewards_hourly = c.slice_pow_rewards(repo.get_total_value('rewards', None, 1))
+			total_blocks_hourly = repo.get_block_count(None, 1)
+
+			for algo in c.algos:
+				stats[algo] = self.compose_stats_for_algo(algo, hours)
+
+			for algo in c.algos:
+				if 'rewards_daily' in stats[algo] and stats[algo]['rewards_daily']:
+					stats[algo]['rewards_daily_percent'] = round(stats[algo]['rewards_daily'] / (total_rewards_daily / 100), 2)
+
+				if 'blocks_daily' in stats[algo] and stats[algo]['blocks_daily']:
+					stats[algo]['blocks_daily_percent'] = round(stats[algo]['blocks_daily'] / (total_blocks_daily / 100), 2)
+
+				if 'rewards_hourly' in stats[algo] and stats[algo]['rewards_hourly']:
+					stats[algo]['rewards_hourly_percent'] = round(stats[algo]['rewards_hourly'] / (total_rewards_hourly / 100), 2)
+
+				if 'blocks_hourly' in stats[algo] and stats[algo]['blocks_hourly']:
+					stats[algo]['blocks_hourly_percent'] = round(stats[algo]['blocks_hourly'] / (total_blocks_hourly / 100), 2)
+
+				if (not hours and 'rewards_total' in stats[algo]) and stats[algo]['rewards_total'] and total_rewards:
+					stats[algo]['rewards_percent'] = round(stats[algo]['rewards_total'] / (total_rewards / 100), 2)
+
+				if (not hours and 'blocks_total' in stats[algo]) and stats[algo]['blocks_total'] and total_blocks:
+					stats[algo]['blocks_percent'] = round(stats[algo]['blocks_total'] / (total_blocks / 100), 2)
+
+			return stats
+
+	class TestMiningStatsComposer(unittest.TestCase):
+		windows = [None, 1, 24, '6', 72]
+
+		def setUp(self):
+			db = sqlite3.connect(':memory:')
+			db.create_function('IF', 3, lambda condition, value, other: value if condition else other)
+			db.execute('CREATE TABLE block_rewards (id INTEGER PRIMARY KEY, hash TEXT, algo TEXT, rewards REAL, '
+				+ 'difficulty REAL, hashrate REAL, reward_per_mh REAL, created_at TEXT)')
+			db.execute('CREATE TABLE mining_status (algo TEXT PRIMARY KEY, blocks INTEGER, difficulty REAL, hashrate REAL)')
+			rng = random.Random(42)
+			now = datetime.datetime.utcnow()
+			rows = []
+
+			for block_id in range(1, 1500):
+				age = rng.uniform(0, 100 * 60)	# minutes, over the longest window
+
+				# away from the window boundaries, the two compositions run at slightly different times
+				if min([abs(age - hours * 60) for hours in [1, 6, 24, 72]]) < 5:
+					continue
+
+				rows += [(
+					block_id,
+					'%064x' % rng.getrandbits(256),
+					rng.choice(['x11', 'x16r', 'sha256d', 'scrypt', 'lyra2z']),	# no nist5 blocks at all
+					round(rng.uniform(5, 20), 4),
+					rng.uniform(1000, 90000),
+					rng.choice([None, rng.uniform(1e6, 1e9)]),	# rows without the hashrate are ignored
+					rng.uniform(0, 1),
+					(now - datetime.timedelta(minutes = age)).strftime('%Y-%m-%d %H:%M:%S')
+					)]
+
+			db.executemany('INSERT INTO block_rewards VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			db.executemany('INSERT INTO mining_status VALUES (?, ?, ?, ?)', [('x11', 10, 1000.0, 123456789.0), ('scrypt', 5, 20.0, 987654321.0)])
+			db.commit()
+
+			config = {'host': 'localhost', 'port': 3306, 'username': '', 'password': '', 'database': ''}
+			stats_repo = vlsblockdb.VelesBlockInfoRepository(**config)
+			mining_repo = vlsblockdb.VelesMiningStatusRepository(**config)
+			stats_repo.connection = mining_repo.connection = SQLiteConnection(db)
+			self.composer = VelesMiningStatsComposer(stats_repo, mining_repo, VelesMiningApiWebServer.algos, VelesMiningApiWebServer.pow_reward_perc)
+			self.reference = ReferenceComposer(self.composer)
+
+		def encode(self, result):
+			return json.dumps(result, indent=4, sort_keys=True)
+
+		def test_stats(self):
+			for hours in self.windows:
+				self.assertEqual(self.encode(self.reference.compose_stats(hours)), self.encode(self.composer.compose_stats(hours)))
+
+		def test_stats_for_algo(self):
+			for algo in VelesMiningApiWebServer.algos:
+				for hours in self.windows:
+					self.assertEqual(
+						self.encode(self.reference.compose_stats_for_algo(algo, hours)),
+						self.encode(self.composer.compose_stats_for_algo(algo, hours))
+						)
+
+		def test_cached_algo_stats(self):
+			# the per-algo payloads the cache builds along with the overall ones
+			for hours in self.windows:
+				stats, algo_stats = self.composer.compose_stats_with_algos(hours)
+
+				for algo in VelesMiningApiWebServer.algos:
+					self.assertEqual(self.encode(self.reference.compose_stats_for_algo(algo, hours)), self.encode(algo_stats[algo]))
+
+	result = unittest.TextTestRunner(verbosity = 2).run(unittest.defaultTestLoader.loadTestsFromTestCase(TestMiningStatsComposer))
+	sys.exit(0 if result.wasSuccessful() else 1)
+
 # Basic commandline interface
 def main():
 	# Process the arguments
 	parser = argparse.ArgumentParser(description='Veles Mining Stats API Stand-alone Server')
 	parser.add_argument('--config', default='websiteapi.conf',
 			help='path to the configuration file')
+	parser.add_argument('--migrate-block-rewards', action='store_true',
+			help='add the primary key to an old block_rewards table, dropping the duplicate rows')
+	parser.add_argument('--backfill', action='store_true',
+			help='fill block_rewards from the block explorer up to the current tip')
+	parser.add_argument('--backfill-from', type=int, default=None,
+			help='first block to backfill, the one after the last stored by default')
+	parser.add_argument('--self-test', action='store_true',
+			help='compare the stats composition with the original one on a fixture')
 	args = parser.parse_args()
 
+	if args.self_test:
+		self_test()
+		return
+
 	# Read the config gile
 	if not os.path.isfile(args.config):
 		raise ConfigurationError('Configuration file not found: {}\n'
@@ -204,7 +573,17 @@ def main():
 
 	# Boot the server app
 	server = VelesMiningApiWebServer(config)
-	server.run()
+
+	if args.migrate_block_rewards:
+		dropped = server.stats_repo.migrate_primary_key()
+		print('Primary key already present' if dropped == None else 'Primary key added, %i duplicate rows dropped' % dropped)
+	elif args.backfill:
+		explorer = vlsexplorer.VelesBlockExplorer()
+		loop = asyncio.get_event_loop()
+		loop.run_until_complete(backfill_block_rewards(server.stats_repo, explorer, args.backfill_from))
+		loop.run_until_complete(explorer.http.close())
+	else:
+		server.run()
 
 if __name__=='__main__':
 	main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+#
+# Admission control and load shedding
+#
+import asyncio
+import json
+import math
+import time
+
+from aiohttp import web
+
+import vlsmetrics
+
+requests_shed = vlsmetrics.registry.counter('veles_requests_shed_total', 'Requests refused on overload', ['kind', 'reason'])
+overload_load = vlsmetrics.registry.gauge('veles_overload_load', 'Load relative to the shedding threshold, shedding from 1')
+
+# Decides whether to take more of the expensive work (uncached RPC, database
+# queries) from the event loop lag and the number of such requests already in
+# progress. The load is the higher of lag / max_lag and in_flight /
+# max_in_flight, from 1 up new expensive requests are refused with a retry
+# hint growing with the load, until the lag and the queue go down. Cheap
+# requests (cached data, events) don't go through here and keep flowing. The
+# lag samples come from the server's loop monitor, observe_lag() on each.
+class VelesAdmissionController(object):
+	max_lag = 0.25
+	max_in_flight = 100
+	retry_after = 2
+	lag_smoothing = 0.5	# weight of the newest lag sample
+
+	def __init__(self, max_lag = None, max_in_flight = None, retry_after = None):
+		# values may come as strings from the config
+		if max_lag != None:
+			self.max_lag = float(max_lag)
+
+		if max_in_flight != None:
+			self.max_in_flight = int(max_in_flight)
+
+		if retry_after != None:
+			self.retry_after = float(retry_after)
+
+		self.lag = 0
+		self.in_flight = 0
+		vlsmetrics.registry.gauge('veles_requests_in_flight', 'Expensive requests in progress', function = lambda: self.in_flight)
+
+	def observe_lag(self, lag):
+		self.lag = self.lag * (1 - self.lag_smoothing) + lag * self.lag_smoothing
+		overload_load.set(self.get_load())
+
+	def get_load(self):
+		return max(self.lag / self.max_lag, self.in_flight / self.max_in_flight)
+
+	def try_enter(self, kind):
+		# None when admitted, leave() has to follow then; otherwise the
+		# seconds the client should wait before retrying
+		load = self.get_load()
+
+		if load >= 1:
+			requests_shed.inc(kind=kind, reason='lag' if self.lag >= self.max_lag else 'in_flight')
+			return int(math.ceil(self.retry_after * load))
+
+		self.in_flight += 1
+		return None
+
+	def leave(self):
+		self.in_flight -= 1
+
+def create_middleware(controller, cheap_paths = (), is_cached = None):
+	# aiohttp middleware answering 503 with Retry-After on overload, except
+	# for the paths served from memory and the requests is_cached(request)
+	# finds a cached response for
+	@web.middleware
+	@asyncio.coroutine
+	def admission_middleware(request, handler):
+		if request.path in cheap_paths or (is_cached and is_cached(request)):
+			return (yield from handler(request))
+
+		retry_after = controller.try_enter('http')
+
+		if retry_after:
+			return web.Response(
+				status = 503,
+				text = json.dumps({'status': 'error', 'message': 'Server overloaded, retry later'}),
+				headers = {'Retry-After': str(retry_after), 'Content-Type': 'application/json'}
+				)
+
+		try:
+			return (yield from handler(request))
+		finally:
+			controller.leave()
+
+	return admission_middleware
+
+# Self-test driving a small HTTP app into overload
+if __name__ == "__main__":
+
+	import unittest
+	import aiohttp
+
+	class TestAdmissionController(unittest.TestCase):
+
+		def test_in_flight_limit(self):
+			controller = VelesAdmissionController(max_in_flight = 2)
+			self.assertIsNone(controller.try_enter('ws'))
+			self.assertIsNone(controller.try_enter('ws'))
+			self.assertEqual(2, controller.try_enter('ws'))	# load 1, retry_after * 1
+			controller.leave()
+			self.assertIsNone(controller.try_enter('ws'))
+
+		def test_lag_limit(self):
+			controller = VelesAdmissionController(max_lag = 0.1)
+
+			for i in range(5):
+				controller.observe_lag(0.5)
+
+			self.assertGreater(controller.try_enter('ws'), 2)
+
+			for i in range(10):
+				controller.observe_lag(0)
+
+			self.assertIsNone(controller.try_enter('ws'))
+
+	class TestOverloadedServer(unittest.TestCase):
+
+		def setUp(self):
+			self.loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(self.loop)
+			self.controller = VelesAdmissionController(max_lag = 0.05, max_in_flight = 3)
+
+			@asyncio.coroutine
+			def handle_slow(request):
+				yield from asyncio.sleep(0.3)
+				return web.json_response({'status': 'success'})
+
+			@asyncio.coroutine
+			def handle_cached(request):
+				return web.json_response({'status': 'success'})
+
+			@asyncio.coroutine
+			def handle_blocking(request):
+				time.sleep(0.3)	# eg. a blocking query, stalls the loop
+				return web.json_response({'status': 'success'})
+
+			@asyncio.coroutine
+			def monitor_lag(interval = 0.1):
+				while True:
+					started = time.perf_counter()
+					yield from asyncio.sleep(interval)
+					self.controller.observe_lag(max(0, time.perf_counter() - started - interval))
+
+			app = web.Application(middlewares = [create_middleware(self.controller, ['/cached'], lambda request: request.query.get('hit') == '1')])
+			app.router.add_get('/slow', handle_slow)
+			app.router.add_get('/cached', handle_cached)
+			app.router.add_get('/blocking', handle_blocking)
+			self.runner = web.AppRunner(app)
+			self.loop.run_until_complete(self.runner.setup())
+			site = web.TCPSite(self.runner, '127.0.0.1', 0)
+			self.loop.run_until_complete(site.start())
+			self.url = 'http://127.0.0.1:%i' % site._server.sockets[0].getsockname()[1]
+			self.session = aiohttp.ClientSession()
+			self.monitor = asyncio.ensure_future(monitor_lag())
+
+		def tearDown(self):
+			self.monitor.cancel()
+			self.loop.run_until_complete(self.session.close())
+			self.loop.run_until_complete(self.runner.cleanup())
+			self.loop.close()
+
+		@asyncio.coroutine
+		def get(self, path):
+			response = yield from self.session.get(self.url + path)
+			yield from response.read()
+			return response.status, response.headers.get('Retry-After')
+
+		def test_sheds_over_in_flight_limit(self):
+			results = self.loop.run_until_complete(asyncio.gather(*[self.get('/slow') for i in range(10)]))
+			statuses = [status for status, retry_after in results]
+			self.assertEqual(3, statuses.count(200))
+			self.assertEqual(7, statuses.count(503))
+			self.assertTrue(all([int(retry_after) > 0 for status, retry_after in results if status == 503]))
+
+			# cached path keeps flowing while the slow ones are in progress
+			@asyncio.coroutine
+			def mixed():
+				slow = [asyncio.ensure_future(self.get('/slow')) for i in range(3)]
+				yield from asyncio.sleep(0.1)
+				cached = yield from self.get('/cached')
+				shed = yield from self.get('/slow')
+				yield from asyncio.gather(*slow)
+				return cached, shed
+
+			cached, shed = self.loop.run_until_complete(mixed())
+			self.assertEqual(200, cached[0])
+			self.assertEqual(503, shed[0])
+			self.assertEqual(0, self.controller.in_flight)
+
+		def test_sheds_on_loop_lag_and_recovers(self):
+			self.loop.run_until_complete(self.get('/blocking'))
+			self.loop.run_until_complete(asyncio.sleep(0.03))	# the monitor notices the stall
+			self.assertGreaterEqual(self.controller.get_load(), 1)
+			self.assertEqual(503, self.loop.run_until_complete(self.get('/slow'))[0])
+			self.assertEqual(200, self.loop.run_until_complete(self.get('/cached'))[0])
+			self.assertEqual(200, self.loop.run_until_complete(self.get('/slow?hit=1'))[0])	# cache hit on a shed path
+
+			self.loop.run_until_complete(asyncio.sleep(0.5))	# lag decays
+			self.assertEqual(200, self.loop.run_until_complete(self.get('/slow'))[0])
+
+	unittest.main(verbosity=2)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#
+# Token bucket rate limiting of the websocket commands
+#
+import collections
+import time
+
+import vlsmetrics
+
+limiter_requests = vlsmetrics.registry.counter('veles_ratelimit_requests_total', 'Rate limited commands by result and limiting scope', ['result', 'scope'])
+limiter_cost = vlsmetrics.registry.counter('veles_ratelimit_tokens_total', 'Tokens taken by the allowed commands', ['service'])
+limiter_ips = vlsmetrics.registry.gauge('veles_ratelimit_tracked_ips', 'Client addresses with a rate limiter bucket')
+
+# Holds up to burst tokens, refilled with rate tokens per second
+class VelesTokenBucket(object):
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated_at = time.monotonic()
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+		self.updated_at = now
+
+	def get_wait(self, cost, now):
+		# seconds until cost tokens are available, 0 when they are now
+		self.refill(now)
+
+		if self.tokens >= cost:
+			return 0
+
+		return (cost - self.tokens) / self.rate
+
+	def take(self, cost):
+		self.tokens -= cost
+
+# Every command takes its cost from the bucket of the connection and from the
+# one shared by all the connections of the same address, only when both have
+# enough tokens. Costs come by 'service.command', 'service.*' and '*', so the
+# RPCs expensive for the node (UTXO set scan, full masternode list) can cost
+# more than the cheap cached lookups. A cost above the burst is capped to it,
+# the command is still possible, just not more often than the refill allows.
+class VelesRateLimiter(object):
+	rate = 5
+	burst = 20
+	ip_rate = 20
+	ip_burst = 60
+	max_ips = 100000
+	costs = {
+		'*': 1,
+		'node.*': 2,
+		'node.getblock': 3,
+		'node.getrawtransaction': 3,
+		'node.getrawmempool': 5,
+		'node.masternodelist': 5,
+		'node.getmultialgostatus': 5,
+		'node.gettxoutsetinfo': 20,
+		'stats.*': 2,
+		}
+
+	def __init__(self, rate = None, burst = None, ip_rate = None, ip_burst = None, costs = None):
+		# values may come as strings from the config, costs as
+		# "node.gettxoutsetinfo=20, stats.*=2"
+		for name, value in [('rate', rate), ('burst', burst), ('ip_rate', ip_rate), ('ip_burst', ip_burst)]:
+			if value != None:
+				setattr(self, name, float(value))
+
+		self.costs = dict(self.costs)
+
+		if costs:
+			for item in costs.split(','):
+				command, cost = item.strip().split('=')
+				self.costs[command.strip()] = float(cost)
+
+		self.ip_buckets = collections.OrderedDict()
+
+	def split_ip_limits(self, parts):
+		# share of one process when the connections of an address are spread
+		# over several worker processes, each with its own buckets
+		self.ip_rate /= parts
+		self.ip_burst /= parts
+
+	def create_bucket(self):
+		return VelesTokenBucket(self.rate, self.burst)
+
+	def get_cost(self, service, command):
+		for key in ['%s.%s' % (service, command), '%s.*' % service, '*']:
+			if key in self.costs:
+				return self.costs[key]
+
+		return 1
+
+	def get_ip_bucket(self, ip, now):
+		if ip in self.ip_buckets:
+			self.ip_buckets.move_to_end(ip)
+			return self.ip_buckets[ip]
+
+		# forget the least recently active addresses
+		while len(self.ip_buckets) >= self.max_ips:
+			self.ip_buckets.popitem(last = False)
+
+		bucket = self.ip_buckets[ip] = VelesTokenBucket(self.ip_rate, self.ip_burst)
+		limiter_ips.set(len(self.ip_buckets))
+		return bucket
+
+	def check(self, bucket, ip, service, command):
+		# returns None when allowed (and takes the tokens), otherwise the
+		# limiting scope and the seconds to wait before retrying
+		now = time.monotonic()
+		ip_bucket = self.get_ip_bucket(ip, now)
+		cost = self.get_cost(service, command)
+
+		for scope, scope_bucket in [('connection', bucket), ('ip', ip_bucket)]:
+			wait = scope_bucket.get_wait(min(cost, scope_bucket.burst), now)
+
+			if wait:
+				limiter_requests.inc(result='limited', scope=scope)
+				return {'scope': scope, 'cost': cost, 'retry-after': round(wait, 3)}
+
+		bucket.take(min(cost, bucket.burst))
+		ip_bucket.take(min(cost, ip_bucket.burst))
+		limiter_requests.inc(result='allowed', scope='all')
+		limiter_cost.inc(cost, service=service)
+		return None
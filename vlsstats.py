@@ -1,18 +1,53 @@
 #!/usr/bin/python3
 import vlswallet
+import vlsmetrics
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine, exists
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session, joinedload
 from sqlalchemy.schema import Table, Column, ForeignKey, MetaData
 from sqlalchemy.types import Integer, String, Float, TypeDecorator, Date
 from sqlalchemy.dialects.mysql import MEDIUMBLOB, BIGINT
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, bindparam
+import collections
 import json
+import threading
+import zlib
 from datetime import datetime
 import time
 
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
 Base = declarative_base()
 
+query_seconds = vlsmetrics.registry.histogram('veles_db_query_seconds', 'Chain stats database query duration', ['query'])
+
+def timed_query(method):
+	# the outermost query ends the session of its thread, so the next one
+	# starts a new transaction and sees the blocks committed meanwhile
+	def wrapper(self, *args, **kwargs):
+		depth = getattr(self.query_depth, 'value', 0)
+		self.query_depth.value = depth + 1
+
+		try:
+			with query_seconds.time(query=method.__name__):
+				return method(self, *args, **kwargs)
+		finally:
+			self.query_depth.value = depth
+
+			if not depth:
+				self.session.remove()
+
+	wrapper.__name__ = method.__name__
+	return wrapper
+
 class JSONEncodedDict(TypeDecorator):
 	impl = MEDIUMBLOB
 
@@ -27,6 +62,100 @@ class JSONEncodedDict(TypeDecorator):
 			value = json.loads(value)
 		return value
 
+# Versioned compact encoding of the transaction vin/vout blobs. The first byte
+# tells the format: legacy rows are plain JSON (starting with '[' or '{'),
+# new ones are MessagePack, compressed with zstd (if the zstandard package is
+# installed) or zlib when that makes them smaller. Without msgpack installed
+# the values are still written as JSON, and every format can always be read.
+class CompactCodec(object):
+	MSGPACK = b'\x01'
+	MSGPACK_ZLIB = b'\x02'
+	MSGPACK_ZSTD = b'\x03'
+	compress_threshold = 256
+	zlib_level = 6
+	zstd_level = 3
+	zstd_contexts = threading.local()	# zstd (de)compressors are costly to create and not thread-safe
+
+	@classmethod
+	def zstd_compressor(cls):
+		if not hasattr(cls.zstd_contexts, 'compressor'):
+			cls.zstd_contexts.compressor = zstandard.ZstdCompressor(level=cls.zstd_level)
+			cls.zstd_contexts.decompressor = zstandard.ZstdDecompressor()
+
+		return cls.zstd_contexts.compressor
+
+	@classmethod
+	def zstd_decompressor(cls):
+		cls.zstd_compressor()
+		return cls.zstd_contexts.decompressor
+
+	@classmethod
+	def encode(cls, value, compress = True):
+		if not msgpack:
+			return bytes(json.dumps(value), 'utf8')
+
+		packed = msgpack.packb(value, use_bin_type=True)
+
+		if compress and len(packed) >= cls.compress_threshold:
+			if zstandard:
+				compressed = cls.MSGPACK_ZSTD + cls.zstd_compressor().compress(packed)
+			else:
+				compressed = cls.MSGPACK_ZLIB + zlib.compress(packed, cls.zlib_level)
+
+			if len(compressed) < len(packed) + 1:
+				return compressed
+
+		return cls.MSGPACK + packed
+
+	@classmethod
+	def decode(cls, data):
+		if data is None:
+			return None
+
+		data = bytes(data)
+		version = data[:1]
+
+		if version == cls.MSGPACK:
+			return msgpack.unpackb(data[1:], raw=False)
+
+		if version == cls.MSGPACK_ZLIB:
+			return msgpack.unpackb(zlib.decompress(data[1:]), raw=False)
+
+		if version == cls.MSGPACK_ZSTD:
+			return msgpack.unpackb(cls.zstd_decompressor().decompress(data[1:]), raw=False)
+
+		return json.loads(data.decode('utf8'))
+
+	@classmethod
+	def is_legacy(cls, data):
+		return data is not None and bytes(data[:1]) not in [cls.MSGPACK, cls.MSGPACK_ZLIB, cls.MSGPACK_ZSTD]
+
+# Model attribute backed by a raw CompactCodec encoded column, decoded only on
+# the first access and then kept until the raw value changes.
+class CompactEncodedField(object):
+	def __init__(self, raw_attribute):
+		self.raw_attribute = raw_attribute
+		self.cache_attribute = '_decoded' + raw_attribute
+
+	def __get__(self, instance, owner):
+		if instance is None:
+			return self
+
+		raw = getattr(instance, self.raw_attribute)
+		cached = instance.__dict__.get(self.cache_attribute)
+
+		if cached and cached[0] is raw:
+			return cached[1]
+
+		value = CompactCodec.decode(raw)
+		instance.__dict__[self.cache_attribute] = (raw, value)
+		return value
+
+	def __set__(self, instance, value):
+		raw = CompactCodec.encode(value) if value is not None else None
+		setattr(instance, self.raw_attribute, raw)
+		instance.__dict__[self.cache_attribute] = (raw, value)
+
 class CoinAmount(TypeDecorator):
 	impl = BIGINT
 
@@ -65,7 +194,7 @@ class FillableBase(Base):
 
 		return attrs; #{name: getattr(self, c.name) for c in self.__table__.columns}
 
-class Block(Base):
+class Block(FillableBase):
 	__tablename__ = 'block'
 	hash = Column(String, primary_key=True)
 	strippedsize = Column(Integer, nullable=False)
@@ -95,7 +224,7 @@ class Block(Base):
 			if key != 'tx':
 				setattr(self, key, value)
 
-class Transaction(Base):
+class Transaction(FillableBase):
 	__tablename__ = 'transaction'
 	txid = Column(String, primary_key=True)
 	hash = Column(String, nullable=False)
@@ -105,8 +234,10 @@ class Transaction(Base):
 	weight = Column(Integer, nullable=False, unique=True)
 	version = Column(Integer, nullable=False)
 	locktime = Column(String, nullable=False)
-	vin = Column(JSONEncodedDict, nullable=False)
-	vout = Column(JSONEncodedDict, nullable=False)
+	_vin = Column('vin', MEDIUMBLOB, nullable=False)
+	_vout = Column('vout', MEDIUMBLOB, nullable=False)
+	vin = CompactEncodedField('_vin')
+	vout = CompactEncodedField('_vout')
 	blockhash = Column(String, ForeignKey('block.hash'))
 	block = relationship("Block", back_populates="tx")
 
@@ -117,7 +248,7 @@ class Transaction(Base):
 			if not key in ignore_keys:
 				setattr(self, key, value)
 
-class BlockReward(Base):
+class BlockReward(FillableBase):
 	__tablename__ = 'block_reward'
 	height = Column(Integer, ForeignKey('block.height'), primary_key=True)
 	amount = Column(CoinAmount, nullable=False)
@@ -128,13 +259,46 @@ class BlockReward(Base):
 	dev = Column(CoinAmount)
 	algo = Column(String)
 
-class BlockHashrate(Base):
+class BlockHashrate(FillableBase):
 	__tablename__ = 'block_hashrate'
 	height = Column(Integer, ForeignKey('block.height'), primary_key=True)
 	hashrate = Column(Float, nullable=False)
 	difficulty = Column(Float, nullable=False)
 	algo = Column(String)
 
+class AddressOutput(FillableBase):
+	__tablename__ = 'address_output'
+	txid = Column(String, primary_key=True)
+	n = Column(Integer, primary_key=True, autoincrement=False)
+	address = Column(String, nullable=False, index=True)
+	value = Column(CoinAmount, nullable=False)
+	height = Column(Integer, nullable=False)
+	spent_txid = Column(String, nullable=True)
+	spent_height = Column(Integer, nullable=True)
+
+class AddressHistory(FillableBase):
+	__tablename__ = 'address_history'
+	id = Column(Integer, primary_key=True, autoincrement=True)
+	address = Column(String, nullable=False, index=True)
+	txid = Column(String, nullable=False)
+	height = Column(Integer, nullable=False)
+	value = Column(CoinAmount, nullable=False)
+
+class AddressBalance(FillableBase):
+	__tablename__ = 'address_balance'
+	address = Column(String, primary_key=True)
+	balance = Column(CoinAmount, nullable=False)
+	received = Column(CoinAmount, nullable=False)
+	sent = Column(CoinAmount, nullable=False)
+	tx_count = Column(Integer, nullable=False)
+	last_height = Column(Integer, nullable=False)
+
+class ChainIndexState(FillableBase):
+	__tablename__ = 'index_state'
+	name = Column(String, primary_key=True)
+	height = Column(Integer, nullable=False)	# indexed through this block
+	block_hash = Column(String, nullable=False)
+
 class CoinDailySupply(Base):
 	__tablename__ = 'daily_supply'
 	id = Column(Integer, primary_key=True)
@@ -159,14 +323,24 @@ class VelesChainStatsDB(object):
 	debug = True
 	tables = {}
 	engine = None
+	hot_blocks_size = 256
+	max_latest_blocks = 100
+	max_history_items = 500
+	max_sync_blocks = 100
 
-	def __init__(self, host, port, username, password, database, wallet = None):
+	def __init__(self, host, port, username, password, database, wallet = None, supply_tracker = None):
 		self.host = host
 		self.port = int(port)
 		self.username = username
 		self.password = password
 		self.database = database
 		self.wallet = wallet
+		self.supply_tracker = supply_tracker
+		self.hot_blocks = collections.OrderedDict()
+		self.hot_heights = {}
+		self.hot_lock = threading.Lock()	# evicted from the event bus thread
+		self.hot_generation = 0
+		self.query_depth = threading.local()	# nested timed queries of the thread
 		self.debug("Connecting to %s on %s" % (database, host))
 		self.engine = create_engine('mysql+pymysql://%s:%s@%s:%i/%s' % (username, password, host, int(port), database))#, echo=True)
 		self.connect()
@@ -174,41 +348,125 @@ class VelesChainStatsDB(object):
 
 	def connect(self):
 		self.connection = self.engine.connect()
-		Session = sessionmaker(bind=self.engine)
-		self.session = Session()
+		# a session per thread, events are handled on the event bus thread
+		self.session = scoped_session(sessionmaker(bind=self.engine))
 		self.debug("Connected")
 	
 	def handle_event(self, name, data):
 		self.debug("Received event " + name)
 
-		if name == 'state_changed' and 'entity-id' in data and 'new-state' in data:
-			if data['entity-id'] == 'chain.tip':
-				self.on_chain_tip_change(data['new-state'])
+		try:
+			if name == 'state_changed' and 'entity-id' in data and 'new-state' in data:
+				if data['entity-id'] == 'chain.tip':
+					self.on_chain_tip_change(data['new-state'])
 
-			elif data['entity-id'] == 'chain.pow':
-				self.on_chain_pow_change(data['new-state'])
+				elif data['entity-id'] == 'chain.pow':
+					self.on_chain_pow_change(data['new-state'])
+		except:
+			self.session.rollback()	# the next event gets a usable session
+			raise
 
 	def on_chain_tip_change(self, data):
 		self.debug("Got new tip of height %s" % data['height'])
 
 		if self.wallet:
-			result = self.wallet.rpc_call("getblock", [data['hash'], 2])
-
-			if not self.session.query(exists().where(Block.hash == data['hash'])).scalar():
-				block = Block()
-				block.fill(result)
-				self.session.add(block)
-				self.session.add(self.get_block_reward(result))
-
-				for tx in result['tx']:
-					if not self.session.query(exists().where(Transaction.txid == tx['txid'])).scalar():
-						tx.update({'blockhash': data['hash']})
-						transaction = Transaction()
-						transaction.fill(tx)
-						self.session.add(transaction)
-				
+			result = self.wallet.rpc_call("getblock", [data['hash'], 2], priority=vlswallet.PRIORITY_INGEST)
+			state = self.get_index_state()
+
+			if state:
+				self.sync_chain(state, result)
+			else:	# address index not built yet (--reindex), just the tip
+				self.store_block(result)
 				self.session.commit()
 
+			# a reorg replaces the cached blocks from this height up
+			self.evict_hot_blocks(lambda block: block['height'] >= result['height'])
+
+	def sync_chain(self, state, tip):
+		# Moves the indexed chain to the tip one block at a time, committing
+		# each: the blocks no longer in the chain of the tip are unwound, the
+		# ones missed since the last tip are fetched and ingested. At most
+		# max_sync_blocks per call, True once at the tip.
+		for step in range(self.max_sync_blocks):
+			if state.height > tip['height'] or (state.height == tip['height'] and state.block_hash != tip['hash']):
+				self.unwind_block(state)
+
+			elif state.height == tip['height']:
+				return True
+
+			else:
+				if state.height + 1 == tip['height']:
+					block = tip
+				else:
+					block_hash = self.wallet.rpc_call("getblockhash", [state.height + 1], priority=vlswallet.PRIORITY_INGEST)
+					block = self.wallet.rpc_call("getblock", [block_hash, 2], priority=vlswallet.PRIORITY_INGEST)
+
+				if block['previousblockhash'] != state.block_hash:
+					self.unwind_block(state)
+				else:
+					self.store_block(block)
+					self.index_addresses(block)
+					state.height = block['height']
+					state.block_hash = block['hash']
+
+			self.session.commit()
+
+		return False
+
+	def store_block(self, block_details):
+		# block with its transactions and reward, replacing the orphaned block
+		# of the same height if any, the caller commits
+		reward = self.get_block_reward(block_details)
+
+		if self.supply_tracker:
+			self.supply_tracker.add_block(block_details['height'], reward.amount, block_details['hash'], block_details.get('previousblockhash'))
+
+		if self.session.query(exists().where(Block.hash == block_details['hash'])).scalar():
+			return
+
+		for orphan in self.session.query(Block).filter(Block.height == block_details['height']).all():
+			self.delete_block(orphan.hash)
+
+		self.session.query(BlockReward).filter(BlockReward.height == block_details['height']).delete(synchronize_session=False)
+		block = Block()
+		block.fill(block_details)
+		self.session.add(block)
+		self.session.add(reward)
+
+		for tx in block_details['tx']:
+			if not self.session.query(exists().where(Transaction.txid == tx['txid'])).scalar():
+				tx.update({'blockhash': block_details['hash']})
+				transaction = Transaction()
+				transaction.fill(tx)
+				self.session.add(transaction)
+
+		self.session.flush()
+
+	def delete_block(self, block_hash):
+		block = self.session.query(Block).filter(Block.hash == block_hash).one_or_none()
+
+		if not block:
+			return
+
+		self.session.query(Transaction).filter(Transaction.blockhash == block_hash).delete(synchronize_session=False)
+		self.session.query(BlockReward).filter(BlockReward.height == block.height).delete(synchronize_session=False)
+		self.session.delete(block)
+		self.session.flush()
+
+	def unwind_block(self, state):
+		# reverts the indexed tip block, its parent comes from the node (which
+		# keeps the stale blocks)
+		self.debug("Unwinding block %s at height %i" % (state.block_hash, state.height))
+		block = self.wallet.rpc_call("getblock", [state.block_hash], priority=vlswallet.PRIORITY_INGEST)
+
+		if not isinstance(block, dict) or not block.get('previousblockhash'):
+			raise ValueError('Cannot unwind block %s, the address index needs --reindex' % state.block_hash)
+
+		self.unindex_addresses(state.height)
+		self.delete_block(state.block_hash)
+		state.height -= 1
+		state.block_hash = block['previousblockhash']
+
 	def on_chain_pow_change(self, data):
 		self.debug("Got new PoW state")
 
@@ -223,6 +481,21 @@ class VelesChainStatsDB(object):
 
 		self.session.commit()
 
+		# blocks cached before their hashrate was stored
+		heights = set([algo_status['last_block_index'] for algo_status in data['multialgo'].values()])
+		self.evict_hot_blocks(lambda block: block['height'] in heights)
+
+	def evict_hot_blocks(self, predicate):
+		with self.hot_lock:
+			self.hot_generation += 1
+
+			for block_hash, block in list(self.hot_blocks.items()):
+				if predicate(block):
+					del self.hot_blocks[block_hash]
+
+					if self.hot_heights.get(block['height']) == block_hash:
+						del self.hot_heights[block['height']]
+
 
 	def save_daily_price(self, data, stats_date):
 		self.debug("Saving Daily Price state")
@@ -240,6 +513,7 @@ class VelesChainStatsDB(object):
 
 		self.session.commit()
 
+	@timed_query
 	def query_daily_price(self, days):
 		result = [];
 		items = self.session.query(CoinDailyPrice).order_by(CoinDailyPrice.date.desc()).limit(days).all()
@@ -249,11 +523,88 @@ class VelesChainStatsDB(object):
 
 		return result
 
+	@timed_query
 	def query_block_stats(self, height):
-		#try:
-		return self.session.query(Block).filter(Block.height == height).one().attributes()
-		#except:
-		#	return None
+		return self.query_block(height)
+
+	@timed_query
+	def query_block(self, block_id):
+		# block by height or hash including its transactions and rewards,
+		# recently requested blocks are served from memory
+		with self.hot_lock:
+			if self.is_height(block_id):
+				block_hash = self.hot_heights.get(int(block_id))
+			else:
+				block_hash = block_id
+
+			if block_hash in self.hot_blocks:
+				self.hot_blocks.move_to_end(block_hash)
+				return self.hot_blocks[block_hash]
+
+			generation = self.hot_generation
+
+		query = self.session.query(Block).options(joinedload(Block.tx), joinedload(Block.reward), joinedload(Block.hashrate))
+
+		if self.is_height(block_id):
+			block = query.filter(Block.height == int(block_id)).one_or_none()
+		else:
+			block = query.filter(Block.hash == block_id).one_or_none()
+
+		if not block:
+			return None
+
+		result = block.attributes()
+		result['tx'] = [tx.attributes() for tx in block.tx]
+		result['reward'] = block.reward.attributes() if block.reward else None
+		result['hashrate'] = block.hashrate.attributes() if block.hashrate else None
+
+		with self.hot_lock:
+			if generation != self.hot_generation:
+				return result	# evicted while querying, may be outdated already
+
+			self.hot_blocks[block.hash] = result
+			self.hot_heights[block.height] = block.hash
+
+			while len(self.hot_blocks) > self.hot_blocks_size:
+				evicted_hash, evicted = self.hot_blocks.popitem(last = False)
+
+				if self.hot_heights.get(evicted['height']) == evicted_hash:
+					del self.hot_heights[evicted['height']]
+
+		return result
+
+	@timed_query
+	def query_block_reward(self, block_id):
+		block = self.query_block(block_id)
+
+		if not block:
+			return None
+
+		return block['reward']
+
+	@timed_query
+	def query_transaction(self, txid):
+		tx = self.session.query(Transaction).filter(Transaction.txid == txid).one_or_none()
+
+		if not tx:
+			return None
+
+		result = tx.attributes()
+		result['height'] = tx.block.height if tx.block else None
+		return result
+
+	@timed_query
+	def query_latest_blocks(self, count = 10):
+		result = []
+		count = max(1, min(int(count), self.max_latest_blocks))
+
+		for block in self.session.query(Block).order_by(Block.height.desc()).limit(count).all():
+			result += [block.attributes()]
+
+		return result
+
+	def is_height(self, block_id):
+		return isinstance(block_id, int) or (isinstance(block_id, str) and block_id.isdigit())
 	
 	def coin_to_satoshi(self, result):
 		if not result:
@@ -261,6 +612,7 @@ class VelesChainStatsDB(object):
 
 		return float(result)
 
+	@timed_query
 	def query_mining_stats(self, algo = None, hours = 24, total = False):
 		# Recursovely do all the algos if not specified
 		if not algo and not total:
@@ -403,9 +755,11 @@ class VelesChainStatsDB(object):
 		
 		return result
 
+	@timed_query
 	def query_mining_difficulty(self, algo, hours):
 		return query_mining_hashrate(algo, hours, true)
 
+	@timed_query
 	def query_mining_hashrate(self, algo = None, hours = 24, return_diff = False):
 		result = [];
 		query = self.session.query(BlockHashrate).join(Block, aliased=True)
@@ -456,6 +810,191 @@ class VelesChainStatsDB(object):
 
 		return reward
 
+	def index_addresses(self, block_details):
+		# Incremental address index: every output paying to an address is stored
+		# in address_output, spending it marks it spent, both are appended to the
+		# address_history and applied to address_balance. Lookups are batched
+		# per block, the caller commits.
+		height = block_details['height']
+		outputs = {}
+		spends = []
+		history = []
+		deltas = {}
+
+		for tx in block_details['tx']:
+			for vin in tx['vin']:
+				if 'txid' in vin and 'vout' in vin:
+					spends += [(tx['txid'], vin['txid'], vin['vout'])]
+
+			for vout in tx['vout']:
+				address = self.get_vout_address(vout)
+
+				if not address or not vout['value']:
+					continue
+
+				output = AddressOutput()
+				output.fill({'txid': tx['txid'], 'n': vout['n'], 'address': address, 'value': vout['value'], 'height': height})
+				outputs[(tx['txid'], vout['n'])] = output
+				self.session.add(output)
+				history += [(address, tx['txid'], vout['value'])]
+
+		spent_txids = list(set([spend[1] for spend in spends]))
+		spent_outputs = {}
+
+		for offset in range(0, len(spent_txids), 500):
+			for output in self.session.query(AddressOutput).filter(AddressOutput.txid.in_(spent_txids[offset:offset + 500])).all():
+				spent_outputs[(output.txid, output.n)] = output
+
+		spent_outputs.update(outputs)
+
+		for txid, prev_txid, prev_n in spends:
+			output = spent_outputs.get((prev_txid, prev_n))
+
+			if not output:
+				continue	# not an address output, or not indexed
+
+			output.spent_txid = txid
+			output.spent_height = height
+			history += [(output.address, txid, -output.value)]
+
+		for address, txid, value in history:
+			if address not in deltas:
+				deltas[address] = {'received': 0, 'sent': 0, 'txids': set()}
+
+			if value > 0:
+				deltas[address]['received'] += value
+			else:
+				deltas[address]['sent'] -= value
+
+			deltas[address]['txids'].add(txid)
+			item = AddressHistory()
+			item.fill({'address': address, 'txid': txid, 'height': height, 'value': value})
+			self.session.add(item)
+
+		addresses = list(deltas.keys())
+		balances = {}
+
+		for offset in range(0, len(addresses), 500):
+			for balance in self.session.query(AddressBalance).filter(AddressBalance.address.in_(addresses[offset:offset + 500])).all():
+				balances[balance.address] = balance
+
+		for address, delta in deltas.items():
+			if address not in balances:
+				balances[address] = AddressBalance()
+				balances[address].fill({'address': address, 'balance': 0, 'received': 0, 'sent': 0, 'tx_count': 0})
+				self.session.add(balances[address])
+
+			balance = balances[address]
+			balance.received = round(balance.received + delta['received'], 8)
+			balance.sent = round(balance.sent + delta['sent'], 8)
+			balance.balance = round(balance.received - balance.sent, 8)
+			balance.tx_count += len(delta['txids'])
+			balance.last_height = height
+
+	def get_vout_address(self, vout):
+		script = vout.get('scriptPubKey', {})
+
+		if 'address' in script:
+			return script['address']
+
+		if 'addresses' in script and len(script['addresses']) == 1:
+			return script['addresses'][0]
+
+		return None
+
+	def unindex_addresses(self, height):
+		# Reverts index_addresses() of the block at height: its outputs and
+		# history go away, the outputs it spent are unspent again and the
+		# balances lose its deltas. The caller commits.
+		deltas = {}
+
+		for item in self.session.query(AddressHistory).filter(AddressHistory.height == height).all():
+			if item.address not in deltas:
+				deltas[item.address] = {'received': 0, 'sent': 0, 'txids': set()}
+
+			if item.value > 0:
+				deltas[item.address]['received'] += item.value
+			else:
+				deltas[item.address]['sent'] -= item.value
+
+			deltas[item.address]['txids'].add(item.txid)
+
+		self.session.query(AddressOutput).filter(AddressOutput.height == height).delete(synchronize_session=False)
+		self.session.query(AddressOutput).filter(AddressOutput.spent_height == height).update({'spent_txid': None, 'spent_height': None}, synchronize_session=False)
+		self.session.query(AddressHistory).filter(AddressHistory.height == height).delete(synchronize_session=False)
+		addresses = list(deltas.keys())
+
+		for offset in range(0, len(addresses), 500):
+			chunk = addresses[offset:offset + 500]
+			last_heights = dict(self.session.query(AddressHistory.address, func.max(AddressHistory.height))
+				.filter(AddressHistory.address.in_(chunk)).group_by(AddressHistory.address).all())
+
+			for balance in self.session.query(AddressBalance).filter(AddressBalance.address.in_(chunk)).all():
+				delta = deltas[balance.address]
+				balance.tx_count -= len(delta['txids'])
+
+				if balance.tx_count <= 0 or balance.address not in last_heights:
+					self.session.delete(balance)
+					continue
+
+				balance.received = round(balance.received - delta['received'], 8)
+				balance.sent = round(balance.sent - delta['sent'], 8)
+				balance.balance = round(balance.received - balance.sent, 8)
+				balance.last_height = last_heights[balance.address]
+
+	def get_index_state(self):
+		return self.session.query(ChainIndexState).filter(ChainIndexState.name == 'address').one_or_none()
+
+	def reset_address_index(self):
+		# starts the index over at the genesis block, address rows left
+		# without a state (older versions indexed the tips only) can't be trusted
+		self.debug("Clearing the address index ...")
+
+		for model in [AddressOutput, AddressHistory, AddressBalance, ChainIndexState]:
+			self.session.query(model).delete(synchronize_session=False)
+
+		state = ChainIndexState()
+		state.fill({'name': 'address', 'height': 0, 'block_hash': self.wallet.rpc_call("getblockhash", [0])})
+		self.session.add(state)
+		self.session.commit()
+		return state
+
+	@timed_query
+	def query_address_balance(self, address):
+		balance = self.session.query(AddressBalance).filter(AddressBalance.address == address).one_or_none()
+
+		if not balance:
+			return None
+
+		return balance.attributes()
+
+	@timed_query
+	def query_address_history(self, address, limit = 50, before = None):
+		# keyset pagination, pass 'next' of the previous page as before
+		query = self.session.query(AddressHistory).filter(AddressHistory.address == address)
+		limit = max(1, min(int(limit), self.max_history_items))
+
+		if before:
+			query = query.filter(AddressHistory.id < int(before))
+
+		items = query.order_by(AddressHistory.id.desc()).limit(limit).all()
+
+		return {
+			'address': address,
+			'history': [item.attributes() for item in items],
+			'next': items[-1].id if len(items) == limit else None
+			}
+
+	@timed_query
+	def query_address_outputs(self, address, unspent_only = True, limit = 100):
+		query = self.session.query(AddressOutput).filter(AddressOutput.address == address)
+
+		if unspent_only:
+			query = query.filter(AddressOutput.spent_txid == None)
+
+		items = query.order_by(AddressOutput.height.desc()).limit(max(1, min(int(limit), self.max_history_items))).all()
+		return [item.attributes() for item in items]
+
 	def get_tx_value(self, tx_details):
 		value = 0
 
@@ -497,10 +1036,20 @@ class VelesChainStatsDB(object):
 
 		total_supply = 0;
 		last_date = None;
+		state = self.get_index_state() or self.reset_address_index()
 		result = self.wallet.rpc_call("getblock", [self.wallet.rpc_call("getblockhash", [1]), 2])
 
 		while 'nextblockhash' in result and result['nextblockhash']:
+			# contiguous continuation of the index, anything else is sorted
+			# out by sync_chain() at the tip
+			if result['height'] == state.height + 1 and result['previousblockhash'] == state.block_hash:
+				self.index_addresses(result)
+				state.height = result['height']
+				state.block_hash = result['hash']
+				self.session.commit()
+
 			if result['height'] < 288000:
+				result = self.wallet.rpc_call("getblock", [result['nextblockhash'], 2])
 				continue
 
 			if result['height'] % 100 == 0:
@@ -526,11 +1075,130 @@ class VelesChainStatsDB(object):
 
 			result = self.wallet.rpc_call("getblock", [result['nextblockhash'], 2])
 			last_date = block_date
+
+		while not self.sync_chain(state, result):
+			self.debug("Address index at height %i" % state.height)
 				
 
+	def migrate_tx_encoding(self, batch_size = 1000):
+		# Re-encodes the legacy JSON vin/vout blobs of the transaction table with
+		# CompactCodec, batch by batch in txid order, safe to interrupt and rerun.
+		self.debug("Migrating transaction vin/vout encoding ...")
+
+		if not msgpack:
+			self.log("msgpack is not installed, nothing to migrate to")
+			return
+
+		table = Transaction.__table__
+		last_txid = ''
+		migrated = 0
+		saved = 0
+
+		while True:
+			rows = self.session.execute(
+				table.select().with_only_columns([table.c.txid, table.c.vin, table.c.vout])
+					.where(table.c.txid > last_txid).order_by(table.c.txid).limit(batch_size)
+				).fetchall()
+
+			if not rows:
+				break
+
+			updates = []
+
+			for txid, vin, vout in rows:
+				if CompactCodec.is_legacy(vin) or CompactCodec.is_legacy(vout):
+					new_vin = CompactCodec.encode(CompactCodec.decode(vin))
+					new_vout = CompactCodec.encode(CompactCodec.decode(vout))
+					saved += len(vin) + len(vout) - len(new_vin) - len(new_vout)
+					updates += [{'_txid': txid, '_vin': new_vin, '_vout': new_vout}]
+
+			if updates:
+				self.session.execute(
+					table.update().where(table.c.txid == bindparam('_txid')).values(vin=bindparam('_vin'), vout=bindparam('_vout')),
+					updates
+					)
+				self.session.commit()
+				migrated += len(updates)
+
+			last_txid = rows[-1][0]
+			self.debug("Migrated %i transactions, saved %i bytes so far" % (migrated, saved))
+
+		self.debug("Migration done, %i transactions migrated, %i bytes saved" % (migrated, saved))
+
 	def log(self, msg):
 		print("VelesChainStatsDB: %s" % msg)
 
 	def debug(self, msg):
 		if (self.debug):
 			self.log("VelesChainStatsDB [debug] : %s" % msg)
+
+# Benchmark of the transaction vin/vout encodings on synthetic transactions
+def bench_tx_codec(count, outputs):
+	import random
+
+	txs = []
+
+	for i in range(count):
+		vin = [{
+			'txid': '%064x' % random.getrandbits(256),
+			'vout': random.randint(0, 3),
+			'scriptSig': {'asm': 'ab' * 70, 'hex': 'cd' * 71},
+			'sequence': 4294967295
+			}]
+		vout = [{
+			'value': round(random.random() * 100, 8),
+			'n': n,
+			'scriptPubKey': {
+				'asm': 'OP_DUP OP_HASH160 %040x OP_EQUALVERIFY OP_CHECKSIG' % random.getrandbits(160),
+				'hex': '76a914%040x88ac' % random.getrandbits(160),
+				'reqSigs': 1,
+				'type': 'pubkeyhash',
+				'addresses': ['V%033x' % random.getrandbits(132)]
+				}
+			} for n in range(outputs)]
+		txs += [vin, vout]
+
+	codecs = {'json': lambda value: bytes(json.dumps(value), 'utf8')}
+
+	if msgpack:
+		codecs['msgpack'] = lambda value: CompactCodec.encode(value, compress = False)
+		codecs['msgpack+zlib'] = lambda value: CompactCodec.MSGPACK_ZLIB + zlib.compress(msgpack.packb(value, use_bin_type=True), CompactCodec.zlib_level)
+
+		if zstandard:
+			codecs['msgpack+zstd'] = lambda value: CompactCodec.MSGPACK_ZSTD + CompactCodec.zstd_compressor().compress(msgpack.packb(value, use_bin_type=True))
+
+		codecs['auto'] = CompactCodec.encode
+
+	result = {'transactions': count, 'outputs_per_tx': outputs, 'codecs': {}}
+
+	for name, encode in codecs.items():
+		started = time.time()
+		encoded = [encode(value) for value in txs]
+		encode_time = time.time() - started
+
+		started = time.time()
+		decoded = [CompactCodec.decode(data) for data in encoded]
+		decode_time = time.time() - started
+
+		if decoded != txs:
+			raise ValueError('%s round-trip mismatch' % name)
+
+		result['codecs'][name] = {
+			'bytes': sum([len(data) for data in encoded]),
+			'encode_ms': round(encode_time * 1000, 2),
+			'decode_ms': round(decode_time * 1000, 2)
+			}
+
+	return result
+
+if __name__=='__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Veles chain stats storage')
+	parser.add_argument('--bench-tx-codec', type=int, default=10000,
+			help='number of synthetic transactions to encode and decode with every codec')
+	parser.add_argument('--outputs', type=int, default=2,
+			help='outputs per synthetic transaction')
+	args = parser.parse_args()
+
+	print(json.dumps(bench_tx_codec(args.bench_tx_codec, args.outputs), indent=4))
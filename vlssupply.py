@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+#
+# Circulating supply tracker
+#
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import vlslog
+
+# Keeps the total coin supply up to date by adding the coinbase amount of every
+# new block (as derived by VelesChainStatsDB.get_block_reward) instead of asking
+# the daemon to walk the whole UTXO set with gettxoutsetinfo on every request.
+# Coinbase amounts include the transaction fees, so the running total is
+# reconciled against gettxoutsetinfo on a slow schedule, or sooner when a gap
+# or a reorg is detected: a block is only counted on top of the block it
+# extends. Blocks come from the ingest thread and the reconciliation runs on
+# the executor, both update the running total under the lock. The masternode
+# count comes from the masternode poller.
+class VelesSupplyTracker(object):
+	max_supply = 2500000
+	reconcile_delay = 6*60*60
+	stale_retry_delay = 60
+
+	def __init__(self, wallet):
+		self.wallet = wallet
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.total_supply = None
+		self.height = None
+		self.block_hash = None
+		self.mn_count = None
+		self.mn_collateral = None
+		self.reconciled_at = 0
+		self.stale = True
+		self.lock = threading.Lock()
+
+	def add_block(self, height, amount, block_hash, previous_hash):
+		with self.lock:
+			if self.height == None:
+				return
+
+			if height == self.height + 1 and self.block_hash and previous_hash == self.block_hash:
+				self.total_supply += amount
+				self.height = height
+				self.block_hash = block_hash
+
+			elif height == self.height and block_hash == self.block_hash:
+				pass	# already counted, eg. the tip we've just reconciled at
+
+			else:
+				self.stale = True	# gap or reorg, needs to be reconciled
+
+	def set_masternode_count(self, count):
+		self.mn_count = count
+
+	def is_ready(self):
+		return self.total_supply != None and self.mn_count != None and self.mn_collateral != None
+
+	def get_supply_info(self):
+		if not self.is_ready():
+			return None
+
+		return {
+			'max_supply': self.max_supply,
+			'total_supply': self.total_supply,
+			'available_supply': self.total_supply - (self.mn_count * self.mn_collateral)
+		}
+
+	def reconcile(self):
+		utxo_info = self.wallet.rpc_call('gettxoutsetinfo')
+
+		if not isinstance(utxo_info, dict) or not 'total_amount' in utxo_info:
+			raise ValueError('Unexpected gettxoutsetinfo result: %s' % utxo_info)
+
+		self.mn_collateral = self.wallet.rpc_call('masternode', ['collateral'])
+
+		if self.mn_count == None:
+			self.mn_count = len(self.wallet.rpc_call('masternode', ['list']))
+
+		with self.lock:
+			self.total_supply = utxo_info['total_amount']
+			self.height = utxo_info['height']
+			self.block_hash = utxo_info.get('bestblock')
+			self.reconciled_at = time.time()
+			self.stale = False
+
+	@asyncio.coroutine
+	def reconcile_task(self):
+		while True:
+			if self.stale or time.time() - self.reconciled_at > self.reconcile_delay:
+				try:
+					yield from asyncio.get_event_loop().run_in_executor(self.executor, self.reconcile)
+				except Exception as e:
+					vlslog.logger.error('Error reconciling coin supply: %s', e)
+
+			yield from asyncio.sleep(self.stale_retry_delay)
@@ -1,14 +1,204 @@
 #!/usr/bin/python3
 import sys, os, asyncio, configparser, requests, json, time, pymysql, glob
+import collections, concurrent.futures, threading
+import vlsmetrics
+
+# RPC priority classes, the lower the sooner
+PRIORITY_TIP = 0	# new block pipeline
+PRIORITY_INGEST = 1	# block ingest and the state pollers
+PRIORITY_INTERACTIVE = 2	# client commands
+PRIORITY_BACKGROUND = 3	# supply, market and geo-location lookups
+priority_names = ['tip', 'ingest', 'interactive', 'background']
+
+rpc_seconds = vlsmetrics.registry.histogram('veles_rpc_call_seconds', 'Daemon RPC call duration', ['method'])
+rpc_errors = vlsmetrics.registry.counter('veles_rpc_errors_total', 'Daemon RPC calls failed or returning an error', ['method'])
+rpc_wait_seconds = vlsmetrics.registry.histogram('veles_rpc_queue_wait_seconds', 'Time waiting for a daemon RPC slot', ['priority'])
+rpc_queue_depth = vlsmetrics.registry.gauge('veles_rpc_queue_depth', 'Daemon RPC calls waiting for a slot', ['priority'])
+
+class VelesThreadWaiter(object):
+	def __init__(self):
+		self.event = threading.Event()
+
+	def wake(self):
+		self.event.set()
+
+class VelesAsyncWaiter(object):
+	def __init__(self, scheduler, loop, future):
+		self.scheduler = scheduler
+		self.loop = loop
+		self.future = future
+
+	def wake(self):
+		self.loop.call_soon_threadsafe(self.grant)
+
+	def grant(self):
+		if self.future.cancelled():	# gave up meanwhile, pass the slot on
+			self.scheduler.release()
+		else:
+			self.future.set_result(None)
+
+# Caps the daemon RPC calls in progress. Calls wait in their priority class,
+# a class is served only when all the higher ones are empty, and the last
+# reserved slots are left to the tip and ingest classes, so client commands
+# can't take them all and delay a new block. Within a class the waiting calls
+# are served round-robin by client, a client sending many commands waits for
+# its own ones. Works for both the executor threads (acquire/slot) and the
+# event loop (acquire_async).
+class VelesRPCScheduler(object):
+	def __init__(self, max_concurrency = 4, reserved = 1):
+		self.max_concurrency = int(max_concurrency)
+		self.reserved = min(int(reserved), self.max_concurrency - 1)
+		self.queues = [collections.OrderedDict() for name in priority_names]	# client -> waiters
+		self.in_flight = 0
+		self.lock = threading.Lock()
+		vlsmetrics.registry.gauge('veles_rpc_in_flight', 'Daemon RPC calls in progress', function = lambda: self.in_flight)
+
+	def can_start(self, priority):
+		limit = self.max_concurrency - (self.reserved if priority >= PRIORITY_INTERACTIVE else 0)
+		return self.in_flight < limit
+
+	def try_start(self, priority):
+		if any(self.queues[:priority + 1]) or not self.can_start(priority):
+			return False
+
+		self.in_flight += 1
+		return True
+
+	def enqueue(self, priority, client, waiter):
+		self.queues[priority].setdefault(client, collections.deque()).append(waiter)
+		rpc_queue_depth.inc(priority=priority_names[priority])
+
+	def remove(self, priority, client, waiter):
+		waiters = self.queues[priority].get(client)
+
+		if not waiters or waiter not in waiters:
+			return False
+
+		waiters.remove(waiter)
+		rpc_queue_depth.dec(priority=priority_names[priority])
+
+		if not waiters:
+			del self.queues[priority][client]
+
+		return True
+
+	def dispatch(self):
+		for priority, queue in enumerate(self.queues):
+			while queue and self.can_start(priority):
+				client, waiters = queue.popitem(last = False)
+				waiter = waiters.popleft()
+
+				if waiters:	# to the back of the class
+					queue[client] = waiters
+
+				rpc_queue_depth.dec(priority=priority_names[priority])
+				self.in_flight += 1
+				waiter.wake()
+
+			if queue:	# the lower classes wait behind this one
+				return
+
+	def acquire(self, priority, client = None):
+		started = time.perf_counter()
+
+		with self.lock:
+			if self.try_start(priority):
+				waiter = None
+			else:
+				waiter = VelesThreadWaiter()
+				self.enqueue(priority, client, waiter)
+
+		if waiter:
+			waiter.event.wait()
+
+		rpc_wait_seconds.observe(time.perf_counter() - started, priority=priority_names[priority])
+
+	@asyncio.coroutine
+	def acquire_async(self, priority, client = None):
+		started = time.perf_counter()
+
+		with self.lock:
+			if self.try_start(priority):
+				waiter = None
+			else:
+				loop = asyncio.get_event_loop()
+				waiter = VelesAsyncWaiter(self, loop, loop.create_future())
+				self.enqueue(priority, client, waiter)
+
+		if waiter:
+			try:
+				yield from waiter.future
+			except asyncio.CancelledError:
+				with self.lock:
+					removed = self.remove(priority, client, waiter)
+
+				if not removed and waiter.future.done() and not waiter.future.cancelled():
+					self.release()	# granted just before the cancellation
+
+				raise
+
+		rpc_wait_seconds.observe(time.perf_counter() - started, priority=priority_names[priority])
+
+	def release(self):
+		with self.lock:
+			self.in_flight -= 1
+			self.dispatch()
+
+	def slot(self, priority, client = None):
+		return VelesRPCSlot(self, priority, client)
+
+class VelesRPCSlot(object):
+	def __init__(self, scheduler, priority, client):
+		self.scheduler = scheduler
+		self.priority = priority
+		self.client = client
+
+	def __enter__(self):
+		self.scheduler.acquire(self.priority, self.client)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.scheduler.release()
 
 class VelesRPCClient(object):
-	def __init__(self, host = "127.0.0.1", port = 25522, username = None, password = None):
+	def __init__(self, host = "127.0.0.1", port = 25522, username = None, password = None, max_concurrency = 4, reserved = 1):
 		self.host = host
 		self.port = int(port)
 		self.username = username
 		self.password = password
+		self.scheduler = VelesRPCScheduler(max_concurrency, reserved)
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.scheduler.max_concurrency)	# never more calls than slots
+
+	def rpc_call(self, method, params = [], priority = PRIORITY_BACKGROUND, client = None):
+		with self.scheduler.slot(priority, client):
+			return self.unscheduled_rpc_call(method, params)
+
+	@asyncio.coroutine
+	def rpc_call_async(self, method, params = [], priority = PRIORITY_INTERACTIVE, client = None):
+		# waits for the slot on the event loop, runs the call on the executor
+		yield from self.scheduler.acquire_async(priority, client)
+
+		try:
+			result = yield from asyncio.get_event_loop().run_in_executor(self.executor, self.unscheduled_rpc_call, method, params)
+		finally:
+			self.scheduler.release()
+
+		return result
+
+	def unscheduled_rpc_call(self, method, params = []):
+		with rpc_seconds.time(method=method):
+			try:
+				result = self.do_rpc_call(method, params)
+			except:
+				rpc_errors.inc(method=method)
+				raise
+
+		if isinstance(result, dict) and 'error' in result:
+			rpc_errors.inc(method=method)
+
+		return result
 
-	def rpc_call(self, method, params = []):
+	def do_rpc_call(self, method, params = []):
 		if self.username or self.password:
 			url = "http://%s:%s@%s:%s" % (self.username, self.password, self.host, self.port)
 		else:
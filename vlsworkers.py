@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+#
+# Multi-process worker mode: supervisor, event hub and worker channel
+#
+import asyncio
+import json
+import os
+import signal
+
+import vlslog
+
+line_limit = 16 * 1024 * 1024	# the largest message, eg. a full masternode list
+
+# Runs in the supervisor, relays the newline separated JSON messages of every
+# worker to all the others over a unix socket. Persistent events and shared
+# states are kept by their key and sent to workers connecting later, so a
+# restarted worker gets the same recent event replay as the others. The relay
+# never waits for a single worker: one that lets more than max_buffer bytes
+# pile up unread is disconnected, and gets the retained messages again when
+# it reconnects.
+class VelesEventHub(object):
+	max_buffer = 64 * 1024 * 1024
+
+	def __init__(self, path):
+		self.path = path
+		self.writers = []
+		self.retained = {}	# key -> encoded message
+
+	@asyncio.coroutine
+	def start(self):
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+		server = yield from asyncio.start_unix_server(self.handle_worker, path = self.path, limit = line_limit)
+		return server
+
+	def write(self, writer, line):
+		if writer.transport.is_closing():
+			return
+
+		if writer.transport.get_write_buffer_size() > self.max_buffer:
+			vlslog.logger.error('Event hub: worker not reading, %i bytes buffered, disconnecting it', writer.transport.get_write_buffer_size())
+			writer.transport.abort()	# drops the buffer, the reader of the worker sees the end
+			return
+
+		writer.write(line)
+
+	@asyncio.coroutine
+	def handle_worker(self, reader, writer):
+		for line in self.retained.values():
+			self.write(writer, line)
+
+		self.writers += [writer]
+
+		try:
+			while True:
+				line = yield from reader.readline()
+
+				if not line:
+					break
+
+				try:
+					message = json.loads(line.decode('utf-8'))
+				except ValueError as e:
+					vlslog.logger.error('Event hub: invalid worker message skipped: %s', e)
+					continue
+
+				if message.get('key'):
+					self.retained[message['type'] + ':' + message['key']] = line
+
+				for other in self.writers:
+					if other is not writer:
+						self.write(other, line)
+		except (ConnectionError, ValueError) as e:	# ValueError also on a line over the limit
+			vlslog.logger.error('Event hub: worker connection error: %s', e)
+		finally:
+			self.writers.remove(writer)
+			writer.close()
+
+# Worker side of the hub connection. Messages are {'type': 'event'|'state',
+# 'key': ..., ...} dictionaries, received ones are passed to the handler.
+# Reconnects when the supervisor restarts the hub, sends while disconnected
+# are dropped (the retained state is resent by the publisher on its next poll).
+class VelesEventChannel(object):
+	reconnect_delay = 1
+
+	def __init__(self, path, handler):
+		self.path = path
+		self.handler = handler
+		self.writer = None
+
+	def send(self, message):
+		if self.writer:
+			self.writer.write((json.dumps(message) + '\n').encode('utf-8'))
+
+	@asyncio.coroutine
+	def run_task(self):
+		while True:
+			try:
+				reader, self.writer = yield from asyncio.open_unix_connection(self.path, limit = line_limit)
+
+				while True:
+					line = yield from reader.readline()
+
+					if not line:
+						break
+
+					try:
+						self.handler(json.loads(line.decode('utf-8')))
+					except Exception as e:
+						vlslog.logger.error('Error handling event hub message: %s', e, exc_info=True)
+			except (ConnectionError, OSError, ValueError) as e:
+				vlslog.logger.error('Event hub connection error: %s', e)
+
+			self.writer = None
+			yield from asyncio.sleep(self.reconnect_delay)
+
+# Forks the workers, each running the server with its own event loop on the
+# shared ports (SO_REUSEPORT), the first one as the publisher running the pull
+# tasks, and relays their events. Dead workers are restarted in the same role.
+class VelesSupervisor(object):
+	check_delay = 1
+
+	def __init__(self, start_worker, workers, socket_path):
+		self.start_worker = start_worker	# start_worker(is_publisher, socket_path), never returns
+		self.workers = workers
+		self.socket_path = socket_path
+		self.children = {}	# pid -> worker index
+
+	def fork(self, index):
+		pid = os.fork()
+
+		if pid:
+			self.children[pid] = index
+			return
+
+		# child: fresh event loop, default signal handling
+		signal.signal(signal.SIGINT, signal.SIG_DFL)
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		asyncio.set_event_loop(asyncio.new_event_loop())
+
+		try:
+			self.start_worker(index == 0, self.socket_path)
+		finally:
+			os._exit(0)
+
+	@asyncio.coroutine
+	def monitor_task(self):
+		while True:
+			yield from asyncio.sleep(self.check_delay)
+
+			for pid, index in list(self.children.items()):
+				finished, status = os.waitpid(pid, os.WNOHANG)
+
+				if finished:
+					vlslog.logger.error('Worker %i (pid %i) exited with status %i, restarting', index, pid, status)
+					del self.children[pid]
+					self.fork(index)
+
+	def stop(self, *args):
+		for pid in self.children.keys():
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+	def run(self):
+		hub = VelesEventHub(self.socket_path)
+		loop = asyncio.get_event_loop()
+		loop.run_until_complete(hub.start())
+
+		for index in range(self.workers):
+			self.fork(index)
+
+		vlslog.logger.info('Supervisor running %i workers, event hub at %s', self.workers, self.socket_path)
+		loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+		try:
+			loop.run_until_complete(self.monitor_task())
+		except (KeyboardInterrupt, RuntimeError):
+			print('\n* Shutting down the workers *')
+		finally:
+			self.stop()
+
+			for pid in list(self.children.keys()):
+				os.waitpid(pid, 0)
+
+			if os.path.exists(self.socket_path):
+				os.unlink(self.socket_path)